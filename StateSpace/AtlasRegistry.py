@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
+"""
+Local registry of parcellations, stored on the grid of the bundled gradients.
+
+Lesion.makemaps fetches the Yeo / Schaefer atlases with nilearn (which needs
+network access on first use) and the lesion functions resample them on every
+run. An AtlasRegistry stores each parcellation once:
+
+    - resampled (nearest neighbour) to the gradient grid
+    - as an int16 label array with its table of parcel names
+
+and indexes the voxels of every parcel, so looking up a parcel is O(1). A
+registry can be seeded from local files (e.g. copied to an offline compute
+node) or, where there is network access, fetched through nilearn:
+
+    python -m StateSpace.AtlasRegistry seed <registrydir> schaefer_400 Schaefer400.nii.gz Schaefer400_labels.txt
+    python -m StateSpace.AtlasRegistry fetch <registrydir> yeo_thick_7
+    python -m StateSpace.AtlasRegistry list <registrydir>
+
+Then pass registry=<registrydir> to Lesion.makemaps, or set the
+STATESPACE_ATLAS_DIR environment variable.
+
+"""
+
+import argparse
+import glob
+import os
+import re
+import tempfile
+import nibabel as nib
+import numpy as np
+
+from StateSpace.Utils import datapath
+
+# registry entry file extension (one .npz per atlas)
+ENTRY_EXT = '.npz'
+
+# environment variable naming the registry used by default in Lesion.makemaps
+REGISTRY_ENV = 'STATESPACE_ATLAS_DIR'
+
+# atlas keys: yeo_<thick|thin>_<7|17> and schaefer_<n_rois>
+KEY_PATTERN = re.compile(r'^(?:yeo_(thick|thin)_(7|17)|schaefer_(\d+))$')
+
+def atlaskey(yeo, shafer_rois=400, yeover='thick_7'):
+    """
+    Return the registry key of an atlas (e.g. 'yeo_thick_7' or 'schaefer_400'), from the makemaps options.
+    """
+    return f'yeo_{yeover}' if yeo else f'schaefer_{shafer_rois}'
+
+def gridimg():
+    """
+    Return the first bundled gradient image, which defines the registry grid.
+    """
+    return nib.load(sorted(glob.glob(os.path.join(datapath('data/gradients'), '*.nii*')))[0])
+
+def labelindex(labels, n_labels):
+    """
+    Return the flat voxel indices of every label 0..n_labels, from one stable sort of the labels.
+
+    Args:
+        labels (numpy array): 1-d integer labels.
+        n_labels (int): Highest label.
+
+    Returns:
+        list: n_labels + 1 sorted index arrays (entry i holds the voxels labelled i).
+    """
+    order = np.argsort(labels, kind='stable')
+    bounds = np.searchsorted(labels[order], np.arange(n_labels + 2))
+    return [order[bounds[label]:bounds[label + 1]] for label in range(n_labels + 1)]
+
+def readnames(path):
+    """
+    Read parcel names from a text file, one per line in label order.
+
+    Tab-separated lookup tables (label, name, ...), as shipped with the Schaefer atlas, are read from their second column.
+    """
+    names = []
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line.strip():
+                continue
+            names.append(line.split('\t')[1] if '\t' in line else line)
+    return names
+
+class Atlas:
+    """
+    Parcellation as an int16 label array on one grid, with its parcel names.
+
+    Parcel i (0-based position in names) has label i + 1, 0 is background (as in Lesion.lesion).
+    Lesion.batchLesion and Lesion.parcellabels use the label array directly when
+    the maps are on the atlas grid, instead of resampling.
+
+    Args:
+        labels (numpy array): 3-d integer labels.
+        names (list): Parcel names, in label order.
+        affine (numpy array): 4x4 affine of the grid.
+        key (str, optional): Registry key. Defaults to None.
+    """
+
+    def __init__(self, labels, names, affine, key=None):
+        self.labels = np.asarray(labels, dtype=np.int16)
+        self.names = [name.decode() if isinstance(name, bytes) else str(name) for name in names]
+        self.affine = np.asarray(affine, dtype=np.float64)
+        self.key = key
+        self._labels = {name: label for label, name in enumerate(self.names, start=1)}
+        self._index = None
+
+    @property
+    def shape(self):
+        return self.labels.shape
+
+    @property
+    def n_parcels(self):
+        return len(self.names)
+
+    def toimg(self):
+        """
+        Return the label array as an int16 nifti image.
+        """
+        return nib.Nifti1Image(self.labels, self.affine)
+
+    def labelindex(self):
+        """
+        Return the flat voxel indices of every label (0 = background), computed once.
+        """
+        if self._index is None:
+            self._index = labelindex(self.labels.reshape(-1), self.n_parcels)
+        return self._index
+
+    def label(self, parcel):
+        """
+        Return the label of a parcel name (str or bytes).
+        """
+        name = parcel.decode() if isinstance(parcel, bytes) else str(parcel)
+        if name not in self._labels:
+            raise KeyError(f"Unknown parcel {name!r} in atlas {self.key}")
+        return self._labels[name]
+
+    def voxels(self, parcel):
+        """
+        Return the flat voxel indices (into the label array) of a parcel, given by name or label.
+        """
+        label = parcel if isinstance(parcel, (int, np.integer)) else self.label(parcel)
+        return self.labelindex()[label]
+
+class AtlasRegistry:
+    """
+    Directory of parcellations resampled to the gradient grid.
+
+    Args:
+        registrydir (str): Registry directory (created if needed).
+    """
+
+    def __init__(self, registrydir):
+        self.registrydir = registrydir
+        self._atlases = {}
+        os.makedirs(registrydir, exist_ok=True)
+
+    def _entrypath(self, key):
+        return os.path.join(self.registrydir, key + ENTRY_EXT)
+
+    def __contains__(self, key):
+        return os.path.exists(self._entrypath(key))
+
+    def keys(self):
+        """
+        Return the keys of the stored atlases, sorted.
+        """
+        return sorted(name[:-len(ENTRY_EXT)] for name in os.listdir(self.registrydir) if name.endswith(ENTRY_EXT))
+
+    def seed(self, key, parcellation, parcelnames):
+        """
+        Resample a parcellation to the gradient grid and store it under key.
+
+        Args:
+            key (str): Registry key (e.g. 'schaefer_400', see atlaskey).
+            parcellation (str or nibabel image object): Parcellation image or its filepath.
+            parcelnames (str or list): Parcel names in label order (from label 1), or a text file of names (see readnames).
+
+        Returns:
+            Atlas: The stored atlas.
+        """
+        from nilearn.image import resample_to_img
+
+        if isinstance(parcellation, str):
+            parcellation = nib.load(parcellation)
+        if isinstance(parcelnames, str):
+            parcelnames = readnames(parcelnames)
+        parcelnames = [name.decode() if isinstance(name, bytes) else str(name) for name in parcelnames]
+        # some nilearn versions list the background (label 0) first
+        if parcelnames and parcelnames[0].lower() == 'background':
+            parcelnames = parcelnames[1:]
+
+        grid = gridimg()
+        fixed_parcelmap = resample_to_img(parcellation, grid, interpolation='nearest')
+        labels = np.rint(np.asanyarray(fixed_parcelmap.dataobj)).squeeze()
+        if labels.min() < 0 or labels.max() > len(parcelnames) or labels.max() > np.iinfo(np.int16).max:
+            raise ValueError(f'Parcellation labels {labels.min():.0f}..{labels.max():.0f} do not match '
+                             f'{len(parcelnames)} parcel names')
+        atlas = Atlas(labels, parcelnames, grid.affine, key=key)
+
+        # write to a temporary file first so readers never see partial entries
+        fd, tmp = tempfile.mkstemp(dir=self.registrydir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(f, labels=atlas.labels, names=np.array(atlas.names), affine=atlas.affine)
+            os.replace(tmp, self._entrypath(key))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self._atlases[key] = atlas
+        return atlas
+
+    def fetch(self, key):
+        """
+        Download an atlas with nilearn (into registrydir/downloads) and store it under key.
+
+        Args:
+            key (str): 'yeo_<thick|thin>_<7|17>' or 'schaefer_<n_rois>'.
+
+        Returns:
+            Atlas: The stored atlas.
+        """
+        from StateSpace.Lesion import makemaps
+
+        match = KEY_PATTERN.match(key)
+        if match is None:
+            raise ValueError(f"Cannot fetch atlas '{key}', expected yeo_<thick|thin>_<7|17> or schaefer_<n_rois>")
+        yeo = match.group(3) is None
+        parcellation, parcelnames = makemaps(yeo, False, shafer_rois=int(match.group(3) or 400),
+                                             yeover=f'{match.group(1)}_{match.group(2)}' if yeo else 'thick_7',
+                                             data_dir=os.path.join(self.registrydir, 'downloads'), registry=False)
+        return self.seed(key, parcellation, parcelnames)
+
+    def load(self, key):
+        """
+        Return the atlas stored under key (read once per registry).
+
+        Args:
+            key (str): Registry key.
+
+        Returns:
+            Atlas: The atlas.
+        """
+        if key not in self._atlases:
+            if key not in self:
+                raise KeyError(f"Atlas '{key}' is not in the registry {self.registrydir}; "
+                               f"add it with seed() (local files) or fetch() (needs network access)")
+            with np.load(self._entrypath(key)) as npz:
+                self._atlases[key] = Atlas(npz['labels'], npz['names'].tolist(), npz['affine'], key=key)
+        return self._atlases[key]
+
+def openregistry(registry):
+    """
+    Return registry as an AtlasRegistry (an AtlasRegistry, a directory path, None for $STATESPACE_ATLAS_DIR if set, or False for none).
+    """
+    if registry is None:
+        registry = os.environ.get(REGISTRY_ENV) or None
+    if registry is None or registry is False:
+        return None
+    if isinstance(registry, AtlasRegistry):
+        return registry
+    return AtlasRegistry(registry)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Seed and inspect a StateSpace atlas registry.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    p = subparsers.add_parser('seed', help='add a parcellation from local files')
+    p.add_argument('registrydir', help='registry directory')
+    p.add_argument('key', help="atlas key, e.g. 'schaefer_400' or 'yeo_thick_7'")
+    p.add_argument('parcellation', help='parcellation nifti')
+    p.add_argument('names', help='text file of parcel names (one per line, or a tab-separated lookup table)')
+    p = subparsers.add_parser('fetch', help='download an atlas with nilearn and add it')
+    p.add_argument('registrydir', help='registry directory')
+    p.add_argument('key', help="'yeo_<thick|thin>_<7|17>' or 'schaefer_<n_rois>'")
+    p = subparsers.add_parser('list', help='list the stored atlases')
+    p.add_argument('registrydir', help='registry directory')
+    args = parser.parse_args(argv)
+
+    registry = AtlasRegistry(args.registrydir)
+    if args.command == 'seed':
+        atlas = registry.seed(args.key, args.parcellation, args.names)
+        print (f"Stored {args.key} ({atlas.n_parcels} parcels) in {args.registrydir}")
+    elif args.command == 'fetch':
+        atlas = registry.fetch(args.key)
+        print (f"Stored {args.key} ({atlas.n_parcels} parcels) in {args.registrydir}")
+    else:
+        for key in registry.keys():
+            atlas = registry.load(key)
+            print (f"{key:20s} {atlas.n_parcels:5d} parcels  {np.count_nonzero(atlas.labels):7d} voxels")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
+"""
+Subject-bootstrap confidence intervals for group time-course coordinates.
+
+bootstrapGroupTimeCourse resamples subjects with replacement n_boot times and
+correlates every resampled group-mean time course with the gradients, per TR.
+Each resample's group mean is a weighted sum of the subjects (weights =
+how often a subject was drawn / n_subjects), so all resamples come from one
+(n_boot x n_subjects) weight matrix applied to per-subject in-mask matrices.
+Those are held in memory (an array) or in a memory-mapped VoxelStore, e.g.
+
+    store = VoxelStore.buildStore(runs, 'store', mask_name, map_coverage, z_score=True)
+
+which z-scores runs as calGroupTimeCourse does. Nothing is re-read or
+re-averaged per resample:
+
+    pearson   exact from per-TR projections of the subjects on the gradients
+              and their (n_subjects x n_subjects) Gram matrix, never forming
+              the resampled means
+    spearman  resampled means are formed boot_chunk at a time for tr_chunk
+              TRs at a time (bounded memory) and ranked
+
+With parcellation=... the subjects are averaged within parcels first, which
+makes spearman resamples cheap as well.
+
+Resamples repeat some subjects and leave out others, so less noise averages
+out of their group means and their correlations are attenuated: the
+bootstrap distribution sits closer to zero than the group-mean estimate, by
+more than its spread when there are many voxels. Two intervals are returned:
+
+    lower / upper                         median-centred percentile band:
+                                          estimate + (q - median), the bootstrap
+                                          percentiles q shifted so their median
+                                          sits on the estimate ('bias' is the shift)
+    percentile_lower / percentile_upper   standard percentile interval: the
+                                          bootstrap percentiles q themselves
+
+The percentile interval can miss the estimate entirely when the attenuation
+is large; the median-centred band always contains it and keeps the width and
+asymmetry of the bootstrap distribution.
+
+"""
+
+import numpy as np
+
+from StateSpace.CorrelateTasksWithGradients import (_resolveGradientSet, parcelsuffix,
+                                                    corrPrepared, slidingWindow, windowsuffix, ParcelGradientSet,
+                                                    CORR_METHODS)
+from StateSpace.ResultWriter import writeResults
+from StateSpace.VoxelStore import VoxelStore
+
+def _subjectrows(subjects, start, stop):
+    # (n_subjects x n_TRs x n_voxels) float64 rows start:stop of every subject
+    if isinstance(subjects, VoxelStore):
+        return np.stack([np.asarray(subjects[entry][start:stop], dtype=np.float64) for entry in range(len(subjects))])
+    if isinstance(subjects, np.ndarray):
+        return np.asarray(subjects[:, start:stop], dtype=np.float64)
+    return np.stack([np.asarray(subject[start:stop], dtype=np.float64) for subject in subjects])
+
+def _subjectshape(subjects):
+    # number of subjects, TRs and voxels (all subjects must have the same number of TRs)
+    if isinstance(subjects, VoxelStore):
+        shapes = [subjects[entry].shape for entry in range(len(subjects))]
+    elif isinstance(subjects, np.ndarray):
+        if subjects.ndim != 3:
+            raise ValueError(f'Expected a (n_subjects x n_TRs x n_voxels) array, got shape {subjects.shape}')
+        shapes = [subjects.shape[1:]] * subjects.shape[0]
+    else:
+        shapes = [np.shape(subject) for subject in subjects]
+    if any(len(shape) != 2 for shape in shapes):
+        raise ValueError('Expected one (n_TRs x n_voxels) matrix per subject (4-d runs)')
+    if len(set(shapes)) != 1:
+        raise ValueError(f'Subjects differ in shape: {sorted(set(shapes))}')
+    return len(shapes), shapes[0][0], shapes[0][1]
+
+def _pearsonBoot(rows, weights, gradient_prepared):
+    # pearson r of every weighted subject mean with every gradient, per TR, from projections and Gram matrices
+    # (centring each subject's TR commutes with the weighted mean)
+    rows = rows - rows.mean(axis=2, keepdims=True)
+    projections = np.einsum('stv,gv->tsg', rows, gradient_prepared)
+    gram = np.einsum('stv,utv->tsu', rows, rows)
+    numerator = np.einsum('bs,tsg->tbg', weights, projections)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        norm = np.sqrt(np.einsum('bs,tsu,bu->tb', weights, gram, weights))
+        return numerator / norm[..., np.newaxis]
+
+def bootstrapGroupTimeCourse(mask_name, map_coverage, subjects, n_boot=1000, corr_method='spearman', ci=0.95,
+                             seed=None, timecourse_name=None, outputdir=None, gradient_set=None, parcellation=None,
+                             window=None, taper='boxcar', tr_chunk=10, boot_chunk=100, output_format='csv', verbose=1):
+    """
+    Calculate per TR group time-course correlations with subject-bootstrap confidence intervals.
+
+    Args:
+        mask_name (str): The name of the mask.
+        map_coverage (str): The coverage of the map.
+        subjects (VoxelStore, numpy array or list): Per-subject in-mask (n_TRs x n_voxels) matrices: a VoxelStore of
+            4-d runs, a (n_subjects x n_TRs x n_voxels) array (e.g. a np.memmap) or a list of matrices.
+
+        n_boot (int, optional): Number of bootstrap resamples. Defaults to 1000.
+        corr_method (str, optional): The correlation method ('spearman', 'pearson' or 'kendall'). Defaults to 'spearman'.
+        ci (float, optional): Coverage of the confidence intervals. Defaults to 0.95.
+        seed (int, optional): Seed of the resampling. Defaults to None.
+        timecourse_name (str, optional): Name of timecourse for saving results. Defaults to None.
+        outputdir (str, optional): The output directory. Defaults to None.
+        gradient_set (GradientSet, optional): Preloaded gradients. Defaults to None (loaded from cache).
+        parcellation (nibabel image object or Atlas, optional): Correlate at parcel resolution (see ParcelGradientSet). Defaults to None (voxels).
+        window (int, optional): Correlate the average of a sliding window of this many TRs centred on each TR (see slidingWindow). Defaults to None (single TRs).
+        taper (str, optional): Sliding window shape, 'boxcar' or 'triangular'. Defaults to 'boxcar'.
+        tr_chunk (int, optional): Number of TRs read from all subjects at once. Defaults to 10.
+        boot_chunk (int, optional): Number of resampled group means formed at once (spearman / kendall). Defaults to 100.
+        output_format (str, optional): Format of the output file ('csv', 'parquet', 'feather' or 'hdf5'). Defaults to 'csv'.
+        verbose (int, optional): The verbosity level. Defaults to 1.
+
+    Returns:
+        pandas.DataFrame: One row per TR and gradient with the group-mean 'Correlation' (as corrGroupTimeCourse),
+        the bootstrap 'se', the 'lower' and 'upper' bounds of the median-centred percentile band
+        ('Correlation' + bootstrap percentile - bootstrap median), the 'percentile_lower' and 'percentile_upper'
+        bootstrap percentiles and the 'bias' (bootstrap median minus 'Correlation').
+    """
+    import pandas as pd
+
+    if corr_method not in CORR_METHODS:
+        raise ValueError(f"corr_method must be one of {CORR_METHODS}, not {corr_method!r}")
+    if int(n_boot) != n_boot or n_boot < 2:
+        raise ValueError(f'n_boot must be an integer of at least 2, not {n_boot!r}')
+    if not 0 < ci < 1:
+        raise ValueError(f'ci must be between 0 and 1, not {ci!r}')
+
+    gradient_set = _resolveGradientSet(mask_name, map_coverage, gradient_set, parcellation)
+    parcels = isinstance(gradient_set, ParcelGradientSet)
+    if isinstance(subjects, VoxelStore):
+        subjects.checkmask(gradient_set)
+
+    n_subjects, n_trs, n_voxels = _subjectshape(subjects)
+    if n_voxels != gradient_set.n_voxels:
+        raise ValueError(f'Number of voxels does not match: subjects {n_voxels}, mask {gradient_set.n_voxels}')
+    gradient_prepared = gradient_set.prepared(corr_method)
+
+    # row 0 is the group mean of all subjects, then one row of subject weights per resample
+    rng = np.random.default_rng(seed)
+    weights = np.vstack([np.full(n_subjects, 1 / n_subjects),
+                         rng.multinomial(n_subjects, np.full(n_subjects, 1 / n_subjects), size=int(n_boot)) / n_subjects])
+
+    # windows need neighbouring TRs, so read each chunk with a margin of window TRs on both sides
+    margin = 0 if window is None else int(window)
+    corr = np.empty((n_trs, len(weights), len(gradient_set.names)))
+    for start in range(0, n_trs, tr_chunk):
+        stop = min(start + tr_chunk, n_trs)
+        first, last = max(start - margin, 0), min(stop + margin, n_trs)
+        rows = _subjectrows(subjects, first, last)
+        if window is not None:
+            rows = np.stack([slidingWindow(subject, window, taper) for subject in rows])
+        rows = rows[:, start - first:stop - first]
+        if parcels:
+            rows = np.stack([gradient_set.reduce(subject) for subject in rows])
+
+        if corr_method == 'pearson':
+            corr[start:stop] = np.clip(_pearsonBoot(rows, weights, gradient_prepared), -1, 1)
+        else:
+            for tr in range(stop - start):
+                for boot in range(0, len(weights), boot_chunk):
+                    # resampled group means of this TR, boot_chunk at a time
+                    means = weights[boot:boot + boot_chunk] @ rows[:, tr]
+                    corr[start + tr, boot:boot + boot_chunk] = corrPrepared(means, gradient_prepared, corr_method)
+        if verbose > 0:
+            print (f"Bootstrapped TRs {start}-{stop - 1} ({n_boot} resamples of {n_subjects} subjects)")
+
+    if corr_method == 'pearson':
+        # apply fishers-r-to-z transformation to correlation values
+        corr = np.arctanh(corr)
+
+    # median-centred percentile band (percentiles relative to the bootstrap median, placed around the estimate)
+    # and the standard percentile interval
+    estimate = corr[:, 0]
+    boots = corr[:, 1:]
+    lower, median, upper = np.nanquantile(boots, [(1 - ci) / 2, 0.5, (1 + ci) / 2], axis=1)
+    df = pd.DataFrame({'TR': np.repeat(np.arange(n_trs), len(gradient_set.names)),
+                       'Gradient': np.tile(gradient_set.names, n_trs),
+                       'Correlation': estimate.ravel(),
+                       'se': np.nanstd(boots, axis=1, ddof=1).ravel(),
+                       'lower': (estimate + lower - median).ravel(),
+                       'upper': (estimate + upper - median).ravel(),
+                       'percentile_lower': lower.ravel(),
+                       'percentile_upper': upper.ravel(),
+                       'bias': (median - estimate).ravel()})
+
+    # save to output dir
+    if outputdir != None:
+        stem = f'gradscores_grp_{timecourse_name}_{corr_method}_{mask_name}{parcelsuffix(gradient_set)}{windowsuffix(window, taper)}_bootstrap'
+        writeResults(df, outputdir, stem, output_format)
+
+    return df
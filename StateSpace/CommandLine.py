@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
+"""
+Command-line interface (installed as the `statespace` command).
+
+Subcommands run one analysis each:
+
+    statespace corr-group  --mask gradientmask_cortical --coverage cortical_only --outputdir results
+    statespace corr-ind    --inputs "bids/sub-*/task-*/map.nii.gz" --taskstring task- --substring sub- --outputdir results
+    statespace timecourse  --inputs "bids/sub-*/func/*bold.nii.gz" --name movie --outputdir results
+    statespace lesion      --mapdir maps --outpath lesioned
+    statespace cache       prune results_cache --max-mb 500
+
+and `statespace run manifest.yaml --workers 4` runs a batch of jobs from a
+JSON or YAML manifest (YAML needs PyYAML):
+
+    defaults:                       # applied to every job (lesion jobs take only the keys runlesion accepts)
+      mask_name: gradientmask_cortical
+      map_coverage: cortical_only
+      outputdir: results
+    jobs:
+      - command: corr-ind
+        inputfiles: bids/sub-*/task-*/map.nii.gz
+        taskstring: task-
+        substring: sub-
+      - command: timecourse
+        mode: ind
+        inputfiles: bids/sub-*/func/*bold.nii.gz
+        substring: sub-
+        timecourse_name: movie
+      - command: lesion
+        mapdir: maps
+        outpath: lesioned
+
+Job keys are the keyword arguments of the matching function (corrGroup,
+corrInd, calGroupTimeCourse/corrGroupTimeCourse or corrIndTimeCourse). Lesion
+jobs take the keyword arguments of runlesion (mapdir, outpath, yeo, shafer_rois,
+yeover, parcels, n_threads, registry, verbose). inputfiles may be a glob pattern or a list of
+paths/patterns. Gradients and masks are loaded once per (mask, coverage) and
+shared by all jobs, which run in a thread pool of --workers threads.
+
+"""
+
+import argparse
+import glob
+import inspect
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+COMMANDS = ('corr-group', 'corr-ind', 'timecourse', 'lesion')
+
+def expandinputs(inputfiles):
+    """
+    Return sorted paths matching a glob pattern or a list of paths/patterns (None is kept).
+    """
+    if inputfiles is None:
+        return None
+    patterns = [inputfiles] if isinstance(inputfiles, str) else list(inputfiles)
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise FileNotFoundError(f'No input files match {pattern}')
+        paths.extend(matches)
+    return paths
+
+def loadmanifest(path):
+    """
+    Read a JSON or YAML job manifest.
+
+    Args:
+        path (str): Manifest path (.json, .yaml or .yml).
+
+    Returns:
+        list: One dict of keyword arguments per job (defaults merged in), each with a 'command'.
+    """
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError('Reading YAML manifests requires PyYAML: pip install pyyaml') from None
+            manifest = yaml.safe_load(f)
+        else:
+            manifest = json.load(f)
+
+    # a bare list of jobs is allowed too
+    if isinstance(manifest, list):
+        manifest = {'jobs': manifest}
+    defaults = manifest.get('defaults', {})
+    # defaults meant for the correlate jobs (output_format, n_jobs, cache, ...) are not passed to lesion jobs
+    lesion_defaults = {key: value for key, value in defaults.items() if key in inspect.signature(runlesion).parameters}
+    jobs = []
+    for n, job in enumerate(manifest.get('jobs', [])):
+        job = {**(lesion_defaults if job.get('command') == 'lesion' else defaults), **job}
+        if job.get('command') not in COMMANDS:
+            raise ValueError(f"Job {n} in {path}: command must be one of {COMMANDS}, got {job.get('command')!r}")
+        jobs.append(job)
+    return jobs
+
+def loadparcellation(parcellation, registry=None):
+    """
+    Return a parcellation given as a nifti path or an atlas registry key (e.g. 'schaefer_400').
+
+    Args:
+        parcellation (str): Nifti filepath, or key of an atlas in the registry.
+        registry (str, optional): Atlas registry directory. Defaults to None ($STATESPACE_ATLAS_DIR if set).
+
+    Returns:
+        nibabel image object or Atlas: The parcellation.
+    """
+    import nibabel as nib
+    from StateSpace.AtlasRegistry import openregistry
+
+    if os.path.exists(parcellation):
+        return nib.load(parcellation)
+    registry = openregistry(registry)
+    if registry is None:
+        raise FileNotFoundError(f'{parcellation} is not a file, and no atlas registry was given to look it up in')
+    return registry.load(parcellation)
+
+def runjob(job):
+    """
+    Run one job (dict with a 'command' and keyword arguments of the matching function).
+
+    Args:
+        job (dict): The job.
+
+    Returns:
+        object: Output of the function (DataFrame, a (DataFrame, p-values) tuple with n_perm, or the written paths for lesion jobs).
+    """
+    from StateSpace import CorrelateTasksWithGradients as C
+
+    kwargs = dict(job)
+    command = kwargs.pop('command')
+    if 'inputfiles' in kwargs:
+        kwargs['inputfiles'] = expandinputs(kwargs['inputfiles'])
+
+    if command == 'lesion':
+        return runlesion(**kwargs)
+
+    if kwargs.get('outputdir') is not None:
+        os.makedirs(kwargs['outputdir'], exist_ok=True)
+
+    # shared gradients and mask (loaded once per mask and coverage)
+    if kwargs.get('gradient_set') is None:
+        kwargs['gradient_set'] = C.getGradientSet(kwargs['mask_name'], kwargs['map_coverage'])
+
+    # parcel resolution (parcellation given as a nifti path or registry key)
+    registry = kwargs.pop('registry', None)
+    if isinstance(kwargs.get('parcellation'), str):
+        kwargs['parcellation'] = loadparcellation(kwargs['parcellation'], registry)
+
+    if command == 'corr-group':
+        return C.corrGroup(**kwargs)
+    if command == 'corr-ind':
+        return C.corrInd(**kwargs)
+
+    # time courses: group-averaged (default) or per subject
+    mode = kwargs.pop('mode', 'group')
+    if mode == 'ind':
+        kwargs.pop('z_score', None)
+        return C.corrIndTimeCourse(**kwargs)
+    if mode != 'group':
+        raise ValueError(f"timecourse mode must be 'group' or 'ind', got {mode!r}")
+    group_matrix = C.calGroupTimeCourse(kwargs['mask_name'], kwargs['map_coverage'], kwargs.pop('inputfiles'),
+                                        z_score=kwargs.pop('z_score', True), verbose=kwargs.get('verbose', 1),
+                                        gradient_set=kwargs['gradient_set'], as_matrix=True,
+                                        chunk_size=kwargs.pop('chunk_size', None) or 100)
+    return C.corrGroupTimeCourse(group_array_masked=group_matrix, **kwargs)
+
+def runlesion(mapdir, outpath, yeo=True, shafer_rois=400, yeover='thick_7', parcels=None, n_threads=None,
+              registry=None, verbose=1):
+    """
+    Write a lesioned copy of every map in mapdir for each parcel (one sub-directory per parcel).
+
+    Args:
+        mapdir (str or list): Directory (or directories) of maps to lesion.
+        outpath (str): Output directory.
+        yeo, shafer_rois, yeover: Atlas options passed to Lesion.makemaps (splitmaps writes region maps
+            instead of a parcellation, so it is not available here).
+        parcels (list, optional): Parcel names to lesion. Defaults to None (all parcels).
+        n_threads (int, optional): Writer threads. Defaults to None (one per core).
+        registry (str, optional): Atlas registry directory. Defaults to None ($STATESPACE_ATLAS_DIR if set).
+        verbose (int, optional): The verbosity level. Defaults to 1.
+
+    Returns:
+        list: The paths written to.
+    """
+    from StateSpace import Lesion
+
+    parcellation, parcelnames = Lesion.makemaps(yeo, False, shafer_rois=shafer_rois, yeover=yeover, registry=registry)
+    return Lesion.batchLesion(parcellation, parcelnames, mapdir, outpath, parcels=parcels,
+                              n_threads=n_threads, verbose=verbose)
+
+def runjobs(jobs, workers=1):
+    """
+    Run jobs in a thread pool, loading each (mask, coverage) gradient set once up front.
+
+    Args:
+        jobs (list): Jobs as returned by loadmanifest.
+        workers (int, optional): Number of jobs run at once. Defaults to 1.
+
+    Returns:
+        list: Output of each job, in order.
+    """
+    from StateSpace import CorrelateTasksWithGradients as C
+
+    # load shared gradient sets (and parcel-resolution sets) before starting threads
+    # so no two threads load or resample the same set
+    jobs = [dict(job) for job in jobs]
+    parcel_sets = {}
+    for job in jobs:
+        if job['command'] != 'lesion' and job.get('gradient_set') is None:
+            job['gradient_set'] = C.getGradientSet(job['mask_name'], job['map_coverage'])
+        if job['command'] != 'lesion' and isinstance(job.get('parcellation'), str):
+            key = (job['mask_name'], job['map_coverage'], job['parcellation'], job.get('registry'))
+            if key not in parcel_sets:
+                parcel_sets[key] = C.parcelGradientSet(job['gradient_set'],
+                                                       loadparcellation(job['parcellation'], job.get('registry')))
+            job['gradient_set'] = parcel_sets[key]
+            job.pop('parcellation')
+            job.pop('registry', None)
+
+    if workers == 1 or len(jobs) < 2:
+        return [runjob(job) for job in jobs]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(runjob, jobs))
+
+def _addcommon(parser):
+    # options shared by the correlate subcommands
+    parser.add_argument('--mask', dest='mask_name', default='gradientmask_cortical', help='mask name or path (default: gradientmask_cortical)')
+    parser.add_argument('--coverage', dest='map_coverage', default='cortical_only', help="map coverage, 'cortical_only' or 'all' (default: cortical_only)")
+    parser.add_argument('--outputdir', help='directory to write results to')
+    parser.add_argument('--corr-method', dest='corr_method', default='spearman', help='spearman, pearson or kendall (default: spearman)')
+    parser.add_argument('--legacy-mask', dest='legacy_mask', action='store_true', help='correlate whole masked volumes (old behaviour)')
+    parser.add_argument('--parcellation', help='correlate parcel averages: parcellation nifti or atlas registry key (e.g. schaefer_400)')
+    parser.add_argument('--registry', help='atlas registry directory for --parcellation keys (default: $STATESPACE_ATLAS_DIR if set)')
+    parser.add_argument('--verbose', type=int, default=1, help='verbosity level (default: 1)')
+
+def _addnull(parser):
+    # permutation p-values (corrGroup / corrInd)
+    parser.add_argument('--n-perm', dest='n_perm', type=int, help='also write permutation p-values from this many surrogate maps')
+    parser.add_argument('--null-model', dest='null_model', choices=['permute', 'block'], default='permute',
+                        help="surrogates: 'permute' voxels (parcels with --parcellation) or 'block' permute voxel blocks (default: permute)")
+    parser.add_argument('--seed', type=int, help='seed of the surrogates')
+
+def makeparser():
+    parser = argparse.ArgumentParser(prog='statespace', description='Correlate brain maps with gradients to get state-space coordinates.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('corr-group', help='correlate (group-level) maps with the gradients')
+    _addcommon(p)
+    p.add_argument('--inputs', dest='inputfiles', nargs='+', help='input maps or glob patterns (default: bundled task maps)')
+    p.add_argument('--cache', help='result cache directory')
+    p.add_argument('--n-jobs', dest='n_jobs', type=int, default=1, help='threads computing surrogates for --n-perm (-1 for all cores, default: 1)')
+    _addnull(p)
+
+    p = subparsers.add_parser('corr-ind', help='correlate individual-level maps with the gradients')
+    _addcommon(p)
+    p.add_argument('--inputs', dest='inputfiles', nargs='+', required=True, help='input maps or glob patterns')
+    p.add_argument('--taskstring', required=True, help='string identifying the task in file paths')
+    p.add_argument('--substring', required=True, help='string identifying the subject in file paths')
+    p.add_argument('--runstring', help='string identifying the run in file paths')
+    p.add_argument('--output-format', dest='output_format', default='csv', help='csv, parquet, feather or hdf5 (default: csv); feather is written at the end, not appended')
+    p.add_argument('--cache', help='result cache directory')
+    p.add_argument('--n-jobs', dest='n_jobs', type=int, default=1, help='worker processes (-1 for all cores, default: 1)')
+    _addnull(p)
+
+    p = subparsers.add_parser('timecourse', help='correlate 4-d runs (group-averaged or per subject) with the gradients per TR')
+    _addcommon(p)
+    p.add_argument('--inputs', dest='inputfiles', nargs='+', required=True, help='input 4-d runs or glob patterns')
+    p.add_argument('--mode', choices=['group', 'ind'], default='group', help='group-averaged or per-subject time courses (default: group)')
+    p.add_argument('--name', dest='timecourse_name', help='time course name used in output file names')
+    p.add_argument('--substring', help='string identifying the subject in file paths (ind mode)')
+    p.add_argument('--no-z-score', dest='z_score', action='store_false', help='do not z-score runs before averaging (group mode)')
+    p.add_argument('--chunk-size', dest='chunk_size', type=int, help='TRs read at once (group mode default: 100, ind mode default: whole runs)')
+    p.add_argument('--window', type=int, help='average sliding windows of this many TRs before correlating')
+    p.add_argument('--taper', choices=['boxcar', 'triangular'], default='boxcar', help='sliding window shape (default: boxcar)')
+    p.add_argument('--output-format', dest='output_format', default='csv', help='csv, parquet, feather or hdf5 (ind mode, default: csv); feather is written at the end, not appended')
+
+    p = subparsers.add_parser('lesion', help='write lesioned copies of maps, one directory per parcel')
+    p.add_argument('--mapdir', required=True, nargs='+', help='directories of maps to lesion')
+    p.add_argument('--outpath', required=True, help='output directory')
+    p.add_argument('--atlas', choices=['yeo', 'schaefer'], default='yeo', help='parcellation atlas (default: yeo)')
+    p.add_argument('--yeover', default='thick_7', help='Yeo atlas version (default: thick_7)')
+    p.add_argument('--shafer-rois', dest='shafer_rois', type=int, default=400, help='number of Schaefer ROIs (default: 400)')
+    p.add_argument('--parcels', nargs='+', help='only lesion these parcels')
+    p.add_argument('--threads', dest='n_threads', type=int, help='writer threads (default: one per core)')
+    p.add_argument('--registry', help='atlas registry directory (default: $STATESPACE_ATLAS_DIR if set)')
+    p.add_argument('--verbose', type=int, default=1, help='verbosity level (default: 1)')
+
+    from StateSpace.ResultCache import addcachearguments
+    p = subparsers.add_parser('cache', help='inspect, prune or clear a result cache')
+    addcachearguments(p)
+
+    p = subparsers.add_parser('run', help='run the jobs in a JSON or YAML manifest')
+    p.add_argument('manifest', help='manifest file (.json, .yaml or .yml)')
+    p.add_argument('--workers', type=int, default=1, help='jobs run at once (default: 1)')
+    return parser
+
+def main(argv=None):
+    parser = makeparser()
+    args = parser.parse_args(argv)
+
+    if args.command == 'cache':
+        from StateSpace.ResultCache import runcache
+        try:
+            runcache(args.cache_command, args.cachedir, args.max_mb, args.max_days)
+        except ValueError as e:
+            parser.error(str(e))
+        return 0
+
+    if args.command == 'run':
+        jobs = loadmanifest(args.manifest)
+        runjobs(jobs, args.workers)
+        print (f"Ran {len(jobs)} jobs from {args.manifest}")
+        return 0
+
+    job = {key: value for key, value in vars(args).items() if value is not None}
+    if args.command == 'lesion':
+        job['yeo'] = job.pop('atlas') == 'yeo'
+    elif args.command == 'timecourse' and args.mode == 'ind':
+        if args.substring is None:
+            makeparser().error('timecourse --mode ind needs --substring')
+    elif args.command == 'timecourse':
+        # per-subject options do not apply to the group-averaged time course
+        for key in ('substring', 'output_format'):
+            job.pop(key, None)
+    runjob(job)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -17,20 +17,27 @@ This produces 'coordinates' in state space.
 """
 
 import nibabel as nib
-from nilearn import image as nimg
 import glob
-from scipy.stats import spearmanr, pearsonr
 import os 
-import pandas as pd
 import numpy as np
-import pkg_resources
-from scipy.stats import zscore
+from functools import lru_cache, partial
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from StateSpace.VoxelStore import VoxelStore
+from StateSpace.ResultWriter import ResultWriter, outputpath, writeResults
+from StateSpace.ResultTable import ResultTable, uniqueids
+from StateSpace.ResultCache import opencache
+from StateSpace.Utils import datapath
+from StateSpace.CreateBinarizedMask import PackedMask
+
+# nilearn, scipy.stats and pandas are imported in the functions that use them,
+# so importing the package (e.g. in worker processes or the CLI) stays fast
 
 def get_sorted_paths(subdir, pattern):
     """
     Returns sorted paths (used by getdata)
     """
-    subdir_path = pkg_resources.resource_filename('StateSpace', subdir)
+    subdir_path = datapath(subdir)
     return sorted(glob.glob(f'{subdir_path}/{pattern}'))
 
 def getdata(mask_name, map_coverage):
@@ -38,27 +45,31 @@ def getdata(mask_name, map_coverage):
     Get the paths of gradient, mask, and task files.
 
     Args:
-        mask_name (str): The name of the mask.
+        mask_name (str or PackedMask): The name of the mask (or full path to own mask, or a PackedMask).
         map_coverage (str): The coverage of the map.
 
     Returns:
-        tuple: A tuple containing the paths of gradient files, mask file, and task files stored in data/realTaskNiftis.
+        tuple: A tuple containing the paths of gradient files, mask file (None for a PackedMask), and task files stored in data/realTaskNiftis.
     """
 
     # read in gradient path, dependent on map_coverage argument (cortical_only or cortical-subcortical)
     gradient_pattern = '*cortical_only.nii.gz' if map_coverage == 'cortical_only' else '*subcortical.nii.gz'
     gradient_paths = get_sorted_paths('data/gradients', gradient_pattern)
 
-    # first, try to read mask_name from data/masks
-    try: 
-        mask_paths = get_sorted_paths('data/masks', f'{mask_name}.nii.gz')
-        mask_path = mask_paths[0]
-    # otherwise, looks everywhere for path
-    except:
-        if os.path.exists(mask_name):
-            mask_path = f'{mask_name}'
-        else:
-            print ("Mask path not found. If using own mask, provide full path.")
+    # own mask built in memory (see CreateBinarizedMask.buildMask), no mask file
+    if isinstance(mask_name, PackedMask):
+        mask_path = None
+    else:
+        # first, try to read mask_name from data/masks
+        try: 
+            mask_paths = get_sorted_paths('data/masks', f'{mask_name}.nii.gz')
+            mask_path = mask_paths[0]
+        # otherwise, looks everywhere for path
+        except:
+            if os.path.exists(mask_name):
+                mask_path = f'{mask_name}'
+            else:
+                print ("Mask path not found. If using own mask, provide full path.")
 
     # as default, returns 14-task task battery baths (in future, would like to change)
     task_paths = get_sorted_paths('data/realTaskNiftis', '*nii.gz')
@@ -74,6 +85,142 @@ def usrpaths(inputfiles, verbose, mask_name, map_coverage):
     task_paths = inputfiles
     return  gradient_paths, mask_path, task_paths
 
+def inputitems(inputfiles, verbose, mask_name, map_coverage, gradient_set, legacy_mask=False):
+    """
+    Return input paths and the items to load them from (file paths, or (VoxelStore, entry) pairs).
+
+    Args:
+        inputfiles (list or VoxelStore): The input filepaths, or a VoxelStore built from them.
+        verbose (int): The verbosity level.
+        mask_name (str): The name of the mask.
+        map_coverage (str): The coverage of the map.
+        gradient_set (GradientSet): Gradients the inputs will be correlated with.
+        legacy_mask (bool, optional): Whether whole-volume (legacy) masking is requested. Defaults to False.
+
+    Returns:
+        tuple: A tuple containing the input paths and the items passed to loadmasked.
+    """
+    if isinstance(inputfiles, VoxelStore):
+        if legacy_mask:
+            raise ValueError('legacy_mask is not supported for VoxelStore inputs (only in-mask voxels are stored)')
+        inputfiles.checkmask(gradient_set)
+        return inputfiles.paths, [(inputfiles, entry) for entry in range(len(inputfiles))]
+    gradient_paths, mask_path, task_paths = usrpaths(inputfiles, verbose, mask_name, map_coverage)
+    return task_paths, task_paths
+
+def loadmasked(item, gradient_set, legacy_mask=False):
+    """
+    Load masked data of one input map or run.
+
+    Args:
+        item (str or tuple): Filepath, or (VoxelStore, entry) pair.
+        gradient_set (GradientSet): Preloaded gradients and mask.
+        legacy_mask (bool, optional): Return whole multiplied volume instead of in-mask voxels. Defaults to False.
+
+    Returns:
+        numpy array: In-mask vector (3-d map) or (n_TRs x n_voxels) matrix (4-d run),
+        or the whole masked array if legacy_mask is True.
+    """
+    # in-mask voxels read straight from the memory-mapped store
+    if isinstance(item, tuple):
+        store, entry = item
+        return store[entry]
+    img = nib.load(item)
+    if legacy_mask and len(img.shape) == 4:
+        # broadcast 3-d mask over TRs in place (no tiled 4-d mask)
+        data = resampletomask(img, gradient_set.maskimg).get_fdata()
+        data *= np.asanyarray(gradient_set.maskimg.dataobj)[..., np.newaxis]
+        return data
+    if legacy_mask:
+        # apply mask and turn to numpy array (whole volume)
+        return applymask(img, gradient_set.maskimg).get_fdata()
+    # keep in-mask voxels only
+    return gradient_set.extract(img)
+
+class ChunkStats:
+    """
+    Running mean and standard deviation (ddof=1) of every value in a sequence of chunks.
+
+    Chunks are merged with Chan et al.'s pairwise update in float64, so the
+    statistics of a whole 4-d image are computed from TR chunks without holding it.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def update(self, chunk):
+        n = chunk.size
+        if n == 0:
+            return
+        mean = chunk.mean(dtype=np.float64)
+        # one float64 temporary of the chunk, squared and summed by a dot product
+        deviation = (chunk - mean).ravel()
+        m2 = np.dot(deviation, deviation)
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self._m2 += m2 + delta ** 2 * self.count * n / total
+        self.count = total
+
+    @property
+    def std(self):
+        return np.sqrt(self._m2 / (self.count - 1))
+
+def iterchunks(item, gradient_set, chunk_size=100, legacy_mask=False, stats=None):
+    """
+    Yield masked TR chunks of one 4-d run, reading at most chunk_size TRs at a time.
+
+    Chunks are read through nibabel's array proxy (img.dataobj[..., start:stop]),
+    so memory is bounded by the chunk rather than the whole run. The file is kept
+    open between chunks so compressed runs are decompressed once, front to back.
+
+    Args:
+        item (str or tuple): Filepath of a 4-d run, or (VoxelStore, entry) pair.
+        gradient_set (GradientSet): Preloaded gradients and mask.
+        chunk_size (int, optional): Number of TRs read at once. Defaults to 100.
+        legacy_mask (bool, optional): Yield whole flattened multiplied volumes instead of in-mask voxels. Defaults to False.
+        stats (ChunkStats, optional): Updated with every chunk as read (whole volumes, before masking); file inputs only. Defaults to None.
+
+    Yields:
+        tuple: Index of the first TR in the chunk and the (n_chunk_TRs x n_voxels) float64 matrix.
+    """
+    # in-mask voxels read straight from the memory-mapped store
+    if isinstance(item, tuple):
+        if stats is not None:
+            raise ValueError('stats of the whole image are not available for VoxelStore inputs (only in-mask voxels are stored)')
+        store, entry = item
+        data = store[entry]
+        for start in range(0, data.shape[0], chunk_size):
+            yield start, np.asarray(data[start:start + chunk_size], dtype=np.float64)
+        return
+
+    img = nib.load(item, keep_file_open=True)
+    if len(img.shape) != 4:
+        raise ValueError(f'{item} is not a 4-d run (shape {img.shape})')
+    index = None if ongrid(img, gradient_set.maskimg) else getResampleIndex(img, gradient_set.maskimg)
+    if legacy_mask:
+        mask = np.asanyarray(gradient_set.maskimg.dataobj)[..., np.newaxis]
+
+    for start in range(0, img.shape[3], chunk_size):
+        # read chunk in its stored dtype (no float64 copy of the whole run)
+        chunk = np.asanyarray(img.dataobj[..., start:start + chunk_size])
+        if stats is not None:
+            # one volume at a time, so the float64 temporaries are the size of a volume
+            for tr in range(chunk.shape[3]):
+                stats.update(chunk[..., tr])
+        if legacy_mask:
+            if index is not None:
+                chunk = index.apply(chunk)
+            chunk = chunk * mask
+            chunk = chunk.reshape(-1, chunk.shape[3]).T
+        elif index is None:
+            chunk = gradient_set.maskdata(chunk)
+        else:
+            chunk = index.apply(chunk, gradient_set.mask_index).T
+        yield start, chunk.astype(np.float64)
+
 def applymask(img, maskimg):
     """
     Return masked image.
@@ -85,17 +232,120 @@ def applymask(img, maskimg):
     Returns:
         Masked img.
     """
+    from nilearn import image as nimg
+
     # try to apply without reshaping
     try:
         return nimg.math_img('a*b',a=img, b=maskimg) #element wise multiplication - return the resulting map
-    # if shapes don't match, reshape img
+    # if shapes don't match, reshape img (using cached resampling index)
     except ValueError: 
-        print('Shapes of images do not match')
-        print(f'mask-image shape: {maskimg.shape}, image shape {img.shape}')
-        print('Reshaping image to mask-image dimensions...')
-        img = nimg.resample_to_img(source_img=img,target_img=maskimg,interpolation='nearest')
+        img = resampletomask(img, maskimg)
         return nimg.math_img('a*b',a=img, b=maskimg) #element wise multiplication - return the resulting map
-    
+
+# voxel coordinates this close outside the source grid still count as inside (rounding of the affines)
+EDGE_TOLERANCE = 1e-6
+
+class ResampleIndex:
+    """
+    Nearest-neighbour voxel mapping from a source grid to a target (mask) grid.
+
+    The source voxel of every target voxel is computed once from the two
+    affines, so resampling an image (3-d map or 4-d run) is a single
+    fancy-index gather. Target voxels that fall outside the source grid (beyond
+    its outermost voxel centres, as in nilearn) are set to zero.
+
+    Args:
+        src_shape (tuple): Spatial (3-d) shape of the source grid.
+        src_affine (numpy array): 4x4 affine of the source grid.
+        tgt_shape (tuple): Spatial (3-d) shape of the target grid.
+        tgt_affine (numpy array): 4x4 affine of the target grid.
+    """
+
+    def __init__(self, src_shape, src_affine, tgt_shape, tgt_affine):
+        self.src_shape = tuple(src_shape)
+        self.tgt_shape = tuple(tgt_shape)
+
+        # target voxel -> world -> source voxel, rounded to the nearest source voxel
+        vox_to_vox = np.linalg.solve(src_affine, tgt_affine)
+        ijk = np.indices(self.tgt_shape).reshape(3, -1)
+        coords = vox_to_vox[:3, :3] @ ijk + vox_to_vox[:3, 3:]
+
+        # as nilearn (scipy.ndimage), only positions within the outermost source voxel centres are inside the grid
+        self.valid = np.all((coords > -EDGE_TOLERANCE) & (coords < np.array(self.src_shape)[:, np.newaxis] - 1 + EDGE_TOLERANCE), axis=0)
+        coords = np.floor(coords + 0.5)
+        coords[:, ~self.valid] = 0
+        self.coords = coords.astype(np.int32).reshape((3,) + self.tgt_shape)
+        self.valid = self.valid.reshape(self.tgt_shape)
+
+    def apply(self, array, mask_index=None):
+        """
+        Gather array from the source grid onto the target grid.
+
+        Args:
+            array (numpy array): 3-d or 4-d array on the source grid.
+            mask_index (numpy array, optional): Boolean target-grid mask; if given only these voxels are gathered.
+
+        Returns:
+            numpy array: Array on the target grid (3-d/4-d), or (n_voxels,) / (n_voxels x n_TRs) if mask_index is given.
+        """
+        if mask_index is None:
+            i, j, k = self.coords
+            valid = self.valid
+        else:
+            i, j, k = self.coords[:, mask_index]
+            valid = self.valid[mask_index]
+        out = np.asarray(array)[i, j, k]
+        out[~valid] = 0
+        return out
+
+# number of (source grid, target grid) resampling indices kept in memory
+RESAMPLE_CACHE_SIZE = 16
+
+@lru_cache(maxsize=RESAMPLE_CACHE_SIZE)
+def _cachedResampleIndex(src_shape, src_affine, tgt_shape, tgt_affine):
+    print(f'Image grid {src_shape} does not match mask grid {tgt_shape}, building nearest-neighbour resampling index')
+    return ResampleIndex(src_shape, np.frombuffer(src_affine).reshape(4, 4),
+                         tgt_shape, np.frombuffer(tgt_affine).reshape(4, 4))
+
+def getResampleIndex(img, maskimg):
+    """
+    Return the (cached) ResampleIndex from img's grid to the mask grid.
+
+    Args:
+        img (nibabel image object): 3-d or 4-d image on the source grid.
+        maskimg (nibabel image object): Mask image defining the target grid.
+
+    Returns:
+        ResampleIndex: Index mapping, built once per (source shape, source affine, mask grid).
+    """
+    return _cachedResampleIndex(tuple(img.shape[:3]), np.asarray(img.affine, dtype=np.float64).tobytes(),
+                                tuple(maskimg.shape[:3]), np.asarray(maskimg.affine, dtype=np.float64).tobytes())
+
+def ongrid(img, maskimg):
+    """
+    Return True if img is on the same voxel grid as the mask.
+    """
+    return img.shape[:3] == maskimg.shape[:3] and np.allclose(img.affine, maskimg.affine)
+
+def resampletomask(img, maskimg):
+    """
+    Return img resampled to the mask grid (unchanged if grids already match).
+
+    Uses nearest-neighbour interpolation through a cached ResampleIndex, so
+    images sharing a grid (e.g. a whole cohort in native space) reuse one index.
+
+    Args:
+        img (nibabel image object): 3-d or 4-d image.
+        maskimg (nibabel image object): Mask image defining the target grid.
+
+    Returns:
+        nibabel image object: Image on the mask grid.
+    """
+    if ongrid(img, maskimg):
+        return img
+    data = getResampleIndex(img, maskimg).apply(np.asanyarray(img.dataobj))
+    return nib.Nifti1Image(data, maskimg.affine)
+
 def gradname(gradient_path, verbose):
     grad_name = os.path.basename(os.path.normpath(gradient_path))
     grad_name = grad_name.split(".")[0]
@@ -103,6 +353,452 @@ def gradname(gradient_path, verbose):
         print (grad_name)
     return grad_name
 
+class GradientSet:
+    """
+    Gradient maps and mask loaded once and held in mask space.
+
+    The in-mask voxels of every gradient are stored as a single
+    (n_gradients x n_voxels) matrix so that the correlate functions do not
+    have to re-load and re-mask each gradient nifti for every input map.
+
+    Args:
+        mask_name (str or PackedMask): The name of the mask (or full path to own mask, or a PackedMask from buildMask).
+        map_coverage (str): The coverage of the map.
+        dtype (numpy dtype, optional): dtype of the gradient matrix. Defaults to float32.
+        verbose (int, optional): The verbosity level. Defaults to 0.
+
+    Attributes:
+        names (list): Gradient names (in the order of the matrix rows).
+        matrix (numpy array): (n_gradients x n_voxels) in-mask gradient values.
+        mask_index (numpy array): Boolean 3-d array marking in-mask voxels.
+        maskimg (nibabel image object): The loaded mask image.
+    """
+
+    def __init__(self, mask_name, map_coverage, dtype=np.float32, verbose=0):
+        self.mask_name = mask_name
+        self.map_coverage = map_coverage
+        self.dtype = np.dtype(dtype)
+
+        # get gradient and mask paths
+        gradient_paths, mask_path, task_paths = getdata(mask_name, map_coverage)
+
+        # load mask once and store boolean index of in-mask voxels
+        self.maskimg = mask_name.toimg() if isinstance(mask_name, PackedMask) else nib.load(mask_path)
+        self.mask_index = np.asanyarray(self.maskimg.dataobj) != 0
+
+        # load each gradient once, apply mask and keep in-mask voxels only
+        self.names = []
+        self.matrix = np.empty((len(gradient_paths), self.n_voxels), dtype=self.dtype)
+        for row, gradient in enumerate(gradient_paths):
+            self.names.append(gradname(gradient, verbose))
+            gradientimg_m = applymask(nib.load(gradient), self.maskimg)
+            self.matrix[row] = gradientimg_m.get_fdata()[self.mask_index]
+
+        # gradient matrix is shared between calls, so make it read-only
+        self.matrix.setflags(write=False)
+
+        # gradient matrices prepared for each correlation method (see prepared)
+        self._prepared = {}
+
+    @classmethod
+    def fromarrays(cls, mask_name, map_coverage, names, matrix, mask_index, maskimg):
+        """
+        Build GradientSet from already loaded arrays (e.g. a shared-memory matrix in a worker process).
+
+        Args:
+            mask_name (str): The name of the mask.
+            map_coverage (str): The coverage of the map.
+            names (list): Gradient names.
+            matrix (numpy array): (n_gradients x n_voxels) in-mask gradient values.
+            mask_index (numpy array): Boolean 3-d array marking in-mask voxels.
+            maskimg (nibabel image object): The mask image.
+
+        Returns:
+            GradientSet: Gradient set wrapping the given arrays (no copy is made).
+        """
+        gradient_set = cls.__new__(cls)
+        gradient_set.mask_name = mask_name
+        gradient_set.map_coverage = map_coverage
+        gradient_set.dtype = matrix.dtype
+        gradient_set.names = list(names)
+        gradient_set.matrix = matrix
+        gradient_set.mask_index = mask_index
+        gradient_set.maskimg = maskimg
+        gradient_set._prepared = {}
+        return gradient_set
+
+    @property
+    def n_voxels(self):
+        return int(self.mask_index.sum())
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    def maskdata(self, array):
+        """
+        Select in-mask voxels from a 3-d or 4-d array on the mask grid.
+
+        Args:
+            array (numpy array): 3-d map or 4-d timecourse with the shape of the mask.
+
+        Returns:
+            numpy array: 1-d vector of in-mask voxels (3-d input) or (n_TRs x n_voxels) matrix (4-d input).
+        """
+        if array.shape[:3] != self.mask_index.shape:
+            raise ValueError(f'Array shape {array.shape} does not match mask shape {self.mask_index.shape}')
+        return array[self.mask_index].T
+
+    def extract(self, img):
+        """
+        Return in-mask voxels of a nibabel image, resampling it to the mask grid if needed.
+
+        Args:
+            img (nibabel image object): 3-d map or 4-d timecourse.
+
+        Returns:
+            numpy array: 1-d vector of in-mask voxels (3-d image) or (n_TRs x n_voxels) matrix (4-d image).
+        """
+        # read data in its stored dtype and only convert the gathered in-mask voxels to float64,
+        # so peak memory is about the input itself (no float64 copy of the whole image)
+        data = np.asanyarray(img.dataobj)
+        if ongrid(img, self.maskimg):
+            data = self.maskdata(data)
+        else:
+            # gather in-mask voxels straight from the source grid (cached resampling index)
+            data = getResampleIndex(img, self.maskimg).apply(data, self.mask_index).T
+        return data.astype(np.float64)
+
+    def toimg(self, vector):
+        """
+        Return in-mask vector as a nifti image on the mask grid (zeros outside of mask).
+
+        Args:
+            vector (numpy array): 1-d vector of in-mask voxels.
+
+        Returns:
+            nibabel image object: Masked image.
+        """
+        volume = np.zeros(self.mask_index.shape, dtype=vector.dtype)
+        volume[self.mask_index] = vector
+        return nib.Nifti1Image(volume, self.maskimg.affine)
+
+    def fullmatrix(self):
+        """
+        Return masked gradients as whole flattened volumes (legacy_mask mode).
+
+        Returns:
+            numpy array: (n_gradients x n_mask_grid_voxels) array, zeros outside of mask.
+        """
+        return np.stack([self.unmask(row).ravel() for row in range(len(self.names))])
+
+    def prepared(self, corr_method='spearman', legacy_mask=False):
+        """
+        Return gradient matrix prepared for corr_method (ranked and/or standardized), computed once per method.
+
+        Args:
+            corr_method (str, optional): The correlation method. Defaults to 'spearman'.
+            legacy_mask (bool, optional): Prepare whole flattened volumes instead of in-mask voxels. Defaults to False.
+
+        Returns:
+            numpy array: Output of prepareMatrix for the gradients.
+        """
+        key = (corr_method, legacy_mask)
+        if key not in self._prepared:
+            self._prepared[key] = prepareMatrix(self.fullmatrix() if legacy_mask else self.matrix, corr_method)
+        return self._prepared[key]
+
+    def corr(self, input_matrix, corr_method='spearman', legacy_mask=False, chunk_size=100):
+        """
+        Correlate each row of input_matrix with every gradient.
+
+        Args:
+            input_matrix (numpy array): (n_maps x n_voxels) array (or a single 1-d map).
+            corr_method (str, optional): The correlation method. Defaults to 'spearman'.
+            legacy_mask (bool, optional): Inputs are whole flattened volumes. Defaults to False.
+            chunk_size (int, optional): Number of input rows prepared at once. Defaults to 100.
+
+        Returns:
+            numpy array: (n_maps x n_gradients) correlation values.
+        """
+        return corrPrepared(input_matrix, self.prepared(corr_method, legacy_mask), corr_method, chunk_size)
+
+    def unmask(self, row):
+        """
+        Return gradient as a masked 3-d array (zeros outside of mask).
+
+        Args:
+            row (int): Index of gradient in names / matrix.
+
+        Returns:
+            numpy array: Masked gradient array with the shape of the mask image.
+        """
+        volume = np.zeros(self.mask_index.shape, dtype=self.dtype)
+        volume[self.mask_index] = self.matrix[row]
+        return volume
+
+# number of (mask, map_coverage, dtype) combinations kept in memory
+GRADIENTSET_CACHE_SIZE = 8
+
+@lru_cache(maxsize=GRADIENTSET_CACHE_SIZE)
+def _cachedGradientSet(mask_name, map_coverage, dtype, stamp):
+    # stamp (file sizes and modification times) only keys the cache, so rewritten masks / gradients are reloaded
+    return GradientSet(mask_name, map_coverage, dtype)
+
+def filestamp(paths):
+    """
+    Return (path, modification time, size) of each file, to detect files rewritten in place.
+    """
+    stamps = []
+    for path in paths:
+        stat = os.stat(path)
+        stamps.append((os.path.abspath(path), stat.st_mtime_ns, stat.st_size))
+    return tuple(stamps)
+
+def getGradientSet(mask_name, map_coverage, dtype=np.float32):
+    """
+    Return GradientSet for mask_name and map_coverage from a bounded LRU cache.
+
+    The cache is keyed on the mask and gradient files as well as their names,
+    so a mask regenerated at the same path (e.g. by binMask) is loaded again.
+
+    Args:
+        mask_name (str): The name of the mask.
+        map_coverage (str): The coverage of the map.
+        dtype (numpy dtype, optional): dtype of the gradient matrix. Defaults to float32.
+
+    Returns:
+        GradientSet: Loaded (and cached) gradient set.
+    """
+    gradient_paths, mask_path, task_paths = getdata(mask_name, map_coverage)
+    stamp = filestamp(gradient_paths + ([] if mask_path is None else [mask_path]))
+    return _cachedGradientSet(mask_name, map_coverage, np.dtype(dtype), stamp)
+
+class ParcelGradientSet(GradientSet):
+    """
+    Gradient set that correlates at parcel (ROI) resolution.
+
+    Inputs and gradients are averaged within the parcels of a parcellation by
+    one sparse (n_parcels x n_voxels) label-reduction matrix, and correlations
+    are computed on the (maps x parcels) and (gradients x parcels) averages,
+    which is orders of magnitude cheaper than correlating every voxel. The
+    voxel-level matrix and mask are kept, so inputs are loaded exactly as for a
+    GradientSet; pass it as gradient_set (or pass parcellation=...) to the
+    correlate functions. Not supported with legacy_mask.
+
+    Build with parcelGradientSet().
+
+    Attributes:
+        labels (numpy array): Parcel label of every in-mask voxel (0 = no parcel).
+        parcels (numpy array): Labels of the parcels used (those with in-mask voxels), in reducer row order.
+        reducer (scipy sparse matrix): (n_parcels x n_voxels) averaging matrix.
+    """
+
+    def _setparcels(self, labels):
+        from scipy import sparse
+
+        self.labels = np.asarray(labels, dtype=np.int32)
+        if self.labels.shape != (self.n_voxels,):
+            raise ValueError(f'Expected one parcel label per in-mask voxel ({self.n_voxels}), got shape {self.labels.shape}')
+
+        # parcels with in-mask voxels, one reducer row each (row i averages the voxels of parcels[i])
+        inparcel = np.flatnonzero(self.labels > 0)
+        self.parcels, rows, counts = np.unique(self.labels[inparcel], return_inverse=True, return_counts=True)
+        self.reducer = sparse.csr_matrix((1.0 / counts[rows], (rows, inparcel)),
+                                         shape=(len(self.parcels), self.n_voxels))
+        self._prepared = {}
+
+    @property
+    def n_parcels(self):
+        return len(self.parcels)
+
+    def reduce(self, input_matrix):
+        """
+        Average the in-mask voxels of each row within every parcel.
+
+        Args:
+            input_matrix (numpy array): (n_maps x n_voxels) array (or a single 1-d map).
+
+        Returns:
+            numpy array: (n_maps x n_parcels) float64 parcel averages.
+        """
+        input_matrix = np.atleast_2d(input_matrix)
+        if input_matrix.shape[1] != self.n_voxels:
+            raise ValueError(f'Number of voxels does not match: input {input_matrix.shape[1]}, mask {self.n_voxels}')
+        return np.asarray(self.reducer @ input_matrix.T.astype(np.float64)).T
+
+    def prepared(self, corr_method='spearman', legacy_mask=False):
+        """
+        Return parcel-averaged gradients prepared for corr_method, computed once per method.
+        """
+        if legacy_mask:
+            raise ValueError('legacy_mask is not supported at parcel resolution')
+        if corr_method not in self._prepared:
+            self._prepared[corr_method] = prepareMatrix(self.reduce(self.matrix), corr_method)
+        return self._prepared[corr_method]
+
+    def corr(self, input_matrix, corr_method='spearman', legacy_mask=False, chunk_size=100):
+        """
+        Average each row of input_matrix within the parcels and correlate it with every (parcel-averaged) gradient.
+
+        Args:
+            input_matrix (numpy array): (n_maps x n_voxels) in-mask array (or a single 1-d map).
+            corr_method (str, optional): The correlation method. Defaults to 'spearman'.
+            legacy_mask (bool, optional): Not supported (raises ValueError). Defaults to False.
+            chunk_size (int, optional): Number of input rows prepared at once. Defaults to 100.
+
+        Returns:
+            numpy array: (n_maps x n_gradients) correlation values.
+        """
+        gradient_prepared = self.prepared(corr_method, legacy_mask)
+        return corrPrepared(self.reduce(input_matrix), gradient_prepared, corr_method, chunk_size)
+
+def parcelGradientSet(gradient_set, parcellation):
+    """
+    Return gradient_set at the parcel resolution of a parcellation.
+
+    Args:
+        gradient_set (GradientSet): Voxel-level gradients and mask.
+        parcellation (nibabel image object, Atlas or numpy array): Parcellation (e.g. from Lesion.makemaps),
+            resampled to the mask grid (nearest neighbour) if needed, or a parcel label per in-mask voxel.
+
+    Returns:
+        ParcelGradientSet: Gradient set sharing gradient_set's matrix and mask.
+    """
+    if isinstance(parcellation, ParcelGradientSet):
+        parcellation = parcellation.labels
+    if isinstance(parcellation, np.ndarray) and parcellation.ndim == 1:
+        labels = parcellation
+    else:
+        from StateSpace.Lesion import parcellabels
+        labels = parcellabels(parcellation, gradient_set)
+    parcel_set = ParcelGradientSet.fromarrays(gradient_set.mask_name, gradient_set.map_coverage, gradient_set.names,
+                                              gradient_set.matrix, gradient_set.mask_index, gradient_set.maskimg)
+    parcel_set._setparcels(labels)
+    return parcel_set
+
+def _resolveGradientSet(mask_name, map_coverage, gradient_set=None, parcellation=None, legacy_mask=False):
+    """
+    Return the gradient set a correlate function works with: gradient_set, or the cached one of mask_name and
+    map_coverage, at parcel resolution if a parcellation is given.
+
+    Args:
+        mask_name (str or PackedMask): The name of the mask.
+        map_coverage (str): The coverage of the map.
+        gradient_set (GradientSet, optional): Preloaded gradients. Defaults to None (loaded from cache).
+        parcellation (nibabel image object or Atlas, optional): Parcellation to average within. Defaults to None (voxels).
+        legacy_mask (bool, optional): Whole-volume mode of the caller, not supported at parcel resolution. Defaults to False.
+
+    Returns:
+        GradientSet or ParcelGradientSet: The gradient set.
+    """
+    # load gradients and mask once (or reuse cached gradient set)
+    if gradient_set is None:
+        gradient_set = getGradientSet(mask_name, map_coverage)
+    # average inputs and gradients within parcels
+    if parcellation is not None:
+        gradient_set = parcelGradientSet(gradient_set, parcellation)
+    # fail before any input is read
+    if legacy_mask and isinstance(gradient_set, ParcelGradientSet):
+        raise ValueError('legacy_mask is not supported at parcel resolution')
+    return gradient_set
+
+def parcelsuffix(gradient_set):
+    """
+    Return the output file name suffix of a gradient set's resolution ('' for voxels).
+    """
+    return f'_parcels{gradient_set.n_parcels}' if isinstance(gradient_set, ParcelGradientSet) else ''
+
+# gradient set (and VoxelStore) of the current worker process (set by _initWorker)
+_worker_gradient_set = None
+_worker_shm = None
+_worker_store = None
+
+def _initWorker(mask_name, map_coverage, names, shm_name, shape, dtype, mask_index, maskimg, labels=None, store=None):
+    """
+    Attach worker process to the gradient matrix held in shared memory (used by parallelmap).
+    """
+    global _worker_gradient_set, _worker_shm, _worker_store
+    _worker_store = store
+    _worker_shm = SharedMemory(name=shm_name)
+    matrix = np.ndarray(shape, dtype=dtype, buffer=_worker_shm.buf)
+    matrix.setflags(write=False)
+    _worker_gradient_set = GradientSet.fromarrays(mask_name, map_coverage, names, matrix, mask_index, maskimg)
+    if labels is not None:
+        _worker_gradient_set = parcelGradientSet(_worker_gradient_set, labels)
+
+def _callWorker(func, item, **kwargs):
+    # VoxelStore entries are sent as integers, the store itself is opened once per worker
+    if _worker_store is not None:
+        item = (_worker_store, item)
+    return func(item, _worker_gradient_set, **kwargs)
+
+def _storeentries(items):
+    # (store, entries) if all items are entries of one VoxelStore, else (None, items)
+    if items and all(isinstance(item, tuple) for item in items):
+        stores = {id(store) for store, entry in items}
+        if len(stores) == 1:
+            return items[0][0], [entry for store, entry in items]
+    return None, items
+
+def iterparallelmap(func, items, gradient_set, n_jobs, **kwargs):
+    """
+    Apply func(item, gradient_set, **kwargs) to each item using a process pool, yielding results as they are ready.
+
+    The gradient matrix is copied once into shared memory and every worker
+    reads that single read-only copy, so it is not pickled per item.
+    Results are yielded in the order of items, each as soon as it (and every
+    item before it) is done, so callers can write them out while the rest run.
+
+    Args:
+        func (function): Module-level function taking (item, gradient_set, **kwargs).
+        items (list): Items to process (e.g. file paths).
+        gradient_set (GradientSet): Gradients shared with the workers.
+        n_jobs (int): Number of worker processes (-1 uses all cores).
+
+    Yields:
+        func output for each item.
+    """
+    if n_jobs is None or n_jobs < 0:
+        n_jobs = os.cpu_count()
+    # nothing to gain from a pool for a single worker
+    if n_jobs == 1 or len(items) < 2:
+        for item in items:
+            yield func(item, gradient_set, **kwargs)
+        return
+
+    # entries of one VoxelStore are sent as integers (the store goes to the initializer)
+    store, items = _storeentries(items)
+
+    matrix = gradient_set.matrix
+    shm = SharedMemory(create=True, size=max(matrix.nbytes, 1))
+    try:
+        shared = np.ndarray(matrix.shape, dtype=matrix.dtype, buffer=shm.buf)
+        shared[:] = matrix
+        # release the view now, so shm can be closed even if the caller stops early
+        del shared
+        initargs = (gradient_set.mask_name, gradient_set.map_coverage, gradient_set.names,
+                    shm.name, matrix.shape, matrix.dtype, gradient_set.mask_index, gradient_set.maskimg,
+                    getattr(gradient_set, 'labels', None), store)
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(items)), initializer=_initWorker, initargs=initargs) as executor:
+            # map keeps results in the order of items
+            yield from executor.map(partial(_callWorker, func, **kwargs), items)
+    finally:
+        shm.close()
+        shm.unlink()
+
+def parallelmap(func, items, gradient_set, n_jobs, **kwargs):
+    """
+    Apply func(item, gradient_set, **kwargs) to each item using a process pool (see iterparallelmap).
+
+    Returns:
+        list: func output for each item, in the order of items.
+    """
+    return list(iterparallelmap(func, items, gradient_set, n_jobs, **kwargs))
+
+# correlation methods understood by corrGrads / corrMatrix
+CORR_METHODS = ('spearman', 'pearson', 'kendall')
+
 def corrGrads(gradient_array, input_array, corr_method='spearman', verbose=1):
     """
     Correlate input array with gradient array.
@@ -110,12 +806,14 @@ def corrGrads(gradient_array, input_array, corr_method='spearman', verbose=1):
     Args:
         gradient_array (numpy array): Gradient array.
         input_array (numpy array): Input array to correlate with gradient array.
-        corr_method (str, optional): String indicating which correlation method. Defaults to spearman.
+        corr_method (str, optional): String indicating which correlation method ('spearman', 'pearson' or 'kendall'). Defaults to spearman.
         verbose (int, optional): The verbosity level. Defaults to 1.
 
     Returns:
         corr (float): Correlation value.
     """
+    from scipy.stats import spearmanr, pearsonr, kendalltau
+
     if corr_method == 'spearman':
         corr = spearmanr(gradient_array.flatten(), input_array.flatten())[0]
         if verbose > 0:
@@ -127,10 +825,136 @@ def corrGrads(gradient_array, input_array, corr_method='spearman', verbose=1):
         corr = np.arctanh(corr)
         if verbose > 0:
             print (f"Pearson (Fisher r-to-z) correlation:",corr)
+
+    elif corr_method == 'kendall':
+        corr = kendalltau(gradient_array.flatten(), input_array.flatten())[0]
+        if verbose > 0:
+            print (f"Kendall tau-b correlation:",corr)
+
+    else:
+        raise ValueError(f"corr_method must be one of {CORR_METHODS}, not {corr_method!r}")
+    return corr
+
+def standardize(matrix):
+    """
+    Centre each row and scale it to unit length (used by corrMatrix).
+
+    Args:
+        matrix (numpy array): 2-d array, one observation vector per row.
+
+    Returns:
+        numpy array: float64 array where the dot product of two rows is their Pearson correlation.
+    """
+    matrix = np.array(matrix, dtype=np.float64)
+    matrix -= matrix.mean(axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        matrix /= np.sqrt(np.einsum('ij,ij->i', matrix, matrix))[:, np.newaxis]
+    return matrix
+
+def prepareMatrix(matrix, corr_method='spearman'):
+    """
+    Prepare rows of a matrix for corrPrepared: rank (spearman) and standardize.
+
+    Args:
+        matrix (numpy array): 2-d array, one map per row.
+        corr_method (str, optional): String indicating which correlation method. Defaults to spearman.
+
+    Returns:
+        numpy array: Prepared float64 array (kendall rows are returned unchanged).
+    """
+    if corr_method not in CORR_METHODS:
+        raise ValueError(f"corr_method must be one of {CORR_METHODS}, not {corr_method!r}")
+    matrix = np.atleast_2d(matrix)
+    if corr_method == 'kendall':
+        return matrix
+    if corr_method == 'spearman':
+        from scipy.stats import rankdata
+        matrix = rankdata(matrix, axis=1)
+    return standardize(matrix)
+
+def corrPrepared(input_matrix, gradient_prepared, corr_method='spearman', chunk_size=100):
+    """
+    Correlate input rows with gradients already prepared by prepareMatrix.
+
+    Args:
+        input_matrix (numpy array): (n_maps x n_voxels) array, e.g. one TR per row.
+        gradient_prepared (numpy array): (n_gradients x n_voxels) output of prepareMatrix.
+        corr_method (str, optional): String indicating which correlation method. Defaults to spearman.
+        chunk_size (int, optional): Number of input rows prepared at once (caps memory). Defaults to 100.
+
+    Returns:
+        numpy array: (n_maps x n_gradients) correlation values (Fisher z for pearson).
+    """
+    input_matrix = np.atleast_2d(input_matrix)
+    if input_matrix.shape[1] != gradient_prepared.shape[1]:
+        raise ValueError(f'Number of voxels does not match: input {input_matrix.shape[1]}, gradients {gradient_prepared.shape[1]}')
+
+    corr = np.empty((input_matrix.shape[0], gradient_prepared.shape[0]))
+    # process input rows in chunks so only chunk_size prepared rows are held at once
+    for start in range(0, input_matrix.shape[0], chunk_size):
+        chunk = input_matrix[start:start + chunk_size]
+        if corr_method == 'kendall':
+            # no matrix form for tau-b, use scipy's O(n log n) implementation per pair
+            from scipy.stats import kendalltau
+            corr[start:start + chunk_size] = [[kendalltau(gradient, row)[0] for gradient in gradient_prepared] for row in chunk]
+        else:
+            corr[start:start + chunk_size] = prepareMatrix(chunk, corr_method) @ gradient_prepared.T
+
+    if corr_method != 'kendall':
+        # keep within [-1, 1] after rounding error
+        np.clip(corr, -1, 1, out=corr)
+
+    if corr_method == 'pearson':
+        # apply fishers-r-to-z transformation to correlation values
+        corr = np.arctanh(corr)
     return corr
 
+def corrMatrix(input_matrix, gradient_matrix, corr_method='spearman', chunk_size=100):
+    """
+    Correlate many input maps with all gradients in one call.
+
+    Spearman ranks each row along the voxel axis once (ties get average ranks,
+    as in scipy.stats.spearmanr). For spearman and pearson, rows are then
+    standardized so that a single matrix product gives every correlation;
+    pearson values are Fisher r-to-z transformed. Kendall tau-b is computed
+    pair by pair. Matches corrGrads to floating-point tolerance.
+
+    Args:
+        input_matrix (numpy array): (n_maps x n_voxels) array, e.g. one TR per row.
+        gradient_matrix (numpy array): (n_gradients x n_voxels) array.
+        corr_method (str, optional): 'spearman', 'pearson' or 'kendall'. Defaults to spearman.
+        chunk_size (int, optional): Number of input rows ranked at once (caps memory). Defaults to 100.
+
+    Returns:
+        numpy array: (n_maps x n_gradients) correlation values.
+    """
+    return corrPrepared(input_matrix, prepareMatrix(gradient_matrix, corr_method), corr_method, chunk_size)
+
+def cachekeys(cache, task_paths, items, gradient_set, corr_method, legacy_mask=False):
+    """
+    Return result cache keys of input maps (None for inputs that are not cached).
+
+    Args:
+        cache (ResultCache or None): The result cache.
+        task_paths (list): The input paths.
+        items (list): The items the inputs are loaded from (VoxelStore entries are not cached).
+        gradient_set (GradientSet): Gradients the inputs are correlated with.
+        corr_method (str): The correlation method.
+        legacy_mask (bool, optional): Whether whole-volume masking is used. Defaults to False.
+
+    Returns:
+        tuple: One cache key per input and the analysis context stored with new entries.
+    """
+    if cache is None:
+        return [None] * len(task_paths), None
+    context = cache.context(gradient_set, corr_method, legacy_mask)
+    keys = [None if isinstance(item, tuple) else cache.key(task, context) for task, item in zip(task_paths, items)]
+    return keys, context
+
 def corrGroup(mask_name, map_coverage, outputdir=None, inputfiles=None,
-              corr_method='spearman', saveMaskedimgs = False,verbose=1):
+              corr_method='spearman', saveMaskedimgs = False,verbose=1,
+              gradient_set=None, legacy_mask=False, cache=None, parcellation=None,
+              n_perm=None, null_model='permute', seed=None, n_jobs=1):
     """
     Calculate the correlation between task maps and gradients.
 
@@ -138,47 +962,70 @@ def corrGroup(mask_name, map_coverage, outputdir=None, inputfiles=None,
         mask_name (str): The name of the mask.
         map_coverage (str): The coverage of the map.
         outputdir (str, optional): The output directory. Defaults to None.
-        inputfiles (list, optional): The input task maps. Defaults to None.
-        corr_method (str, optional): The correlation method. Defaults to 'spearman'.
+        inputfiles (list or VoxelStore, optional): The input task maps. Defaults to None.
+        corr_method (str, optional): The correlation method ('spearman', 'pearson' or 'kendall'). Defaults to 'spearman'.
         saveMaskedimgs (bool, optional): Whether to save masked task images. Defaults to False.
         verbose (int, optional): The verbosity level. Defaults to 1.
+        gradient_set (GradientSet, optional): Preloaded gradients. Defaults to None (loaded from cache).
+        legacy_mask (bool, optional): Correlate whole multiplied volumes (out-of-mask voxels as zeros) instead of in-mask voxels only. Defaults to False.
+        cache (str or ResultCache, optional): Result cache directory; maps already correlated with the same settings are read from it. Defaults to None (no cache).
+        parcellation (nibabel image object or Atlas, optional): Correlate at parcel resolution: inputs and gradients are averaged within the parcels first (see ParcelGradientSet). Defaults to None (voxels).
+        n_perm (int, optional): If given, also return two-sided p-values from this many surrogate maps (see NullModels.nullPvalues). Defaults to None.
+        null_model (str, optional): Surrogates for n_perm, 'permute' (voxels, or parcels with a parcellation) or 'block' (blocks of voxels). Defaults to 'permute'.
+        seed (int, optional): Seed of the surrogates. Defaults to None.
+        n_jobs (int, optional): Number of threads computing surrogates (-1 uses all cores). Defaults to 1.
 
     Returns:
-        pandas.DataFrame: The correlation values between task maps and gradients.
+        pandas.DataFrame: The correlation values between task maps and gradients
+        (and a DataFrame of p-values in the same layout if n_perm is given).
     """
+    import pandas as pd
+
+    if n_perm is not None and legacy_mask:
+        raise ValueError('n_perm is not supported with legacy_mask')
+
+    gradient_set = _resolveGradientSet(mask_name, map_coverage, gradient_set, parcellation, legacy_mask)
+    maskimg = gradient_set.maskimg
+    cache = opencache(cache)
+
     # get all the relevent data by calling getdata() function
     # if inputfiles not provided, will use 14 task battery maps in data/realTaskNiftis
     if inputfiles is None:
         gradient_paths, mask_path, task_paths = getdata(mask_name, map_coverage) 
-    # if inputfiles provided, will use those
-    elif inputfiles:
-        gradient_paths, mask_path, task_paths = usrpaths(inputfiles, verbose, mask_name, map_coverage)
+        items = task_paths
+    # if inputfiles (or a VoxelStore) provided, will use those
+    else:
+        task_paths, items = inputitems(inputfiles, verbose, mask_name, map_coverage, gradient_set, legacy_mask)
 
     # create empty dictionary to store correlation values in
     corr_dictionary = {}
 
-    # load maskimg once before loops
-    maskimg=nib.load(mask_path)
+    # in-mask maps kept for the null model
+    null_inputs = []
+
+    # cache keys only for file inputs (VoxelStore entries are not checked against their source files)
+    cache_keys, cache_context = cachekeys(cache, task_paths, items, gradient_set, corr_method, legacy_mask)
 
     # loop over each task_path in task_paths
-    for task in task_paths:
+    for task, item, cache_key in zip(task_paths, items, cache_keys):
 
         # extract task name from file path
         task_name = os.path.basename(os.path.normpath(task))
         task_name = task_name.split(".")[0]
 
-        # load taskimg
-        taskimg=nib.load(task)
+        corrs = cache.get(cache_key) if cache_key is not None else None
+        save_masked = saveMaskedimgs == True and outputdir != None
 
-        # apply mask to taskimg
-        multmap = applymask(taskimg, maskimg)
+        if corrs is None or save_masked or n_perm is not None:
+            # load masked task map (whole volume if legacy_mask, otherwise 1-d vector of in-mask voxels)
+            task_array_masked = loadmasked(item, gradient_set, legacy_mask)
 
-        # turn maskim to numpy array
-        task_array_masked = multmap.get_fdata()
+        if n_perm is not None:
+            null_inputs.append(task_array_masked)
 
         # if you want to save masked task images in outputdir, set to true
-        if saveMaskedimgs == True and outputdir != None:
-            nib.save(multmap, 
+        if save_masked:
+            nib.save(nib.Nifti1Image(task_array_masked, maskimg.affine) if legacy_mask else gradient_set.toimg(task_array_masked), 
             os.path.join(outputdir,f'{task_name}_masked.nii.gz'))
 
         # create 1st level dictionary key (task name)
@@ -187,23 +1034,16 @@ def corrGroup(mask_name, map_coverage, outputdir=None, inputfiles=None,
             print (task_name)
             print('\n')
 
-        # Iterate through each of Neurovault's gradients
-        for gradient in gradient_paths:
-
-            # extract grad name from file path
-            grad_name = gradname(gradient, verbose)
-
-            # load gradient image and apply mask
-            gradient_img=nib.load(gradient)
-            gradientimg_m = applymask(gradient_img, maskimg) 
+        if corrs is None:
+            # correlate task map with all of Neurovault's gradients at once
+            corrs = gradient_set.corr(task_array_masked.ravel(), corr_method, legacy_mask)[0]
+            if cache_key is not None:
+                cache.put(cache_key, corrs, path=task, **cache_context)
 
-            # Get the masked gradient image data as a numpy array
-            gradient_array_masked = gradientimg_m.get_fdata()
-
-            # call corrGrads to return corr
-            corr = corrGrads(gradient_array_masked,task_array_masked)
-
-            # add corr value to dict
+        # add corr values to dict
+        for grad_name, corr in zip(gradient_set.names, corrs):
+            if verbose > 0:
+                print (grad_name, f"{corr_method} correlation:", corr)
             corr_dictionary[task_name][grad_name] = corr 
 
     # store results in transposed dataframe
@@ -212,9 +1052,20 @@ def corrGroup(mask_name, map_coverage, outputdir=None, inputfiles=None,
 
     # save dataframe to csv if outputdir provided
     if outputdir != None:
-        df.to_csv(os.path.join(outputdir,f'gradscores_{corr_method}_{mask_name}.csv'))
+        df.to_csv(os.path.join(outputdir,f'gradscores_{corr_method}_{mask_name}{parcelsuffix(gradient_set)}.csv'))
 
-    return df
+    if n_perm is None:
+        return df
+
+    # permutation p-values of all maps at once, in the layout of df
+    from StateSpace.NullModels import nullPvalues
+    pvalues = nullPvalues(np.stack(null_inputs), gradient_set, n_perm, corr_method, null_model, seed=seed, n_jobs=n_jobs)
+    task_names = [os.path.basename(os.path.normpath(task)).split(".")[0] for task in task_paths]
+    df_p = pd.DataFrame({task_name: dict(zip(gradient_set.names, row)) for task_name, row in zip(task_names, pvalues)}).T
+    df_p.index.name = 'Task_name'
+    if outputdir != None:
+        df_p.to_csv(os.path.join(outputdir,f'gradscores_{corr_method}_{mask_name}{parcelsuffix(gradient_set)}_pvalues.csv'))
+    return df, df_p
 
 def extractid(pth, string):
     """
@@ -241,141 +1092,157 @@ def extractid(pth, string):
 
     return id[0]
 
+def _corrIndMap(task, gradient_set, corr_method='spearman', legacy_mask=False, verbose=1):
+    """
+    Correlate one individual-level map with all gradients (used by corrInd).
+
+    Args:
+        task (str or tuple): Filepath of the map, or (VoxelStore, entry) pair.
+        gradient_set (GradientSet): Preloaded gradients.
+        corr_method (str, optional): The correlation method. Defaults to 'spearman'.
+        legacy_mask (bool, optional): Correlate whole multiplied volumes. Defaults to False.
+        verbose (int, optional): The verbosity level. Defaults to 1.
+
+    Returns:
+        list: Correlation value for each gradient (in the order of gradient_set.names).
+    """
+    # load masked task map (whole volume if legacy_mask, otherwise 1-d vector of in-mask voxels)
+    task_array_masked = loadmasked(task, gradient_set, legacy_mask)
+
+    if verbose > 0:
+        print (task)
+        print('\n')
+
+    # correlate masked task map with all of Neurovault's gradients at once
+    corrs = gradient_set.corr(task_array_masked.ravel(), corr_method, legacy_mask)[0]
+
+    if verbose > 0:
+        for grad_name, corr in zip(gradient_set.names, corrs):
+            print (grad_name, f"{corr_method} correlation:", corr)
+    return list(corrs)
+
+# number of maps loaded at once for the null model in corrInd
+NULL_MAP_CHUNK = 100
+
 def corrInd(mask_name, map_coverage, inputfiles,
             taskstring, substring, runstring = None,
             outputdir = None,
-            corr_method='spearman', verbose=1):
+            corr_method='spearman', verbose=1, gradient_set=None,
+            legacy_mask=False, n_jobs=1, output_format='csv', cache=None, parcellation=None,
+            n_perm=None, null_model='permute', seed=None):
     """
     Correlate individual-level maps and gradient maps.
 
     Args:
         mask_name (str): The name of the mask.
         map_coverage (str): The coverage of the map.
-        inputfiles (list): The input task map filepaths.
+        inputfiles (list or VoxelStore): The input task map filepaths (or a VoxelStore built from them).
         taskstring (str): The string identifying the task (assumes BID format).
         substring (str): The string identifying the subject (assumes BID format).
 
         runstring (str, optional): The string identifying the run (assumes BID format). Defaults to None.
         outputdir (str, optional): The output directory. Defaults to None.
-        corr_method (str, optional): The correlation method. Defaults to 'spearman'.
+        corr_method (str, optional): The correlation method ('spearman', 'pearson' or 'kendall'). Defaults to 'spearman'.
         verbose (int, optional): The verbosity level. Defaults to 1.
+        gradient_set (GradientSet, optional): Preloaded gradients. Defaults to None (loaded from cache).
+        legacy_mask (bool, optional): Correlate whole multiplied volumes (out-of-mask voxels as zeros) instead of in-mask voxels only. Defaults to False.
+        n_jobs (int, optional): Number of worker processes to spread maps over (and threads computing surrogates, -1 uses all cores). Defaults to 1.
+        output_format (str, optional): Format of the output files ('csv', 'parquet', 'feather' or 'hdf5'). Rows are appended subject by subject
+            as each subject's maps are correlated (feather is written at the end). Defaults to 'csv'.
+        cache (str or ResultCache, optional): Result cache directory; only maps missing from it are correlated. Defaults to None (no cache).
+        parcellation (nibabel image object or Atlas, optional): Correlate at parcel resolution: inputs and gradients are averaged within the parcels first (see ParcelGradientSet). Defaults to None (voxels).
+        n_perm (int, optional): If given, also return two-sided p-values from this many surrogate maps (see NullModels.nullPvalues). Defaults to None.
+        null_model (str, optional): Surrogates for n_perm, 'permute' (voxels, or parcels with a parcellation) or 'block' (blocks of voxels). Defaults to 'permute'.
+        seed (int, optional): Seed of the surrogates. Defaults to None.
 
     Returns:
-        pandas.DataFrame: The correlation values between task maps and gradients.
+        pandas.DataFrame: The correlation values between task maps and gradients
+        (and a DataFrame of p-values in the same layout if n_perm is given).
     """
-    #  retrieve file paths
-    gradient_paths, mask_path, task_paths = usrpaths(inputfiles, verbose, mask_name, map_coverage)
+    if n_perm is not None and legacy_mask:
+        raise ValueError('n_perm is not supported with legacy_mask')
 
-    # load mask as nib object once 
-    maskimg = nib.load(mask_path) 
+    gradient_set = _resolveGradientSet(mask_name, map_coverage, gradient_set, parcellation, legacy_mask)
 
-    # create empty dictionary to store correlation values in
-    corr_dictionary = {}
+    #  retrieve file paths (and items to load them from)
+    task_paths, items = inputitems(inputfiles, verbose, mask_name, map_coverage, gradient_set, legacy_mask)
 
-    # loop over each task
+    # extract task name and subject id (and run id if runstring provided) from each file path,
+    # and check them for duplicates before anything is correlated or written
+    id_columns = ['Task_name', 'subid'] if runstring is None else ['Task_name', 'subid', 'runid']
+    map_ids = []
     for task in task_paths:
-
-        # extract task name and subject id from file path
-        task_name = extractid(task, taskstring)
-        subid = extractid(task, substring)
-
-        # load task image and apply mask
-        taskimg = nib.load(task)
-        multmap = applymask(taskimg, maskimg)
-
-        # turn to numpy array
-        task_array_masked = multmap.get_fdata()
-
-        # create the 1st level dictionary key (task name)
-        if task_name not in corr_dictionary:
-            corr_dictionary[task_name] = {}
-
-        # create the 2nd level dictionary key (subject id) if it doesn't exist
-        if subid not in corr_dictionary[task_name]:
-            corr_dictionary[task_name][subid] = {}
-
-        # if runstring provided, add level to dict
+        ids = {'Task_name': extractid(task, taskstring), 'subid': extractid(task, substring)}
         if runstring is not None:
-            runid_val = extractid(task, runstring)
-            # create the 3rd level dictionary key (runid) if it doesn't exist
-            if runid_val not in corr_dictionary[task_name][subid]:
-                corr_dictionary[task_name][subid][runid_val] = {}
-
-        if verbose > 0:
-            print (task_name)
-            print('\n')
-
-        # Iterate through each of Neurovault's gradients
-        for gradient in gradient_paths:
-            # retrieve gradname
-            grad_name = gradname(gradient, verbose)
-
-            # load gradient image and apply mask
-            gradientimg = nib.load(gradient)
-            gradientimg_m = applymask(gradientimg, maskimg)  
-
-            # Get the masked gradient image data as a numpy array
-            gradient_array_masked = gradientimg_m.get_fdata()
-
-            # correlate masked task map and gradients 
-            corr = corrGrads(gradient_array_masked,task_array_masked)
-
-            # add to corr dictionary
-            if runstring is None:
-                corr_dictionary[task_name][subid][grad_name] = corr
-            else:
-                corr_dictionary[task_name][subid][runid_val][grad_name] = corr
-
-    # if runstring not provided
-    if runstring is None:
-        # Create an empty list to store data in long format
-        data_long = []
-
-        # Iterate through the nested dictionary to convert it to long format
-        for task, sub_dict in corr_dictionary.items():
-            for sub, grad_dict in sub_dict.items():
-                data_long.extend([task, sub, grad, corr] for grad, corr in grad_dict.items())
-                
-        # Create the 'df_long' DataFrame
-        df_long = pd.DataFrame(data_long, columns=['Task_name', 'subid', 'Gradient', 'Correlation'])
-        # Create the 'df_wide' DataFrame
-        df_wide = df_long.pivot_table(index=['Task_name', 'subid'], columns='Gradient', values='Correlation').reset_index()
-    
-    # if runstring is provided
-    else:
-        # Create an empty list to store data in long format
-        data_long = []
-
-        # Function to recursively traverse the dictionary and create long format data
-        def process_dict(d, task_name, sub_id, run_id=None):
-            if isinstance(d, dict):
-                for key, value in d.items():
-                    if run_id is not None:
-                        data_long.append([task_name, sub_id, run_id, key, value])
-                    elif isinstance(value, dict):
-                        process_dict(value, task_name, sub_id, key)
-            else:
-                return
-
-        # Iterate through the nested dictionary to convert it to long format
-        for task_name, sub_dict in corr_dictionary.items():
-            for sub_id, run_dict in sub_dict.items():
-                process_dict(run_dict, task_name, sub_id)
-
-        # Create the 'df_long' DataFrame
-        df_long = pd.DataFrame(data_long, columns=['Task_name', 'subid', 'runid', 'Gradient', 'Correlation'])
-        # Create the 'df_wide' DataFrame
-        df_wide = df_long.pivot_table(index=['Task_name', 'subid', 'runid'], columns='Gradient', values='Correlation').reset_index()
- 
-    # save dataframe to csv if output directory provided
+            ids['runid'] = extractid(task, runstring)
+        map_ids.append(ids)
+    uniqueids({col: [ids[col] for ids in map_ids] for col in id_columns})
+
+    # read maps already in the result cache
+    cache = opencache(cache)
+    cache_keys, cache_context = cachekeys(cache, task_paths, items, gradient_set, corr_method, legacy_mask)
+    map_corrs = [cache.get(key) if key is not None else None for key in cache_keys]
+    missing = [i for i, corrs in enumerate(map_corrs) if corrs is None]
+
+    # correlate each remaining map with the gradients (in parallel if n_jobs > 1), results keep task_paths order
+    computed = iterparallelmap(_corrIndMap, [items[i] for i in missing], gradient_set, n_jobs, corr_method=corr_method,
+                               legacy_mask=legacy_mask, verbose=verbose)
+
+    # collect correlation values in one preallocated (maps x gradients) array
+    results = ResultTable(id_columns, gradient_set.names, len(task_paths))
+
+    # long and wide output files, appended subject by subject as soon as a subject's maps are correlated
+    output_stem = f'gradscores_{corr_method}_{mask_name}{parcelsuffix(gradient_set)}'
+    writers = [] if outputdir is None else [ResultWriter(outputpath(outputdir, f'{output_stem}_{layout}', output_format), output_format)
+                                            for layout in ('long', 'wide')]
+    try:
+        # loop over each task
+        subject_rows = ResultTable(id_columns, gradient_set.names)
+        for i, ids in enumerate(map_ids):
+            if map_corrs[i] is None:
+                map_corrs[i] = next(computed)
+                if cache_keys[i] is not None:
+                    cache.put(cache_keys[i], map_corrs[i], path=task_paths[i], **cache_context)
+            results.add(map_corrs[i], **ids)
+            subject_rows.add(map_corrs[i], **ids)
+
+            # write the subject as soon as its last map (before one of another subject) is done
+            if i + 1 == len(map_ids) or map_ids[i + 1]['subid'] != ids['subid']:
+                if writers:
+                    writers[0].append(subject_rows.long())
+                    writers[1].append(subject_rows.wide())
+                subject_rows = ResultTable(id_columns, gradient_set.names)
+    finally:
+        computed.close()
+        for writer in writers:
+            writer.close()
+    if cache is not None and verbose > 0:
+        print (f"Result cache: {len(task_paths) - len(missing)} maps read, {len(missing)} correlated")
+
+    # build wide DataFrame
+    df_wide = results.wide()
+
+    if n_perm is None:
+        return df_wide
+
+    # permutation p-values, NULL_MAP_CHUNK maps loaded at a time; every chunk uses the same surrogates
+    from StateSpace.NullModels import nullPvalues
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    pvalues = ResultTable(id_columns, gradient_set.names, len(task_paths))
+    for start in range(0, len(items), NULL_MAP_CHUNK):
+        chunk = np.stack([loadmasked(item, gradient_set) for item in items[start:start + NULL_MAP_CHUNK]])
+        chunk_p = nullPvalues(chunk, gradient_set, n_perm, corr_method, null_model, seed=seed, n_jobs=n_jobs)
+        for ids, row in zip(map_ids[start:start + NULL_MAP_CHUNK], chunk_p):
+            pvalues.add(row, **ids)
+    df_p = pvalues.wide()
     if outputdir != None:
-        df_long.to_csv(os.path.join(outputdir,f'gradscores_{corr_method}_{mask_name}_long.csv'), index=False)
-        df_wide.to_csv(os.path.join(outputdir,f'gradscores_{corr_method}_{mask_name}_wide.csv'), index=False)
-
-    return df_wide
+        writeResults(df_p, outputdir, f'{output_stem}_pvalues_wide', output_format)
+    return df_wide, df_p
 
 def mask4d(img, maskimg):
 # reshape mask to be 4d (additional dimension of time)
+# NOTE: no longer used by the time-course functions, which broadcast the 3-d mask or work in mask space
     print ("original mask shape:",maskimg.get_fdata().shape)
     mask_reshaped = np.expand_dims(maskimg.get_fdata(), axis=-1)
     img_shape = img.shape
@@ -384,10 +1251,76 @@ def mask4d(img, maskimg):
     # convert 4-d mask back to image
     return nib.Nifti1Image(mask_reshaped, maskimg.affine)
 
-def calGroupTimeCourse(mask_name, map_coverage, inputfiles, z_score = True, verbose=1):
+# window shapes understood by slidingWindow
+WINDOW_TAPERS = ('boxcar', 'triangular')
+
+def _trailingSum(array, length):
+    # sum of the last `length` rows at every row (fewer at the start), from one cumulative sum
+    csum = np.cumsum(array, axis=0)
+    csum[length:] -= csum[:-length].copy()
+    return csum
+
+def slidingWindow(matrix, window, taper='boxcar'):
+    """
+    Average a (n_TRs x n_voxels) matrix over a sliding window of TRs centred on each TR.
+
+    Window sums come from cumulative sums over the TRs, so each window costs
+    O(n_voxels) whatever its length. A triangular window is two boxcar passes.
+    Windows are truncated at the start and end of the run (weights renormalised),
+    so the output keeps one row per TR.
+
+    Args:
+        matrix (numpy array): (n_TRs x n_voxels) array, one TR per row.
+        window (int): Window length in TRs (1 returns the TRs unchanged).
+        taper (str, optional): Window shape, 'boxcar' (flat) or 'triangular'. Defaults to 'boxcar'.
+
+    Returns:
+        numpy array: (n_TRs x n_voxels) float64 windowed averages.
+    """
+    if taper not in WINDOW_TAPERS:
+        raise ValueError(f"taper must be one of {WINDOW_TAPERS}, not {taper!r}")
+    if int(window) != window or window < 1:
+        raise ValueError(f'window must be a positive number of TRs, not {window!r}')
+    window = int(window)
+    matrix = np.asarray(matrix, dtype=np.float64)
+    n_trs = matrix.shape[0]
+
+    # boxcar pass lengths (two boxcars of length m make a triangle of length 2m - 1)
+    lengths = [window] if taper == 'boxcar' else [(window + 1) // 2] * 2
+    offset = sum(length - 1 for length in lengths)
+
+    # zero-pad so truncated windows at either end only see the run itself, and
+    # track the summed weights of the same windows to renormalise
+    padded = np.zeros((n_trs + 2 * offset,) + matrix.shape[1:])
+    padded[offset:offset + n_trs] = matrix
+    weights = np.zeros(n_trs + 2 * offset)
+    weights[offset:offset + n_trs] = 1
+    for length in lengths:
+        padded = _trailingSum(padded, length)
+        weights = _trailingSum(weights, length)
+
+    # trailing window ending at row r covers [r - offset, r]; centre it on each TR
+    rows = slice(offset + offset // 2, offset + offset // 2 + n_trs)
+    return padded[rows] / weights[rows].reshape((-1,) + (1,) * (matrix.ndim - 1))
+
+def windowsuffix(window, taper='boxcar'):
+    """
+    Return the output file name suffix of a sliding window ('' for single TRs).
+    """
+    return '' if window is None else f'_window{window}{taper}'
+
+def calGroupTimeCourse(mask_name, map_coverage, inputfiles, z_score = True, verbose=1,
+                       gradient_set=None, as_matrix=False, chunk_size=100):
     """
     Calculate group-averaged time course for per TR function.
 
+    Subjects are streamed one at a time into a running mean of their in-mask
+    (n_TRs x n_voxels) data, so peak memory is about one subject's in-mask
+    float32 matrix plus the accumulator, regardless of the number of subjects.
+    Each run is read chunk_size TRs at a time in its stored dtype (see iterchunks)
+    and its z-score statistics are accumulated chunk by chunk, so the whole run
+    is never held as floats.
+
     Args:
         mask_name (str): The name of the mask.
         map_coverage (str): The coverage of the map.
@@ -395,57 +1328,69 @@ def calGroupTimeCourse(mask_name, map_coverage, inputfiles, z_score = True, verb
 
         z_score (boolean, optional): Whether to z-score ind data prior to averaging. Defaults to True.
         verbose (int, optional): The verbosity level. Defaults to 1.
+        gradient_set (GradientSet, optional): Preloaded gradients and mask. Defaults to None (loaded from cache).
+        as_matrix (boolean, optional): Return in-mask (n_TRs x n_voxels) matrix instead of 4-d array. Defaults to False.
+        chunk_size (int, optional): Number of TRs read at once. Defaults to 100.
 
     Returns:
-        numpy array: The masked group-averaged time course as a 4-d numpy array.
+        numpy array: The masked group-averaged time course as a 4-d float32 numpy array
+        (or (n_TRs x n_voxels) matrix if as_matrix is True).
     """
     
     # get mask and task paths
     gradient_paths, mask_path, task_paths=usrpaths(inputfiles, verbose, mask_name, map_coverage)
 
-    # load mask as nib object
-    maskimg = nib.load(mask_path)
+    # load mask once (or reuse cached gradient set)
+    if gradient_set is None:
+        gradient_set = getGradientSet(mask_name, map_coverage)
+    maskimg = gradient_set.maskimg
 
-    # create empty list to store individual arrays
-    data_arrays = []
+    # running mean of in-mask data across individuals
+    group_mean = None
 
-    # load all data into a list of 4-d arrays
-    for task in task_paths:
-        taskimg = nib.load(task)
-        taskarray = taskimg.get_fdata()
-        # default behavior is to z-score each img
-        if z_score:
-            ztaskarray = zscore(taskarray, axis=None, ddof=1)
-            data_arrays.append(ztaskarray)
-        else:
-            data_arrays.append(taskarray)
+    # stream one individual at a time into the running mean
+    for n_subjects, task in enumerate(task_paths, start=1):
+        shape = nib.load(task).shape
+        if len(shape) != 4:
+            raise ValueError(f'{task} is not a 4-d run (shape {shape})')
 
-    # store affine of last input image for using below
-    task_affine = taskimg.affine
+        # default behavior is to z-score each img (over the whole 4-d image), statistics gathered chunk by chunk
+        stats = ChunkStats() if z_score else None
 
-    # Combine the individual arrays into a single 5D array (additional dimension for individuals)
-    combined_brain_data = np.array(data_arrays)
+        # keep in-mask voxels only (resampled to mask grid with cached index if needed), chunk_size TRs at a time
+        tr_matrix = np.empty((shape[3], gradient_set.n_voxels), dtype=np.float32)
+        for start, chunk in iterchunks(task, gradient_set, chunk_size, stats=stats):
+            tr_matrix[start:start + len(chunk)] = chunk
 
-    # Calculate the average along the first axis (axis=0) to get the average brain data across individuals
-    # makes it a 4-day array again (group-average)
-    group_averaged_time_course = np.mean(combined_brain_data, axis=0)
+        if z_score:
+            tr_matrix -= stats.mean
+            tr_matrix /= stats.std
 
-    # convert 4-d array back to nifi image using task_affine
-    groupimg = nib.Nifti1Image(group_averaged_time_course, affine=task_affine)
+        if group_mean is None:
+            group_mean = np.zeros(tr_matrix.shape, dtype=np.float32)
+        elif tr_matrix.shape != group_mean.shape:
+            raise ValueError(f'{task} has {tr_matrix.shape[0]} TRs, expected {group_mean.shape[0]}')
 
-    # make mask 4d
-    maskimg_4d = mask4d(groupimg, maskimg)
+        # update running mean with this individual
+        tr_matrix -= group_mean
+        tr_matrix /= n_subjects
+        group_mean += tr_matrix
 
-    # apply 4-d mask to group-averaged image
-    multmap=applymask(groupimg,maskimg_4d)
+        if verbose > 0:
+            print (f"Added {task} to group average ({n_subjects}/{len(task_paths)})")
 
-    # get data from masked array
-    group_array_masked = multmap.get_fdata()
+    if as_matrix:
+        return group_mean
+
+    # put in-mask group average back into 4-d array (zeros outside of mask)
+    group_array_masked = np.zeros(maskimg.shape[:3] + (group_mean.shape[0],), dtype=np.float32)
+    group_array_masked[gradient_set.mask_index] = group_mean.T
 
     return group_array_masked
     
 def corrGroupTimeCourse(mask_name, map_coverage, group_array_masked, timecourse_name = None,outputdir=None,
-              corr_method='spearman', verbose=1):
+              corr_method='spearman', verbose=1, gradient_set=None,
+            legacy_mask=False, window=None, taper='boxcar', parcellation=None):
     
     """
     Calculate per TR correlations for group-averaged timecourse.
@@ -453,72 +1398,130 @@ def corrGroupTimeCourse(mask_name, map_coverage, group_array_masked, timecourse_
     Args:
         mask_name (str): The name of the mask.
         map_coverage (str): The coverage of the map.
-        group_array_masked (numpy array): The group-averaged masked timecourse.
+        group_array_masked (numpy array): The group-averaged masked timecourse (4-d array,
+            or (n_TRs x n_voxels) in-mask matrix from calGroupTimeCourse(..., as_matrix=True)).
 
         timecourse_name (str, optional): Name of timecourse for saving results. Defaults to None.
         outputdir (str, optional): The output directory. Defaults to None.
-        corr_method (str, optional): The correlation method. Defaults to 'spearman'.
+        corr_method (str, optional): The correlation method ('spearman', 'pearson' or 'kendall'). Defaults to 'spearman'.
         verbose (int, optional): The verbosity level. Defaults to 1.
+        gradient_set (GradientSet, optional): Preloaded gradients. Defaults to None (loaded from cache).
+        legacy_mask (bool, optional): Correlate whole multiplied volumes (out-of-mask voxels as zeros) instead of in-mask voxels only. Defaults to False.
+        window (int, optional): Correlate the average of a sliding window of this many TRs centred on each TR (see slidingWindow). Defaults to None (single TRs).
+        taper (str, optional): Sliding window shape, 'boxcar' or 'triangular'. Defaults to 'boxcar'.
+        parcellation (nibabel image object or Atlas, optional): Correlate at parcel resolution: inputs and gradients are averaged within the parcels first (see ParcelGradientSet). Defaults to None (voxels).
 
     Returns:
         pandas.DataFrame: The correlation values for each TR.
     """
+    import pandas as pd
+
+    gradient_set = _resolveGradientSet(mask_name, map_coverage, gradient_set, parcellation, legacy_mask)
+
+    # in-mask matrix given: put back into 4-d array for legacy whole-volume mode
+    if group_array_masked.ndim == 2 and legacy_mask:
+        group_matrix = group_array_masked
+        group_array_masked = np.zeros(gradient_set.mask_index.shape + (group_matrix.shape[0],), dtype=group_matrix.dtype)
+        group_array_masked[gradient_set.mask_index] = group_matrix.T
+
+    if legacy_mask:
+        # reshape 4-d group array to (n_TRs x n_voxels), one whole TR volume per row
+        tr_matrix = group_array_masked.reshape(-1, group_array_masked.shape[3]).T
+    elif group_array_masked.ndim == 2:
+        # already in-mask voxels, one TR per row
+        tr_matrix = group_array_masked
+    else:
+        # in-mask voxels only, one TR per row
+        tr_matrix = gradient_set.maskdata(group_array_masked)
+    n_trs = tr_matrix.shape[0]
+
+    # average TRs over sliding windows
+    if window is not None:
+        tr_matrix = slidingWindow(tr_matrix, window, taper)
+
+    # correlate all TRs with all gradients at once
+    corr = gradient_set.corr(tr_matrix, corr_method, legacy_mask)
+
+    if verbose > 0:
+        print (f"Correlated {n_trs} TRs with {len(gradient_set.names)} gradients")
+
+    # store results in dataframe (one column per gradient)
+    df = pd.DataFrame(corr, columns=gradient_set.names)
     
-    # get gradiet and mask paths
-    gradient_paths, mask_path, task_paths = getdata(mask_name, map_coverage)
-    
-    # load mask image once
-    maskimg = nib.load(mask_path)
+    # Set the index name to 'TR'
+    df.index.name = 'TR'
 
-    # create corr dictionary for results
-    corr_dictionary = {}
+    # save to output dir
+    if outputdir != None:
+        df.to_csv(os.path.join(outputdir,f'gradscores_grp_{timecourse_name}_{corr_method}_{mask_name}{parcelsuffix(gradient_set)}{windowsuffix(window, taper)}.csv'))
 
-    # Iterate through each of Neurovault's gradients
-    for gradient in gradient_paths:
+    return df
 
-        # retrieve gradname
-        grad_name = gradname(gradient, verbose)
+def timecourseframe(corr, subid, gradient_names, start=0):
+    """
+    Return per TR correlation values of one subject as a DataFrame (columns subid, TR and one per gradient).
 
-        # create key for gradient
-        if grad_name not in corr_dictionary:
-            corr_dictionary[grad_name] = {}
+    Args:
+        corr (numpy array): (n_TRs x n_gradients) correlation values.
+        subid (str): The subject id.
+        gradient_names (list): Names of the gradients.
+        start (int, optional): Index of the first TR. Defaults to 0.
 
-        # load gradient image and apply mask
-        gradientimg = nib.load(gradient)
-        gradientimg_m = applymask(gradientimg, maskimg)               
+    Returns:
+        pandas.DataFrame: One row per TR.
+    """
+    import pandas as pd
 
-        # Get the masked gradient image data as a numpy array
-        gradient_array = gradientimg_m.get_fdata()
+    df = pd.DataFrame(corr, columns=pd.Index(gradient_names, name='Gradient'))
+    df.insert(0, 'TR', np.arange(start, start + len(corr)))
+    df.insert(0, 'subid', subid)
+    return df
 
-        # loop over group-averaged array TRs (4th dimension)
-        for tr_volume in range(group_array_masked.shape[3]):
+def streamIndTimeCourse(mask_name, map_coverage, inputfiles, substring, corr_method='spearman',
+                        chunk_size=100, verbose=1, gradient_set=None, legacy_mask=False, parcellation=None):
+    """
+    Calculate per TR correlations for individual level timecourses, yielding them chunk by chunk.
+
+    Each run is read chunk_size TRs at a time (see iterchunks), so memory is
+    bounded by the chunk and rows can be written out as soon as they are ready.
 
-            # select TR volume
-            tr_array_masked = group_array_masked[:, :, :, tr_volume]
+    Args:
+        mask_name (str): The name of the mask.
+        map_coverage (str): The coverage of the map.
+        inputfiles (list or VoxelStore): List of filepaths (or a VoxelStore built from them).
+        substring (str): The string for finding subid in filepath. Assumes BID format.
+        corr_method (str, optional): The correlation method ('spearman', 'pearson' or 'kendall'). Defaults to 'spearman'.
+        chunk_size (int, optional): Number of TRs read and correlated at once. Defaults to 100.
+        verbose (int, optional): The verbosity level. Defaults to 1.
+        gradient_set (GradientSet, optional): Preloaded gradients. Defaults to None (loaded from cache).
+        legacy_mask (bool, optional): Correlate whole multiplied volumes (out-of-mask voxels as zeros) instead of in-mask voxels only. Defaults to False.
+        parcellation (nibabel image object or Atlas, optional): Correlate at parcel resolution: inputs and gradients are averaged within the parcels first (see ParcelGradientSet). Defaults to None (voxels).
 
-            # correlate task map and gradients
-            corr = corrGrads(gradient_array, tr_array_masked)
+    Yields:
+        pandas.DataFrame: Correlation values of one chunk (columns subid, TR and one per gradient).
+    """
+    gradient_set = _resolveGradientSet(mask_name, map_coverage, gradient_set, parcellation, legacy_mask)
 
-            if verbose > 0:
-                print ("TR:",tr_volume)
+    # get paths (and items to load them from)
+    task_paths, items = inputitems(inputfiles, verbose, mask_name, map_coverage, gradient_set, legacy_mask)
 
-            # add to dict
-            corr_dictionary[grad_name][tr_volume] = corr
+    # extract subject ids from file paths (checked for duplicates before the first chunk)
+    subids = [extractid(ind_path, substring) for ind_path in task_paths]
+    uniqueids({'subid': subids})
 
-    # Transform corr_dictionary into pandas DataFrame
-    df = pd.DataFrame({grad_name: [corr_dictionary[grad_name].get(tr_volume, None) for tr_volume in corr_dictionary.get(grad_name, {})] for grad_name in corr_dictionary})
-    
-    # Set the index name to 'TR'
-    df.index.name = 'TR'
+    for subid, item in zip(subids, items):
+        for start, tr_matrix in iterchunks(item, gradient_set, chunk_size, legacy_mask):
+            # correlate all TRs of the chunk with all gradients at once
+            corr = gradient_set.corr(tr_matrix, corr_method, legacy_mask)
 
-    # save to output dir
-    if outputdir != None:
-        df.to_csv(os.path.join(outputdir,f'gradscores_grp_{timecourse_name}_{corr_method}_{mask_name}.csv'))
+            if verbose > 0:
+                print ("subid",subid,f"correlated TRs {start}-{start + len(corr) - 1}")
 
-    return df
+            yield timecourseframe(corr, subid, gradient_set.names, start)
 
 def corrIndTimeCourse(mask_name, map_coverage, inputfiles, substring, timecourse_name = None, outputdir=None,
-              corr_method='spearman', verbose=1):
+              corr_method='spearman', verbose=1, gradient_set=None,
+            legacy_mask=False, chunk_size=None, output_format='csv', window=None, taper='boxcar', parcellation=None):
     
     """
     Calculate per TR correlations for individual level timecourses.
@@ -526,96 +1529,95 @@ def corrIndTimeCourse(mask_name, map_coverage, inputfiles, substring, timecourse
     Args:
         mask_name (str): The name of the mask.
         map_coverage (str): The coverage of the map.
-        inputfiles (list): List of filepaths. All nifti files must have same number of volumes.
+        inputfiles (list or VoxelStore): List of filepaths (or a VoxelStore built from them). All nifti files must have same number of volumes.
         substring (str): The string for finding subid in filepath. Assumes BID format.
 
         timecourse_name (str, optional): Name of timecourse for saving results. Defaults to None.
         outputdir (str, optional): The output directory. Defaults to None.
-        corr_method (str, optional): The correlation method. Defaults to 'spearman'.
+        corr_method (str, optional): The correlation method ('spearman', 'pearson' or 'kendall'). Defaults to 'spearman'.
         verbose (int, optional): The verbosity level. Defaults to 1.
+        gradient_set (GradientSet, optional): Preloaded gradients. Defaults to None (loaded from cache).
+        legacy_mask (bool, optional): Correlate whole multiplied volumes (out-of-mask voxels as zeros) instead of in-mask voxels only. Defaults to False.
+        chunk_size (int, optional): If given, read and correlate runs chunk_size TRs at a time (bounded memory, see streamIndTimeCourse),
+            appending rows to the output file as each chunk finishes. Defaults to None (whole runs, appended as each run finishes).
+        output_format (str, optional): Format of the output file ('csv', 'parquet', 'feather' or 'hdf5'; feather is written at the end). Defaults to 'csv'.
+        window (int, optional): Correlate the average of a sliding window of this many TRs centred on each TR (see slidingWindow).
+            Not supported with chunk_size. Defaults to None (single TRs).
+        taper (str, optional): Sliding window shape, 'boxcar' or 'triangular'. Defaults to 'boxcar'.
+        parcellation (nibabel image object or Atlas, optional): Correlate at parcel resolution: inputs and gradients are averaged within the parcels first (see ParcelGradientSet). Defaults to None (voxels).
 
     Returns:
         pandas.DataFrame: The correlation values for each person and each TR.
     """
+    if window is not None and chunk_size is not None:
+        raise ValueError('window is not supported with chunk_size (windows span chunks), use whole runs')
     
-    # get paths
-    gradient_paths, mask_path, task_paths = usrpaths(inputfiles, verbose, mask_name, map_coverage)
-    
-    # load mask image once
-    maskimg = nib.load(mask_path)
-
-    # create empty dictionary to store correlation values in
-    corr_dictionary = {}
-
-    # loop over indiviudal file paths
-    for ind_path in task_paths:
-        # extract subject id from file path
-        subid = extractid(ind_path, substring)
-
-        # load ind image
-        indimg = nib.load(ind_path)
-
-        # make mask 4d (TO DO: change this because this means 4d mask is made for each person)
-        maskimg_4d = mask4d(indimg, maskimg)
-
-        # apply mask
-        multmap = applymask(indimg, maskimg_4d)
-
-        # turn to numpy array
-        ind_array_masked = multmap.get_fdata()
-
-        # create the 1st level dictionary key (sub id)
-        if subid not in corr_dictionary:
-            corr_dictionary[subid] = {}
-
-        # Iterate through each of Neurovault's gradients
-        for gradient in gradient_paths:
-            # retrieve gradname
-            grad_name = gradname(gradient, verbose)
-
-            # load gradient image and apply mask
-            # create key for gradient
-            if grad_name not in corr_dictionary:
-                corr_dictionary[subid][grad_name] = {}
-
-            # load gradient image and apply mask
-            gradientimg = nib.load(gradient)
-            gradientimg_m = applymask(gradientimg, maskimg)               
-
-            # Get the masked gradient image data as a numpy array
-            gradient_array = gradientimg_m.get_fdata()
+    gradient_set = _resolveGradientSet(mask_name, map_coverage, gradient_set, parcellation, legacy_mask)
 
-            # loop over group-averaged array TRs (4th dimension)
-            for tr_volume in range(ind_array_masked.shape[3]):
+    output_stem = f'gradscores_ind_{timecourse_name}_{corr_method}_{mask_name}{parcelsuffix(gradient_set)}{windowsuffix(window, taper)}'
 
-                # select TR volume
-                tr_array_masked = ind_array_masked[:, :, :, tr_volume]
+    if chunk_size is not None:
+        # stream runs in TR chunks, each chunk is written as soon as it is correlated
+        frames = streamIndTimeCourse(mask_name, map_coverage, inputfiles, substring, corr_method,
+                                     chunk_size, verbose, gradient_set, legacy_mask)
+    else:
+        # whole runs, each subject is written as soon as its run is correlated
+        frames = _runTimeCourses(mask_name, map_coverage, inputfiles, substring, corr_method,
+                                 verbose, gradient_set, legacy_mask, window, taper)
 
-                # correlate task map and gradients
-                corr = corrGrads(gradient_array, tr_array_masked)
+    # collect correlation values of all subjects' TRs in one array, appending them to the output file as they come
+    writer = ResultWriter(outputpath(outputdir, output_stem, output_format), output_format) if outputdir != None else None
+    results = ResultTable(['subid', 'TR'], gradient_set.names)
+    try:
+        for df in frames:
+            if writer is not None:
+                writer.append(df)
+            results.add(df[gradient_set.names].to_numpy(), subid=df['subid'].to_numpy(), TR=df['TR'].to_numpy())
+    finally:
+        frames.close()
+        if writer is not None:
+            writer.close()
+
+    # build wide DataFrame
+    return results.wide()
+
+def _runTimeCourses(mask_name, map_coverage, inputfiles, substring, corr_method, verbose, gradient_set,
+                    legacy_mask, window, taper):
+    """
+    Yield per TR correlations of each whole run (used by corrIndTimeCourse).
 
-                if verbose > 0:
-                    print ("subid",subid,"TR:",tr_volume)
+    Yields:
+        pandas.DataFrame: Correlation values of one subject (columns subid, TR and one per gradient).
+    """
+    # get paths (and items to load them from)
+    task_paths, items = inputitems(inputfiles, verbose, mask_name, map_coverage, gradient_set, legacy_mask)
 
-                # add to dict
-                corr_dictionary[subid][grad_name][tr_volume] = corr
+    # extract subject ids from file paths (checked for duplicates before the first run is correlated)
+    subids = [extractid(ind_path, substring) for ind_path in task_paths]
+    uniqueids({'subid': subids})
 
-    # Create an empty list to store data in long format
-    data_long = []
+    # loop over indiviudal file paths
+    for subid, item in zip(subids, items):
+        # load masked ind data
+        ind_array_masked = loadmasked(item, gradient_set, legacy_mask)
 
-    # Iterate through the nested dictionary to convert it to long format
-    for subid, grad_dict in corr_dictionary.items():
-        for grad, tr_dict in grad_dict.items():
-            data_long.extend([subid, grad, TR, corr] for TR, corr in tr_dict.items())
+        if legacy_mask:
+            # reshape 4-d array to (n_TRs x n_voxels), one TR volume per row
+            tr_matrix = ind_array_masked.reshape(-1, ind_array_masked.shape[3]).T
+        else:
+            # already in-mask voxels only, one TR per row
+            tr_matrix = ind_array_masked
+        n_trs = tr_matrix.shape[0]
 
-    # Create the 'df_long' DataFrame
-    df_long = pd.DataFrame(data_long, columns=['subid', 'Gradient', 'TR', 'Correlation'])
+        # average TRs over sliding windows
+        if window is not None:
+            tr_matrix = slidingWindow(tr_matrix, window, taper)
 
-    # Create the 'df_wide' DataFrame
-    df_wide = df_long.pivot_table(index=['subid', 'TR'], columns='Gradient', values='Correlation').reset_index()
+        # correlate all TRs with all gradients at once
+        corr = gradient_set.corr(tr_matrix, corr_method, legacy_mask)
 
-    # save to output dir
-    if outputdir != None:
-        df_wide.to_csv(os.path.join(outputdir,f'gradscores_ind_{timecourse_name}_{corr_method}_{mask_name}.csv'), index = False)
+        if verbose > 0:
+            print ("subid",subid,f"correlated {n_trs} TRs")
 
-    return df_wide
+        # one row per TR
+        yield timecourseframe(corr, subid, gradient_set.names)
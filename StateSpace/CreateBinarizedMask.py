@@ -1,93 +1,229 @@
 '''
 Create binarized mask from nifti image 
 
+buildMask() streams any list of maps (one at a time) into a single boolean
+accumulator, combining them by intersection, union or coverage threshold, and
+returns a PackedMask (bit-packed, 1 bit per voxel). A PackedMask can be saved
+as a uint8 nifti anywhere, or passed as mask_name to the correlate functions.
+coverageCount() counts per voxel the maps it is non-zero in, from which
+binMask() derives the intersection and union of the gradients in one pass.
+
 '''
 
+import hashlib
 import numpy as np
 import nibabel as nib
 import glob
 import os
-import pkg_resources
+from StateSpace.Utils import datapath
+
+# rules for combining input maps in buildMask
+MASK_RULES = ('intersection', 'union', 'coverage')
+
+class PackedMask:
+    """
+    Boolean brain mask stored bit-packed (1 bit per voxel) with its grid.
+
+    Can be passed as mask_name to GradientSet / the correlate functions in place of a mask name or path.
 
-def binMask(method, map_coverage):  # sourcery skip: extract-method
+    Args:
+        bits (numpy array): Output of np.packbits on the C-order flattened boolean mask.
+        shape (tuple): 3-d shape of the mask grid.
+        affine (numpy array): 4x4 affine of the mask grid.
+        name (str, optional): Name used in output file names. Defaults to 'custommask'.
+    """
+
+    def __init__(self, bits, shape, affine, name='custommask'):
+        self.bits = np.asarray(bits, dtype=np.uint8)
+        self.shape = tuple(int(n) for n in shape)
+        self.affine = np.asarray(affine, dtype=np.float64)
+        self.name = name
+        self._digest = hashlib.sha1(self.bits.tobytes() + repr(self.shape).encode() + self.affine.tobytes()).hexdigest()
+
+    @classmethod
+    def fromarray(cls, array, affine, name='custommask'):
+        """
+        Pack a 3-d array (non-zero = in mask).
+        """
+        array = np.asarray(array) != 0
+        return cls(np.packbits(array, axis=None), array.shape, affine, name)
+
+    @classmethod
+    def load(cls, path, name=None):
+        """
+        Pack a mask nifti file (non-zero = in mask).
+        """
+        img = nib.load(path)
+        if name is None:
+            name = os.path.basename(path).split('.')[0]
+        return cls.fromarray(np.asanyarray(img.dataobj), img.affine, name)
+
+    @property
+    def n_voxels(self):
+        return int(np.unpackbits(self.bits).sum())
+
+    def toarray(self):
+        """
+        Return the mask as a 3-d boolean array.
+        """
+        return np.unpackbits(self.bits, count=int(np.prod(self.shape))).reshape(self.shape).astype(bool)
+
+    def toimg(self):
+        """
+        Return the mask as a uint8 nifti image.
+        """
+        img = nib.Nifti1Image(self.toarray().astype(np.uint8), self.affine)
+        img.set_data_dtype(np.uint8)
+        return img
+
+    def save(self, path):
+        """
+        Save the mask as a uint8 nifti file.
+        """
+        nib.save(self.toimg(), path)
+
+    def __eq__(self, other):
+        return isinstance(other, PackedMask) and self._digest == other._digest
+
+    def __hash__(self):
+        # hashable so gradient sets built on a PackedMask can be cached
+        return hash(self._digest)
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return f'PackedMask({self.name!r}, shape={self.shape})'
+
+def _readnonzero(inputfiles):
+    # yield (path, non-zero voxels, affine) one map at a time, checking all maps are on the grid of the first
+    shape = affine = None
+    for brain_map in inputfiles:
+        img = nib.load(brain_map)
+        # compare in the stored dtype (no float64 copy)
+        nonzero = np.asanyarray(img.dataobj) != 0
+        if nonzero.ndim == 4:
+            nonzero = nonzero.all(axis=3)
+        if shape is None:
+            shape, affine = nonzero.shape, img.affine
+        elif nonzero.shape != shape or not np.allclose(img.affine, affine):
+            raise ValueError(f'{brain_map} is not on the grid of {inputfiles[0]}')
+        yield nonzero, affine
+
+def coverageCount(inputfiles):
+    """
+    Count, per voxel, the maps it is non-zero in, reading one map at a time.
+
+    Args:
+        inputfiles (list): Map filepaths (all on the same grid). 4-d maps count voxels that are non-zero in every volume.
+
+    Returns:
+        tuple: The (int32) count array and the affine of the grid.
+    """
+    if not inputfiles:
+        raise ValueError('No input files given')
+    count = None
+    for nonzero, affine in _readnonzero(inputfiles):
+        if count is None:
+            count = np.zeros(nonzero.shape, dtype=np.int32)
+        count += nonzero
+    return count, affine
+
+def buildMask(inputfiles, rule='intersection', threshold=1.0, outpath=None, name='custommask', verbose=1):
+    """
+    Build a mask of non-zero voxels from maps, reading one map at a time.
+
+    Args:
+        inputfiles (list): Map filepaths (all on the same grid). 4-d maps count voxels that are non-zero in every volume.
+        rule (str, optional): 'intersection' (non-zero in all maps), 'union' (non-zero in any map) or
+            'coverage' (non-zero in at least threshold of the maps). Defaults to 'intersection'.
+        threshold (float, optional): Fraction of maps a voxel must be non-zero in, for rule 'coverage'. Defaults to 1.0.
+        outpath (str, optional): Path to save the mask to as a uint8 nifti. Defaults to None (not saved).
+        name (str, optional): Name of the mask (used in output file names). Defaults to 'custommask'.
+        verbose (int, optional): The verbosity level. Defaults to 1.
+
+    Returns:
+        PackedMask: The mask.
+    """
+    if rule not in MASK_RULES:
+        raise ValueError(f"rule must be one of {MASK_RULES}, not {rule!r}")
+    if not inputfiles:
+        raise ValueError('No input files given')
+
+    if rule == 'coverage':
+        count, affine = coverageCount(inputfiles)
+        accumulator = count >= threshold * len(inputfiles)
+    else:
+        accumulator = None
+        for nonzero, affine in _readnonzero(inputfiles):
+            if accumulator is None:
+                accumulator = np.full(nonzero.shape, rule == 'intersection')
+            if rule == 'intersection':
+                accumulator &= nonzero
+            else:
+                accumulator |= nonzero
+
+    mask = PackedMask.fromarray(accumulator, affine, name)
+    if verbose > 0:
+        print (f"Built {rule} mask of {len(inputfiles)} maps: {mask.n_voxels} voxels")
+    if outpath is not None:
+        mask.save(outpath)
+        if verbose > 0:
+            print (f"Saved mask to {outpath}")
+    return mask
+
+def binMask(method, map_coverage, outputdir=None):
     """
     Creates and saves binary mask based on specified method and map coverage.
 
     Args:
         method (str): The method to use for creating masks. Options include 'grad_only' and 'all_maps'.
         map_coverage (str): The coverage you want to use. Options include 'cortical_only' and 'all'.
+        outputdir (str, optional): Directory to save the mask to. Defaults to None (the package data/masks directory).
 
     Returns:
-        None.
+        PackedMask: The mask (None if the gradient masks do not match).
+
+    Raises:
+        ValueError: If method or map_coverage is not one of the options.
     
-    Mask is saved to data/masks directory.
+    Mask is saved (as uint8) to data/masks directory, unless outputdir is given.
 
     """
-    gradient_subdir = pkg_resources.resource_filename('StateSpace','data/gradients')
+    maskdir = datapath('data/masks') if outputdir is None else outputdir
+    gradient_subdir = datapath('data/gradients')
     if map_coverage == 'cortical_only':
         gradient_paths = sorted(glob.glob(f'{gradient_subdir}/*cortical_only.nii.gz'))
         print ("Cortical only gradient maps used.")
     elif map_coverage == 'all':
         gradient_paths = sorted(glob.glob(f'{gradient_subdir}/*subcortical.nii.gz'))
         print ("Cortical AND sub-cortical gradient maps used.")
+    else:
+        raise ValueError(f"map_coverage must be 'cortical_only' or 'all', not {map_coverage!r}")
 
     if method == 'grad_only':
+        mask_name = 'gradientmask_cortical' if map_coverage == 'cortical_only' else 'gradientmask_cortical_subcortical'
+
+        # sanity check - all masks should be the same, regardless of which grad they came from
+        # (intersection and union from one pass over the gradients)
+        count, affine = coverageCount(gradient_paths)
+        if not np.array_equal(count == len(gradient_paths), count > 0):
+            print('Gradient mask arrays do not match.')
+            return None
+        mask = PackedMask.fromarray(count > 0, affine, mask_name)
 
-        mask_list = []
-    
-        # loop over grads (only necessary for sanity - all masks should be the same, regardless of which grad they came from)
-        for brain_map in gradient_paths:
-    
-            map_array = nib.load(brain_map).get_fdata()
-        
-            mask = np.zeros_like(map_array)
-        
-            mask[map_array != 0] = 1
-        
-            mask_list.append(mask)
-    
-        if np.array_equal(mask_list[0],mask_list[1]):
-            maskdir=pkg_resources.resource_filename('StateSpace', 'data/masks')
-            # NOTE: See how we used the affine arg? this resolved weird aligmennt issue
-            if map_coverage == 'cortical_only':
-                nib.save(nib.Nifti1Image(mask_list[0], affine=nib.load(brain_map).affine), 
-                os.path.join(maskdir,'gradientmask_cortical.nii.gz'))
-            elif map_coverage == 'all':
-                nib.save(nib.Nifti1Image(mask_list[0], affine=nib.load(brain_map).affine), 
-                os.path.join(maskdir,'gradientmask_cortical_subcortical.nii.gz'))
-        else:
-            print('Gradient 1 and 2 mask arrays do not match.')
-            
     elif method == 'all_maps':
-        
-        task_subdir = pkg_resources.resource_filename('StateSpace','data/realTaskNiftis')
+        mask_name = 'combinedmask_cortical' if map_coverage == 'cortical_only' else 'combinedmask_cortical_subcortical'
+
+        task_subdir = datapath('data/realTaskNiftis')
         task_paths = sorted(glob.glob(f'{task_subdir}/*nii.gz'))
-        
-        # put task and gradient maps together in a list to loop over
-        all_paths = task_paths + gradient_paths
-        
-        mask_list = []
-        
-        # Loop over all maps
-        for brain_map in all_paths:
-            map_array = nib.load(brain_map).get_fdata()
-            
-            mask = np.zeros_like(map_array)
-            
-            mask[map_array != 0] = 1
-            
-            mask_list.append(mask)
-        
-        # Combine masks
-        combined_mask = np.ones_like(mask_list[0])
-        for mask in mask_list:
-            combined_mask *= mask
-            
-        # Save final mask
-        maskdir=pkg_resources.resource_filename('StateSpace', 'data/masks')
-        if map_coverage == 'cortical_only':
-            nib.save(nib.Nifti1Image(combined_mask, affine=nib.load(brain_map).affine), 
-                 os.path.join(maskdir,'combinedmask_cortical.nii.gz'))
-        elif map_coverage == 'all':
-            nib.save(nib.Nifti1Image(combined_mask, affine=nib.load(brain_map).affine), 
-                 os.path.join(maskdir,'combinedmask_cortical_subcortical.nii.gz'))
+
+        # voxels non-zero in all task and gradient maps
+        mask = buildMask(task_paths + gradient_paths, 'intersection', name=mask_name, verbose=0)
+
+    else:
+        raise ValueError(f"method must be 'grad_only' or 'all_maps', not {method!r}")
+
+    # Save final mask
+    mask.save(os.path.join(maskdir, f'{mask_name}.nii.gz'))
+    return mask
@@ -5,17 +5,26 @@ import os
 import shutil
 import nibabel as nib
 import numpy as np
-from nilearn.datasets import fetch_atlas_schaefer_2018, fetch_atlas_yeo_2011
-from nilearn.image import load_img, new_img_like, resample_to_img
 from tqdm import tqdm
-import pkg_resources
+from StateSpace.CorrelateTasksWithGradients import getGradientSet, getdata, usrpaths, corrMatrix, ongrid
+from StateSpace.AtlasRegistry import Atlas, atlaskey, labelindex, openregistry
+
+# nilearn, scipy and pandas are imported in the functions that use them (fast package import)
 
 
 def makemaps(
-    yeo: bool, splitmaps: bool, shafer_rois: int = 400, yeover: str = "thick_7"
+    yeo: bool,
+    splitmaps: bool,
+    shafer_rois: int = 400,
+    yeover: str = "thick_7",
+    data_dir: str = None,
+    registry=None,
 ):
     """
     This function makes a parcellation map from either the Yeo or Shafer atlas.
+    With an atlas registry (see StateSpace.AtlasRegistry) the parcellation is read from
+    the registry, already resampled to the gradient grid, and is only downloaded
+    (into the registry) if it is not stored yet.
 
     Parameters
     ----------
@@ -28,17 +37,31 @@ def makemaps(
     yeover : str
         Which version of the Yeo atlas to use.
         Options: "thick_7", "thick_17", "thin_7", "thin_17"
+    data_dir : str
+        Download directory. Defaults to "yeo_networks" / "shaefer_atlas" in the working directory.
+    registry : AtlasRegistry or str
+        Atlas registry (or its directory) to read the parcellation from. Defaults to None
+        ($STATESPACE_ATLAS_DIR if set); False never uses a registry.
 
     Returns
     -------
-    parcellation : nibabel.nifti1.Nifti1Image
-        The parcellation map.
+    parcellation : nibabel.nifti1.Nifti1Image or Atlas
+        The parcellation map (an Atlas, on the gradient grid, when read from a registry).
     parcelnames : list
-        The names of the parcels.
+        The names of the parcels (str when read from a registry).
     """
+    registry = openregistry(registry)
+    if registry is not None and not splitmaps:
+        key = atlaskey(yeo, shafer_rois, yeover)
+        atlas = registry.load(key) if key in registry else registry.fetch(key)
+        return atlas, atlas.names
+
+    from nilearn.datasets import fetch_atlas_schaefer_2018, fetch_atlas_yeo_2011
+    from nilearn.image import load_img, new_img_like
+
     if yeo:
         yeonum = yeover.split("_")[-1]
-        atlasdir = "yeo_networks"
+        atlasdir = "yeo_networks" if data_dir is None else data_dir
         parcellation = load_img(fetch_atlas_yeo_2011(atlasdir)[yeover])
         if splitmaps:
             mdata = np.squeeze(parcellation.get_fdata())
@@ -80,7 +103,7 @@ def makemaps(
                 b"Default",
             ]
     else:
-        atlasdir = "shaefer_atlas"
+        atlasdir = "shaefer_atlas" if data_dir is None else data_dir
         parcellation = fetch_atlas_schaefer_2018(n_rois=shafer_rois, data_dir=atlasdir)
         parcelnames = parcellation["labels"].tolist()
         parcellation = load_img(parcellation["maps"])
@@ -101,6 +124,10 @@ def lesion(
     It then creates a new map for each map in the map directory where the lesion number is set to 0.
     It then saves the new maps in the new directory.
     """
+    from nilearn.image import new_img_like, resample_to_img
+
+    if isinstance(parcellation, Atlas):
+        parcellation = parcellation.toimg()
     lesionnumber += 1
     maps = [[x, nib.load(os.path.join(mapdir, x))] for x in os.listdir(mapdir) if '.nii' in x] # add extension check for README
     print(maps)
@@ -115,6 +142,391 @@ def lesion(
         mapdata = map.get_fdata()
         mapdata = np.where(fixed_parcelmap == lesionnumber, 0, mapdata)
         mapnifti = new_img_like(map, mapdata, affine=map.affine)
-        mapnifti.to_filename(os.path.join(outpath, parcel.decode(), mapname))
-        print(f'Saving {os.path.join(outpath, parcel.decode(), mapname)}')
+        mapnifti.to_filename(os.path.join(outpath, _parcelname(parcel), mapname))
+        print(f'Saving {os.path.join(outpath, _parcelname(parcel), mapname)}')
+
+
+def batchLesion(
+    parcellation: nib.Nifti1Image,
+    parcelnames: list,
+    mapdirs,
+    outpath: str,
+    parcels: list = None,
+    n_threads: int = None,
+    verbose: int = 1,
+) -> list:
+    """
+    This function writes lesioned copies of every map in mapdirs for many parcels in one pass
+    (same output as calling lesion once per parcel and map directory).
+    Each map is loaded once and the parcellation is resampled once per map grid; the
+    voxels of every parcel are looked up from one sorted label array, so the cost grows
+    linearly with the number of parcels (e.g. Schaefer 400 / 1000) rather than reloading
+    all maps for each one. Lesioned maps are built and written in a thread pool, as
+    writing .nii.gz files is bound by gzip compression.
+
+    Parameters
+    ----------
+    parcellation : nibabel.nifti1.Nifti1Image or Atlas
+        The parcellation map (e.g. from makemaps).
+    parcelnames : list
+        The names of the parcels. Parcel i has label i + 1 in the parcellation (as in lesion).
+    mapdirs : str or list
+        Directory, or list of directories, of maps to lesion.
+    outpath : str
+        Output directory, lesioned maps are written to outpath/<parcel>/<mapname>.
+    parcels : list
+        Names of the parcels to lesion. Defaults to all parcels.
+    n_threads : int
+        Number of writer threads. Defaults to None (os.cpu_count()).
+    verbose : int
+        The verbosity level.
+
+    Returns
+    -------
+    paths : list
+        The paths written to.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from nilearn.image import new_img_like
+
+    if isinstance(mapdirs, str):
+        mapdirs = [mapdirs]
+    names = [_parcelname(x) for x in parcelnames]
+    if parcels is None:
+        parcels = names
+    parcels = [_parcelname(x) for x in parcels]
+    unknown = [x for x in parcels if x not in names]
+    if unknown:
+        raise ValueError(f"Unknown parcels {unknown}")
+
+    # load every map once (fdata, as in lesion)
+    maps = []
+    for mapdir in mapdirs:
+        for mapname in sorted(os.listdir(mapdir)):
+            if ".nii" in mapname:
+                img = nib.load(os.path.join(mapdir, mapname))
+                maps.append((mapname, img, img.get_fdata()))
+
+    # resample the parcellation once per map grid (unless it is a registry atlas on that grid)
+    # and index the voxels of every parcel
+    grids = {}
+    parcelvoxels = []
+    for mapname, img, data in maps:
+        grid = (img.shape[:3], np.asarray(img.affine, dtype=np.float64).tobytes())
+        if grid not in grids and isinstance(parcellation, Atlas) and ongrid(img, parcellation):
+            # registry atlases keep their voxel index
+            grids[grid] = parcellation.labelindex()
+        elif grid not in grids:
+            grids[grid] = labelindex(_gridlabels(parcellation, img).reshape(-1), len(names))
+        parcelvoxels.append(grids[grid])
+
+    for parcel in parcels:
+        os.makedirs(os.path.join(outpath, parcel), exist_ok=True)
+
+    def write(job):
+        parcel, n = job
+        mapname, img, data = maps[n]
+        voxels = parcelvoxels[n][names.index(parcel) + 1]
+        # set the parcel's voxels (in every volume of a 4-d map) to 0
+        mapdata = data.copy()
+        mapdata.reshape(int(np.prod(img.shape[:3])), -1)[voxels] = 0
+        path = os.path.join(outpath, parcel, mapname)
+        new_img_like(img, mapdata, affine=img.affine).to_filename(path)
+        return path
+
+    jobs = [(parcel, n) for parcel in parcels for n in range(len(maps))]
+    with ThreadPoolExecutor(max_workers=n_threads or os.cpu_count()) as executor:
+        paths = list(tqdm(executor.map(write, jobs), total=len(jobs), disable=verbose == 0))
+    return paths
+
+def _gridlabels(parcellation, img) -> np.ndarray:
+    # parcel labels on img's grid: a registry atlas on that grid is used as is,
+    # anything else is resampled (nearest neighbour)
+    from nilearn.image import resample_to_img
+
+    if isinstance(parcellation, Atlas):
+        if ongrid(img, parcellation):
+            return parcellation.labels
+        parcellation = parcellation.toimg()
+    fixed_parcelmap = resample_to_img(parcellation, img, interpolation="nearest")
+    return np.rint(np.asanyarray(fixed_parcelmap.dataobj).squeeze()).astype(np.int64)
+
+
+def _parcelname(parcel):
+    # parcel names from makemaps are bytes for the yeo / older schaefer atlases
+    return parcel.decode() if isinstance(parcel, bytes) else str(parcel)
+
+
+def parcellabels(parcellation: nib.Nifti1Image, gradient_set) -> np.ndarray:
+    """
+    This function resamples a parcellation to the mask grid (nearest neighbour) once
+    and returns the parcel label of every in-mask voxel.
+
+    Parameters
+    ----------
+    parcellation : nibabel.nifti1.Nifti1Image or Atlas
+        The parcellation map (e.g. from makemaps).
+    gradient_set : GradientSet
+        Gradients and mask defining the in-mask voxels.
+
+    Returns
+    -------
+    labels : numpy.ndarray
+        1-d integer array of parcel labels, one per in-mask voxel.
+    """
+    labels = _gridlabels(parcellation, gradient_set.maskimg)
+    return gradient_set.maskdata(labels).astype(np.int32)
+
+
+def _taskmatrix(mask_name, map_coverage, inputfiles, gradient_set, verbose):
+    # task maps (14-task battery by default) as in-mask (maps x voxels) matrix
+    if inputfiles is None:
+        gradient_paths, mask_path, task_paths = getdata(mask_name, map_coverage)
+    else:
+        gradient_paths, mask_path, task_paths = usrpaths(inputfiles, verbose, mask_name, map_coverage)
+    task_names = [os.path.basename(os.path.normpath(x)).split(".")[0] for x in task_paths]
+    task_matrix = np.empty((len(task_paths), gradient_set.n_voxels), dtype=np.float32)
+    for row, task in enumerate(task_paths):
+        task_matrix[row] = gradient_set.extract(nib.load(task))
+    return task_names, task_matrix
+
+
+def virtualLesion(
+    parcellation: nib.Nifti1Image,
+    parcelnames: list,
+    mask_name: str,
+    map_coverage: str,
+    inputfiles: list = None,
+    corr_method: str = "spearman",
+    parcels: list = None,
+    gradient_set=None,
+    outpath: str = None,
+    verbose: int = 1,
+):
+    """
+    This function computes lesioned state-space coordinates in memory.
+    Task maps and gradients are held as in-mask (maps x voxels) matrices, and for
+    each parcel its voxels are removed from both before correlating, so no lesioned
+    niftis need to be written or re-loaded.
+    Note that lesioned voxels are dropped from the correlation rather than set to
+    zero (as in the niftis written by lesion).
+
+    Parameters
+    ----------
+    parcellation : nibabel.nifti1.Nifti1Image or Atlas
+        The parcellation map (e.g. from makemaps).
+    parcelnames : list
+        The names of the parcels. Parcel i has label i + 1 in the parcellation (as in lesion).
+    mask_name : str
+        The name of the mask.
+    map_coverage : str
+        The coverage of the map.
+    inputfiles : list
+        The task map filepaths. Defaults to the 14-task battery maps.
+    corr_method : str
+        The correlation method. Defaults to 'spearman'.
+    parcels : list
+        Names of the parcels to lesion. Defaults to all parcels.
+    gradient_set : GradientSet
+        Preloaded gradients. Defaults to None (loaded from cache).
+    outpath : str
+        If given, lesioned task maps and gradients are also saved to outpath/<parcel>/.
+    verbose : int
+        The verbosity level.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        Lesioned correlation values, indexed by parcel and task name, one column per gradient.
+    """
+    import pandas as pd
+
+    if gradient_set is None:
+        gradient_set = getGradientSet(mask_name, map_coverage)
+
+    # load every task map once into an in-mask (maps x voxels) matrix
+    task_names, task_matrix = _taskmatrix(mask_name, map_coverage, inputfiles, gradient_set, verbose)
+
+    # resample parcellation once and look up parcel label of each in-mask voxel
+    labels = parcellabels(parcellation, gradient_set)
+
+    names = [_parcelname(x) for x in parcelnames]
+    if parcels is None:
+        parcels = names
+    parcels = [_parcelname(x) for x in parcels]
+
+    frames = []
+    for parcel in tqdm(parcels, disable=verbose == 0):
+        lesion_label = names.index(parcel) + 1
+        lesioned = labels == lesion_label
+
+        # drop lesioned voxels from task maps and gradients and correlate
+        keep = ~lesioned
+        corr = corrMatrix(task_matrix[:, keep], gradient_set.matrix[:, keep], corr_method)
+        frames.append(
+            pd.DataFrame(corr, index=task_names, columns=gradient_set.names).assign(
+                Parcel=parcel
+            )
+        )
+
+        # only write lesioned niftis when asked to
+        if outpath is not None:
+            os.makedirs(os.path.join(outpath, parcel), exist_ok=True)
+            for mapname, vector in zip(
+                task_names + gradient_set.names,
+                np.concatenate([task_matrix, gradient_set.matrix]),
+            ):
+                vector = np.where(lesioned, 0, vector)
+                gradient_set.toimg(vector).to_filename(
+                    os.path.join(outpath, parcel, f"{mapname}.nii.gz")
+                )
+
+    df = pd.concat(frames)
+    df.index.name = "Task_name"
+    df = df.set_index("Parcel", append=True).reorder_levels(["Parcel", "Task_name"])
+    return df
+
+
+def parcelStats(task_matrix: np.ndarray, gradient_matrix: np.ndarray, labels: np.ndarray, n_parcels: int):
+    """
+    This function precomputes the sufficient statistics for Pearson correlation
+    (voxel count, sums, sums of squares and cross-products) of every parcel,
+    plus the whole-brain totals, in a single pass over the voxels.
+
+    Parameters
+    ----------
+    task_matrix : numpy.ndarray
+        (maps x voxels) in-mask task values.
+    gradient_matrix : numpy.ndarray
+        (gradients x voxels) in-mask gradient values.
+    labels : numpy.ndarray
+        Parcel label of every in-mask voxel (0 = no parcel).
+    n_parcels : int
+        Number of parcels (labels 1..n_parcels).
+
+    Returns
+    -------
+    stats : dict
+        'n', 'sx', 'sxx', 'sy', 'syy', 'sxy' arrays with parcels on the first axis,
+        and the same keys prefixed with 'total_' for the whole brain.
+    """
+    from scipy import sparse
 
+    # centre on whole-brain means to limit cancellation in the sums
+    x = task_matrix - task_matrix.mean(axis=1, keepdims=True, dtype=np.float64)
+    y = gradient_matrix - gradient_matrix.mean(axis=1, keepdims=True, dtype=np.float64)
+
+    # sparse (parcels x voxels) indicator matrix, voxels outside the listed parcels are ignored
+    inparcel = (labels >= 1) & (labels <= n_parcels)
+    indicator = sparse.csr_matrix(
+        (np.ones(inparcel.sum()), (labels[inparcel] - 1, np.flatnonzero(inparcel))),
+        shape=(n_parcels, labels.size),
+    )
+
+    stats = {
+        "n": np.asarray(indicator.sum(axis=1)).ravel(),
+        "sx": indicator @ x.T,
+        "sxx": indicator @ (x**2).T,
+        "sy": indicator @ y.T,
+        "syy": indicator @ (y**2).T,
+        # (parcels x maps x gradients) cross-products, one map at a time
+        "sxy": np.stack([indicator @ (row * y).T for row in x], axis=1),
+        "total_n": labels.size,
+        "total_sx": x.sum(axis=1),
+        "total_sxx": (x**2).sum(axis=1),
+        "total_sy": y.sum(axis=1),
+        "total_syy": (y**2).sum(axis=1),
+        "total_sxy": x @ y.T,
+    }
+    return stats
+
+
+def incrementalLesion(
+    parcellation: nib.Nifti1Image,
+    parcelnames: list,
+    mask_name: str,
+    map_coverage: str,
+    inputfiles: list = None,
+    corr_method: str = "pearson",
+    gradient_set=None,
+    verbose: int = 1,
+):
+    """
+    This function computes leave-one-parcel-out (lesioned) state-space coordinates
+    for every parcel from per-parcel sufficient statistics.
+    The statistics are computed once (one pass over the voxels); each lesion is then
+    the whole-brain totals minus that parcel's contribution, so all parcels cost
+    O(parcels) instead of O(parcels x voxels).
+    Pearson values are exact (and Fisher r-to-z transformed, as in corrGrads) and
+    match virtualLesion(..., corr_method='pearson').
+    Spearman is an explicit opt-in and only approximate: voxels are ranked once over
+    the whole brain and the ranks are not recomputed after each parcel is removed,
+    so values differ slightly from virtualLesion(..., corr_method='spearman'), which
+    re-ranks the remaining voxels (use it when exact spearman values are needed).
+
+    Parameters
+    ----------
+    parcellation : nibabel.nifti1.Nifti1Image or Atlas
+        The parcellation map (e.g. from makemaps).
+    parcelnames : list
+        The names of the parcels. Parcel i has label i + 1 in the parcellation (as in lesion).
+    mask_name : str
+        The name of the mask.
+    map_coverage : str
+        The coverage of the map.
+    inputfiles : list
+        The task map filepaths. Defaults to the 14-task battery maps.
+    corr_method : str
+        'pearson' (exact) or 'spearman' (approximate, whole-brain ranks). Defaults to 'pearson'.
+    gradient_set : GradientSet
+        Preloaded gradients. Defaults to None (loaded from cache).
+    verbose : int
+        The verbosity level.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        Lesioned correlation values, indexed by parcel and task name, one column per gradient
+        (same layout as virtualLesion).
+    """
+    import pandas as pd
+    from scipy.stats import rankdata
+
+    if corr_method not in ("pearson", "spearman"):
+        raise ValueError(
+            f"incrementalLesion computes pearson (exact) or spearman (approximate) correlations, "
+            f"not {corr_method!r}; use virtualLesion for kendall lesions"
+        )
+    if gradient_set is None:
+        gradient_set = getGradientSet(mask_name, map_coverage)
+
+    task_names, task_matrix = _taskmatrix(mask_name, map_coverage, inputfiles, gradient_set, verbose)
+    gradient_matrix = gradient_set.matrix
+    if corr_method == "spearman":
+        # approximate: ranked once over the whole brain, the same ranks are reused for every lesion
+        task_matrix = rankdata(task_matrix, axis=1)
+        gradient_matrix = rankdata(gradient_matrix, axis=1)
+
+    labels = parcellabels(parcellation, gradient_set)
+    names = [_parcelname(x) for x in parcelnames]
+    stats = parcelStats(task_matrix, gradient_matrix, labels, len(names))
+
+    # remove each parcel's contribution from the whole-brain totals (broadcast over parcels)
+    n = stats["total_n"] - stats["n"][:, None, None]
+    sx = stats["total_sx"][None, :, None] - stats["sx"][:, :, None]
+    sxx = stats["total_sxx"][None, :, None] - stats["sxx"][:, :, None]
+    sy = stats["total_sy"][None, None, :] - stats["sy"][:, None, :]
+    syy = stats["total_syy"][None, None, :] - stats["syy"][:, None, :]
+    sxy = stats["total_sxy"][None, :, :] - stats["sxy"]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        corr = (n * sxy - sx * sy) / np.sqrt((n * sxx - sx**2) * (n * syy - sy**2))
+    np.clip(corr, -1, 1, out=corr)
+    if corr_method == "pearson":
+        # apply fishers-r-to-z transformation to correlation values
+        corr = np.arctanh(corr)
+
+    index = pd.MultiIndex.from_product([names, task_names], names=["Parcel", "Task_name"])
+    return pd.DataFrame(
+        corr.reshape(-1, len(gradient_set.names)), index=index, columns=gradient_set.names
+    )
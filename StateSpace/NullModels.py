@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
+"""
+Permutation null models for state-space coordinates.
+
+nullPvalues gives two-sided p-values for the correlation of each input map
+with each gradient, from n_perm surrogate maps:
+
+    permute  in-mask voxels shuffled at random (parcels, for a ParcelGradientSet:
+             a parcel shuffle)
+    block    cubes of block_size^3 voxels shuffled as units among blocks of
+             the same size (blocks at the mask edge are partial), which keeps
+             local spatial autocorrelation within blocks
+
+Ranking and standardizing (see prepareMatrix) do not change under a
+permutation, so inputs and gradients are prepared once. The surrogates are
+made by shuffling the prepared gradients instead of every input: corr(x[p], g)
+is corr(x, g[p^-1]), and p^-1 is as random as p. All maps are then
+correlated with a batch of shuffled gradients in one matrix product. Batches
+of chunk_size permutations bound memory and run in n_jobs threads. Every
+permutation has its own seed from seed, so results do not depend on n_jobs
+or chunk_size.
+
+corrGroup and corrInd return these p-values next to their DataFrames when
+given n_perm.
+
+"""
+
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from StateSpace.CorrelateTasksWithGradients import ParcelGradientSet, prepareMatrix
+
+NULL_MODELS = ('permute', 'block')
+
+# correlation methods with a permutation-invariant preparation (see prepareMatrix)
+NULL_CORR_METHODS = ('spearman', 'pearson')
+
+# p-value ties: null correlations within this of the observed one count as exceeding it
+TIE_TOLERANCE = 1e-12
+
+def blockIndex(mask_index, block_size=4):
+    """
+    Group in-mask voxels into cubic blocks.
+
+    Args:
+        mask_index (numpy array): Boolean 3-d array marking in-mask voxels.
+        block_size (int, optional): Block edge length in voxels. Defaults to 4.
+
+    Returns:
+        tuple: In-mask voxel order grouped by block, and the (n_blocks + 1) block bounds into it.
+    """
+    ijk = np.array(np.nonzero(mask_index)) // block_size
+    n_blocks = ijk.max(axis=1) + 1
+    block = np.ravel_multi_index(tuple(ijk), tuple(n_blocks))
+    order = np.argsort(block, kind='stable')
+    bounds = np.flatnonzero(np.diff(block[order], prepend=-1, append=-1))
+    return order, bounds
+
+def surrogateIndex(rng, n_voxels, blocks=None):
+    """
+    Return source indices of one surrogate: surrogate = vector[index].
+
+    A block permutation moves every block whole, with its voxels in their
+    order, into the place of another block of the same size. Blocks whose
+    size no other block shares (rare partial blocks at the mask edge) cannot
+    move whole, so their voxels are shuffled among themselves.
+
+    Args:
+        rng (numpy Generator): Random number generator.
+        n_voxels (int): Length of the vectors.
+        blocks (tuple, optional): Output of blockIndex for a block permutation. Defaults to None (voxels shuffled).
+
+    Returns:
+        numpy array: Permutation of range(n_voxels).
+    """
+    if blocks is None:
+        return rng.permutation(n_voxels)
+    order, bounds = blocks
+    sizes = np.diff(bounds)
+    # source block of every block, shuffled within each size class
+    source = np.arange(len(sizes))
+    remainder = []
+    for size in np.unique(sizes):
+        members = np.flatnonzero(sizes == size)
+        if len(members) > 1:
+            source[members] = rng.permutation(members)
+        else:
+            remainder.append(members[0])
+    # voxel k of block b is taken from voxel k of its source block (same size, so blocks stay whole)
+    offsets = np.arange(len(order)) - np.repeat(bounds[:-1], sizes)
+    index = np.empty(n_voxels, dtype=np.intp)
+    index[order] = order[np.repeat(bounds[:-1][source], sizes) + offsets]
+    if remainder:
+        voxels = np.concatenate([order[bounds[b]:bounds[b + 1]] for b in remainder])
+        index[voxels] = rng.permutation(voxels)
+    return index
+
+def _exceedances(input_prepared, gradient_prepared, observed, seeds, blocks):
+    # number of surrogates per (map, gradient) with |null r| >= |observed r|, for one batch of permutations
+    indices = np.stack([surrogateIndex(np.random.default_rng(seed), gradient_prepared.shape[1], blocks) for seed in seeds])
+    # (n_gradients x n_perm x n_voxels) shuffled gradients, all maps correlated in one product
+    shuffled = gradient_prepared[:, indices].reshape(-1, gradient_prepared.shape[1])
+    null = (input_prepared @ shuffled.T).reshape(len(input_prepared), gradient_prepared.shape[0], len(seeds))
+    return np.sum(np.abs(null) >= np.abs(observed)[..., np.newaxis] - TIE_TOLERANCE, axis=2)
+
+def nullPvalues(input_matrix, gradient_set, n_perm=1000, corr_method='spearman', null_model='permute',
+                block_size=4, seed=None, chunk_size=20, n_jobs=1):
+    """
+    Return two-sided permutation p-values of the correlation of each input map with each gradient.
+
+    Args:
+        input_matrix (numpy array): (n_maps x n_voxels) in-mask input maps (or a single 1-d map).
+        gradient_set (GradientSet): Gradients the maps are correlated with (a ParcelGradientSet shuffles parcels).
+        n_perm (int, optional): Number of surrogates. Defaults to 1000.
+        corr_method (str, optional): 'spearman' or 'pearson'. Defaults to 'spearman'.
+        null_model (str, optional): 'permute' or 'block' (voxel resolution only). Defaults to 'permute'.
+        block_size (int, optional): Block edge length in voxels for the 'block' model. Defaults to 4.
+        seed (int, optional): Seed of the random number generator. Defaults to None (fresh entropy).
+        chunk_size (int, optional): Permutations per batch (caps memory at about
+            chunk_size x n_gradients x n_voxels float64 per thread). Defaults to 20.
+        n_jobs (int, optional): Number of threads running batches (-1 for all cores). Defaults to 1.
+
+    Returns:
+        numpy array: (n_maps x n_gradients) p-values, (1 + exceedances) / (1 + n_perm).
+    """
+    if null_model not in NULL_MODELS:
+        raise ValueError(f"null_model must be one of {NULL_MODELS}, not {null_model!r}")
+    if corr_method not in NULL_CORR_METHODS:
+        raise ValueError(f"Null models support corr_method {NULL_CORR_METHODS}, not {corr_method!r}")
+    if int(n_perm) != n_perm or n_perm < 1:
+        raise ValueError(f'n_perm must be a positive integer, not {n_perm!r}')
+    parcels = isinstance(gradient_set, ParcelGradientSet)
+    if parcels and null_model == 'block':
+        raise ValueError("null_model 'block' is for voxel resolution, use 'permute' (parcel shuffle) with a parcellation")
+
+    # prepare inputs and gradients once (rank and standardize), in parcel space for parcel-resolution sets
+    input_matrix = np.atleast_2d(input_matrix)
+    input_prepared = prepareMatrix(gradient_set.reduce(input_matrix) if parcels else input_matrix, corr_method)
+    gradient_prepared = gradient_set.prepared(corr_method)
+    observed = np.clip(input_prepared @ gradient_prepared.T, -1, 1)
+
+    blocks = blockIndex(gradient_set.mask_index, block_size) if null_model == 'block' else None
+    seeds = np.random.SeedSequence(seed).spawn(int(n_perm))
+    batches = [seeds[start:start + chunk_size] for start in range(0, len(seeds), chunk_size)]
+
+    if n_jobs is None or n_jobs < 0:
+        n_jobs = os.cpu_count()
+    if n_jobs == 1 or len(batches) < 2:
+        counts = sum(_exceedances(input_prepared, gradient_prepared, observed, batch, blocks) for batch in batches)
+    else:
+        # numpy releases the GIL in the gather and matrix product, so threads share the prepared arrays
+        with ThreadPoolExecutor(max_workers=min(n_jobs, len(batches))) as executor:
+            counts = sum(executor.map(lambda batch: _exceedances(input_prepared, gradient_prepared, observed, batch, blocks),
+                                      batches))
+    pvalues = (1 + counts) / (1 + n_perm)
+    # constant maps have no correlation to test
+    pvalues[np.isnan(observed)] = np.nan
+    return pvalues
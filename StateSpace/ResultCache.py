@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
+"""
+Opt-in on-disk cache of per-map gradient correlations.
+
+corrGroup and corrInd accept cache=<directory> (or a ResultCache). Each input
+map's correlation values are stored under a key made from:
+
+    - the input file, by size + modification time ('stat', default) or by a
+      sha256 of its content ('hash', survives copies and touches)
+    - the mask (name and a digest of its voxels) and map_coverage
+    - the gradients (names and a digest of their values and dtype)
+    - corr_method and legacy_mask
+    - the StateSpace version and NUMERICS_VERSION
+
+so re-running an analysis only correlates maps that are new or changed.
+Entries can be pruned by total size and/or age, from python or the command line:
+
+    statespace cache info <cachedir>
+    statespace cache prune <cachedir> --max-mb 500 --max-days 30
+    statespace cache clear <cachedir>
+
+(or python -m StateSpace.ResultCache with the same arguments).
+
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+import time
+import numpy as np
+
+# cache entry file extension (one .npz per map)
+ENTRY_EXT = '.npz'
+
+# bytes read at once when hashing input files
+HASH_BLOCK = 1 << 20
+
+KEY_METHODS = ('stat', 'hash')
+
+CACHE_COMMANDS = ('info', 'prune', 'clear')
+
+# version of the correlation numerics, part of every key: bump it whenever a change
+# alters correlation values, so entries from older code are not served (the package
+# version alone does not change for source checkouts)
+NUMERICS_VERSION = 2
+
+def packageversion():
+    """
+    Return the installed StateSpace version ('unknown' if not installed).
+    """
+    from importlib.metadata import version, PackageNotFoundError
+    try:
+        return version('StateSpace')
+    except PackageNotFoundError:
+        return 'unknown'
+
+def filehash(path):
+    """
+    Return the sha256 hex digest of a file's content.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def gradientdigest(gradient_set):
+    """
+    Return the sha1 hex digest of a gradient set's values (with their dtype and shape).
+    """
+    matrix = np.ascontiguousarray(gradient_set.matrix)
+    digest = hashlib.sha1(f'{matrix.dtype.str}{matrix.shape}'.encode())
+    digest.update(matrix.tobytes())
+    return digest.hexdigest()
+
+class ResultCache:
+    """
+    Directory of cached per-map correlation values.
+
+    Args:
+        cachedir (str): Cache directory (created if needed).
+        key_method (str, optional): Identify inputs by 'stat' (absolute path, size and mtime)
+            or 'hash' (sha256 of the content). Defaults to 'stat'.
+    """
+
+    def __init__(self, cachedir, key_method='stat'):
+        if key_method not in KEY_METHODS:
+            raise ValueError(f"Unknown key_method '{key_method}', expected one of {KEY_METHODS}")
+        self.cachedir = cachedir
+        self.key_method = key_method
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cachedir, exist_ok=True)
+
+    def context(self, gradient_set, corr_method, legacy_mask=False):
+        """
+        Return the part of the key shared by all maps of one analysis.
+
+        Args:
+            gradient_set (GradientSet): Gradients the maps are correlated with.
+            corr_method (str): The correlation method.
+            legacy_mask (bool, optional): Whether whole-volume masking is used. Defaults to False.
+
+        Returns:
+            dict: Mask, coverage, gradients (and parcellation), method, package and numerics version.
+        """
+        context = {'mask_name': str(gradient_set.mask_name),
+                   'mask_digest': hashlib.sha1(np.packbits(gradient_set.mask_index).tobytes()).hexdigest(),
+                   'map_coverage': gradient_set.map_coverage,
+                   'gradients': list(gradient_set.names),
+                   'gradients_digest': gradientdigest(gradient_set),
+                   'corr_method': corr_method,
+                   'legacy_mask': bool(legacy_mask),
+                   'version': packageversion(),
+                   'numerics_version': NUMERICS_VERSION}
+        # parcel-resolution gradient sets (ParcelGradientSet) give different values
+        if getattr(gradient_set, 'labels', None) is not None:
+            context['parcels_digest'] = hashlib.sha1(np.ascontiguousarray(gradient_set.labels).tobytes()).hexdigest()
+        return context
+
+    def key(self, path, context):
+        """
+        Return the cache key of an input file within an analysis context.
+
+        Args:
+            path (str): Input map filepath.
+            context (dict): Output of context().
+
+        Returns:
+            str: Hex digest identifying the entry.
+        """
+        if self.key_method == 'hash':
+            source = {'sha256': filehash(path)}
+        else:
+            stat = os.stat(path)
+            source = {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        return hashlib.sha256(json.dumps([source, context], sort_keys=True).encode()).hexdigest()
+
+    def _entrypath(self, key):
+        return os.path.join(self.cachedir, key + ENTRY_EXT)
+
+    def get(self, key):
+        """
+        Return cached values for key, or None if missing (touches the entry, for least-recently-used pruning).
+        """
+        entry = self._entrypath(key)
+        try:
+            with np.load(entry) as npz:
+                values = npz['values']
+        except (OSError, KeyError, ValueError):
+            self.misses += 1
+            return None
+        os.utime(entry)
+        self.hits += 1
+        return values
+
+    def put(self, key, values, **meta):
+        """
+        Store values under key, with meta (e.g. input path) kept for inspection.
+        """
+        # write to a temporary file first so readers never see partial entries
+        fd, tmp = tempfile.mkstemp(dir=self.cachedir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, values=np.asarray(values), meta=np.array(json.dumps(meta)))
+            os.replace(tmp, self._entrypath(key))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def entries(self):
+        """
+        Return one row per cache entry (key, bytes, last use and stored meta).
+
+        Returns:
+            pandas.DataFrame: Entries, most recently used first.
+        """
+        import pandas as pd
+
+        rows = []
+        for name in os.listdir(self.cachedir):
+            if not name.endswith(ENTRY_EXT):
+                continue
+            entry = os.path.join(self.cachedir, name)
+            stat = os.stat(entry)
+            row = {'key': name[:-len(ENTRY_EXT)], 'bytes': stat.st_size, 'last_used': pd.Timestamp(stat.st_mtime, unit='s')}
+            try:
+                with np.load(entry) as npz:
+                    row.update(json.loads(str(npz['meta'])))
+            except (OSError, KeyError, ValueError):
+                pass
+            rows.append(row)
+        df = pd.DataFrame(rows, columns=['key', 'bytes', 'last_used'] if not rows else None)
+        return df.sort_values('last_used', ascending=False, ignore_index=True)
+
+    def prune(self, max_bytes=None, max_age=None):
+        """
+        Remove entries older than max_age, then least recently used entries until the cache fits in max_bytes.
+
+        Args:
+            max_bytes (int, optional): Maximum total size in bytes. Defaults to None (no limit).
+            max_age (float, optional): Maximum time since last use in seconds. Defaults to None (no limit).
+
+        Returns:
+            int: Number of entries removed.
+        """
+        entries = []
+        for name in os.listdir(self.cachedir):
+            if name.endswith(ENTRY_EXT):
+                stat = os.stat(os.path.join(self.cachedir, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        # most recently used first
+        entries.sort(reverse=True)
+
+        now = time.time()
+        total = 0
+        removed = 0
+        for mtime, size, name in entries:
+            too_old = max_age is not None and now - mtime > max_age
+            too_big = max_bytes is not None and total + size > max_bytes
+            if too_old or too_big:
+                os.remove(os.path.join(self.cachedir, name))
+                removed += 1
+            else:
+                total += size
+        return removed
+
+    def clear(self):
+        """
+        Remove all entries.
+
+        Returns:
+            int: Number of entries removed.
+        """
+        return self.prune(max_bytes=0)
+
+def opencache(cache):
+    """
+    Return cache as a ResultCache (None, a ResultCache or a directory path).
+    """
+    if cache is None or isinstance(cache, ResultCache):
+        return cache
+    return ResultCache(cache)
+
+def addcachearguments(parser):
+    """
+    Add the cache command arguments to an argparse parser (used here and by the statespace command line).
+    """
+    parser.add_argument('cache_command', metavar='command', choices=CACHE_COMMANDS, help='info, prune or clear')
+    parser.add_argument('cachedir', help='cache directory')
+    parser.add_argument('--max-mb', dest='max_mb', type=float, help='prune: keep at most this many megabytes (least recently used removed first)')
+    parser.add_argument('--max-days', dest='max_days', type=float, help='prune: remove entries not used for this many days')
+
+def runcache(command, cachedir, max_mb=None, max_days=None):
+    """
+    Run a cache command: print a summary of the entries ('info'), prune them or clear them.
+
+    Args:
+        command (str): 'info', 'prune' or 'clear'.
+        cachedir (str): Cache directory.
+        max_mb (float, optional): prune: keep at most this many megabytes. Defaults to None.
+        max_days (float, optional): prune: remove entries not used for this many days. Defaults to None.
+
+    Returns:
+        int: Number of entries listed or removed.
+    """
+    import pandas as pd
+
+    if command not in CACHE_COMMANDS:
+        raise ValueError(f"Unknown cache command '{command}', expected one of {CACHE_COMMANDS}")
+    if not os.path.isdir(cachedir):
+        raise ValueError(f'{cachedir} is not a directory')
+    cache = ResultCache(cachedir)
+
+    if command == 'info':
+        entries = cache.entries()
+        print (f"{len(entries)} entries, {entries['bytes'].sum() / 1e6:.2f} MB in {cachedir}")
+        if len(entries):
+            columns = [col for col in ['last_used', 'corr_method', 'mask_name', 'map_coverage', 'path'] if col in entries]
+            with pd.option_context('display.max_colwidth', 80, 'display.width', 200):
+                print (entries[columns].to_string(index=False))
+        return len(entries)
+    if command == 'prune':
+        if max_mb is None and max_days is None:
+            raise ValueError('prune needs --max-mb and/or --max-days')
+        removed = cache.prune(max_bytes=None if max_mb is None else int(max_mb * 1e6),
+                              max_age=None if max_days is None else max_days * 86400)
+    else:
+        removed = cache.clear()
+    print (f"Removed {removed} entries")
+    return removed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Inspect and prune a StateSpace result cache.')
+    addcachearguments(parser)
+    args = parser.parse_args(argv)
+    try:
+        runcache(args.cache_command, args.cachedir, args.max_mb, args.max_days)
+    except ValueError as e:
+        parser.error(str(e))
+
+if __name__ == '__main__':
+    main()
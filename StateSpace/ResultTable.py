@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
+"""
+Array-backed container for gradient scores.
+
+ResultTable holds correlation values in one preallocated (n_rows x n_gradients)
+array, with one id (task, subject, run, TR, ...) per row, and builds the wide
+and long DataFrames straight from it. Rows can be added one map at a time or
+as blocks (e.g. all TRs of a run). Duplicate ids raise a ValueError rather
+than being averaged.
+
+"""
+
+import numpy as np
+
+from StateSpace.ResultWriter import longFrame
+
+def uniqueids(ids):
+    """
+    Return row ids as a DataFrame, raising ValueError if any id is duplicated.
+
+    Args:
+        ids (dict): One sequence of ids per id column (all the same length).
+
+    Returns:
+        pandas.DataFrame: One column per id column, one row per id.
+    """
+    import pandas as pd
+
+    ids = pd.DataFrame(ids).infer_objects()
+    duplicated = ids.duplicated(keep=False)
+    if duplicated.any():
+        first = ids[duplicated].iloc[0].to_dict()
+        raise ValueError(f'{int(duplicated.sum())} rows have duplicate ids (e.g. {first}); '
+                         'make ids unique (e.g. with a runstring) instead of relying on averaging')
+    return ids
+
+class ResultTable:
+    """
+    Gradient scores with their row ids, stored in a preallocated array.
+
+    Args:
+        id_columns (list): Names of the id columns (e.g. ['Task_name', 'subid']).
+        gradient_names (list): Names of the gradients (one value column each).
+        n_rows (int, optional): Number of rows to preallocate (grown if exceeded). Defaults to 0.
+        dtype (numpy dtype, optional): dtype of the values. Defaults to float64.
+
+    Attributes:
+        values (numpy array): (capacity x n_gradients) values, the first n_rows are filled.
+        ids (dict): One (capacity,) object array of ids per id column.
+        n_rows (int): Number of rows added.
+    """
+
+    def __init__(self, id_columns, gradient_names, n_rows=0, dtype=np.float64):
+        self.id_columns = list(id_columns)
+        self.gradient_names = list(gradient_names)
+        self.values = np.empty((n_rows, len(self.gradient_names)), dtype=dtype)
+        self.ids = {col: np.empty(n_rows, dtype=object) for col in self.id_columns}
+        self.n_rows = 0
+
+    def __len__(self):
+        return self.n_rows
+
+    def _reserve(self, n):
+        # grow capacity (doubling) so at least n more rows fit
+        capacity = len(self.values)
+        if self.n_rows + n <= capacity:
+            return
+        capacity = max(self.n_rows + n, 2 * capacity)
+        values = np.empty((capacity, self.values.shape[1]), dtype=self.values.dtype)
+        values[:self.n_rows] = self.values[:self.n_rows]
+        self.values = values
+        for col in self.id_columns:
+            ids = np.empty(capacity, dtype=object)
+            ids[:self.n_rows] = self.ids[col][:self.n_rows]
+            self.ids[col] = ids
+
+    def add(self, values, **ids):
+        """
+        Add one row (1-d values) or a block of rows (2-d values).
+
+        Args:
+            values (numpy array): (n_gradients,) or (n x n_gradients) correlation values.
+            **ids: One value per id column, either a scalar (shared by the block) or an array of length n.
+        """
+        missing = set(self.id_columns) - set(ids)
+        if missing:
+            raise ValueError(f'Missing id columns {sorted(missing)}')
+        values = np.atleast_2d(values)
+        n = len(values)
+        self._reserve(n)
+        rows = slice(self.n_rows, self.n_rows + n)
+        self.values[rows] = values
+        for col in self.id_columns:
+            self.ids[col][rows] = ids[col]
+        self.n_rows += n
+
+    def idframe(self):
+        """
+        Return the row ids as a DataFrame, raising ValueError if any id is duplicated.
+
+        Returns:
+            pandas.DataFrame: One column per id column, one row per added row.
+        """
+        return uniqueids({col: self.ids[col][:self.n_rows] for col in self.id_columns})
+
+    def _frame(self, ids, order):
+        import pandas as pd
+
+        # id columns plus one value column per gradient, rows in the given order
+        frame = ids.take(order).reset_index(drop=True)
+        values = pd.DataFrame(self.values[order], columns=pd.Index(self.gradient_names, name='Gradient'))
+        frame = pd.concat([frame, values], axis=1)
+        frame.columns.name = 'Gradient'
+        return frame
+
+    def wide(self):
+        """
+        Return the wide DataFrame, sorted by the id columns.
+
+        Returns:
+            pandas.DataFrame: Id columns followed by one column per gradient.
+        """
+        ids = self.idframe()
+        order = ids.sort_values(self.id_columns, kind='stable').index.to_numpy()
+        return self._frame(ids, order)
+
+    def long(self):
+        """
+        Return the long DataFrame, rows grouped by id column in order of first appearance.
+
+        Returns:
+            pandas.DataFrame: Id columns, 'Gradient' and 'Correlation', one row per id and gradient.
+        """
+        import pandas as pd
+
+        ids = self.idframe()
+        # code each id prefix (first column, first two columns, ...) by first appearance and sort on the codes
+        codes = [pd.MultiIndex.from_frame(ids[self.id_columns[:level + 1]]).factorize()[0]
+                 for level in range(len(self.id_columns))]
+        order = np.lexsort(codes[::-1]) if codes else np.arange(self.n_rows)
+        return longFrame(self._frame(ids, order), self.id_columns, self.gradient_names)
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
+"""
+Writers for gradient score tables (csv, parquet, feather or hdf5).
+
+ResultWriter appends DataFrames of gradient scores to one output file. In
+parquet and feather the id columns (task, subject, run, gradient) are stored
+as categoricals, so long-format tables stay small and are quick to read back.
+
+    csv      appended as text on every call (default, same files as before)
+    parquet  appended as one row group per call (requires pyarrow)
+    hdf5     appended to a 'table' on every call (requires tables); id columns
+             are stored as strings, as categoricals cannot be appended with new
+             categories
+    feather  collected in memory and written on close (requires pyarrow): the
+             format cannot be appended to, so nothing is on disk until the end
+             and memory grows with the rows. Use parquet or hdf5 to stream.
+
+longFrame() turns a wide table (one column per gradient) into the long format
+straight from its numpy values.
+
+"""
+
+import importlib
+import os
+import numpy as np
+
+# file extension of each output format
+EXTENSIONS = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather', 'hdf5': '.h5'}
+
+# optional module (and pip package) needed by each output format
+REQUIRES = {'parquet': ('pyarrow', 'pyarrow'), 'feather': ('pyarrow', 'pyarrow'), 'hdf5': ('tables', 'tables')}
+
+# id columns stored as categoricals in the typed formats
+CATEGORICAL_COLUMNS = ('Task_name', 'subid', 'runid', 'Gradient')
+
+# key of the table in hdf5 output
+HDF_KEY = 'gradscores'
+
+# minimum width of string (id) columns in hdf5 output, fixed by the first append
+HDF_STRING_SIZE = 128
+
+def _require(output_format):
+    """
+    Import the optional module output_format needs, with an install hint if it is missing.
+    """
+    if output_format not in REQUIRES:
+        return None
+    module, package = REQUIRES[output_format]
+    try:
+        return importlib.import_module(module)
+    except ImportError:
+        raise ImportError(f"Writing {output_format} output requires {module}: pip install {package}") from None
+
+def outputpath(outputdir, stem, output_format='csv'):
+    """
+    Return the path of an output file, with the extension of output_format.
+
+    Args:
+        outputdir (str): The output directory.
+        stem (str): File name without extension.
+        output_format (str, optional): 'csv', 'parquet', 'feather' or 'hdf5'. Defaults to 'csv'.
+
+    Returns:
+        str: The output path.
+    """
+    if output_format not in EXTENSIONS:
+        raise ValueError(f"Unknown output format '{output_format}', expected one of {list(EXTENSIONS)}")
+    return os.path.join(outputdir, stem + EXTENSIONS[output_format])
+
+def categorize(df, columns=CATEGORICAL_COLUMNS):
+    """
+    Return df with the given id columns (those present) converted to categoricals.
+    """
+    import pandas as pd
+
+    columns = [col for col in columns if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype)]
+    if not columns:
+        return df
+    return df.astype({col: 'category' for col in columns})
+
+def longFrame(df_wide, id_columns, gradient_names, categorical=False):
+    """
+    Return a wide gradient score table in long format, built from its numpy values.
+
+    Args:
+        df_wide (pandas.DataFrame): Table with the id columns and one column per gradient.
+        id_columns (list): Names of the id columns (e.g. ['Task_name', 'subid']).
+        gradient_names (list): Names of the gradient columns, in output order.
+        categorical (bool, optional): Store the Gradient column as a categorical. Defaults to False.
+
+    Returns:
+        pandas.DataFrame: One row per id and gradient (id columns, 'Gradient', 'Correlation').
+    """
+    import pandas as pd
+
+    values = df_wide[list(gradient_names)].to_numpy()
+    n_rows, n_grads = values.shape
+
+    data = {col: np.repeat(df_wide[col].to_numpy(), n_grads) for col in id_columns}
+    codes = np.tile(np.arange(n_grads), n_rows)
+    if categorical:
+        data['Gradient'] = pd.Categorical.from_codes(codes, categories=list(gradient_names))
+    else:
+        data['Gradient'] = np.asarray(gradient_names, dtype=object)[codes]
+    data['Correlation'] = values.ravel()
+    return pd.DataFrame(data)
+
+class ResultWriter:
+    """
+    Append gradient score tables to one csv, parquet, feather or hdf5 file.
+
+    csv, parquet and hdf5 rows are on disk after every append. Feather files
+    cannot be appended to, so feather rows are held in memory and written on close.
+
+    Use as a context manager (or call close()) so the file is finalised:
+
+        with ResultWriter('scores.parquet') as writer:
+            for df in tables:
+                writer.append(df)
+
+    Args:
+        path (str): Output path.
+        output_format (str, optional): 'csv', 'parquet', 'feather' or 'hdf5'. Defaults to None (from the extension of path).
+        categorical (tuple, optional): Id columns stored as categoricals in parquet and feather. Defaults to CATEGORICAL_COLUMNS.
+    """
+
+    def __init__(self, path, output_format=None, categorical=CATEGORICAL_COLUMNS):
+        if output_format is None:
+            ext = os.path.splitext(path)[1]
+            matches = [fmt for fmt, fmt_ext in EXTENSIONS.items() if fmt_ext == ext]
+            output_format = matches[0] if matches else 'csv'
+        if output_format not in EXTENSIONS:
+            raise ValueError(f"Unknown output format '{output_format}', expected one of {list(EXTENSIONS)}")
+        self.path = path
+        self.output_format = output_format
+        self.categorical = tuple(categorical)
+        self.n_rows = 0
+        # fail before any results are computed if the optional dependency is missing
+        self._module = _require(output_format)
+        self._writer = None
+        self._store = None
+        self._frames = []
+
+    def append(self, df):
+        """
+        Append the rows of df (same columns on every call).
+
+        Args:
+            df (pandas.DataFrame): Rows to write.
+        """
+        if self.output_format == 'csv':
+            df.to_csv(self.path, mode='w' if self.n_rows == 0 else 'a', header=self.n_rows == 0, index=False)
+        elif self.output_format == 'parquet':
+            import pyarrow.parquet as pq
+            table = self._module.Table.from_pandas(categorize(df, self.categorical), preserve_index=False)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self.path, table.schema)
+            self._writer.write_table(table)
+        elif self.output_format == 'hdf5':
+            import pandas as pd
+            strings = [col for col in df.columns if pd.api.types.is_string_dtype(df[col])]
+            if self._store is None:
+                self._store = pd.HDFStore(self.path, mode='w')
+                # string columns get a fixed width on the first append, leave room for longer ids
+                self._itemsize = {col: max(HDF_STRING_SIZE, int(df[col].astype(str).str.len().max()) if len(df) else 0) for col in strings}
+            self._store.append(HDF_KEY, df, format='table', index=False, data_columns=list(self._itemsize),
+                               min_itemsize=self._itemsize)
+            self._store.flush()
+        else:
+            # feather cannot be appended to, the table is written once with categories over all rows
+            self._frames.append(df)
+        self.n_rows += len(df)
+
+    def close(self):
+        """
+        Finalise the output file.
+        """
+        import pandas as pd
+
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+        if self._frames:
+            categorize(pd.concat(self._frames, ignore_index=True), self.categorical).to_feather(self.path)
+            self._frames = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def writeResults(df, outputdir, stem, output_format='csv'):
+    """
+    Write one gradient score table to outputdir/stem.<ext>.
+
+    Args:
+        df (pandas.DataFrame): Table to write.
+        outputdir (str): The output directory.
+        stem (str): File name without extension.
+        output_format (str, optional): 'csv', 'parquet', 'feather' or 'hdf5'. Defaults to 'csv'.
+
+    Returns:
+        str: The path written to.
+    """
+    path = outputpath(outputdir, stem, output_format)
+    with ResultWriter(path, output_format) as writer:
+        writer.append(df)
+    return path
@@ -1,12 +1,17 @@
 import nibabel as nib
-from nilearn import image as nimg
-import glob
-from scipy.stats import spearmanr, pearsonr
 import os 
-import pandas as pd
-import numpy as np
-import pkg_resources
-from scipy.stats import zscore
+
+def datapath(subdir=''):
+    """
+    Return the absolute path of bundled package data (e.g. datapath('data/gradients')).
+
+    Uses importlib.resources, falling back to the package directory on python < 3.9.
+    """
+    try:
+        from importlib.resources import files
+    except ImportError:
+        return os.path.join(os.path.dirname(os.path.abspath(__file__)), subdir)
+    return str(files('StateSpace').joinpath(subdir))
 
 def checkLength(input_files):
     # Check if there are any input files
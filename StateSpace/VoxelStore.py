@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
+"""
+On-disk, memory-mapped store of in-mask voxels.
+
+buildStore() decompresses a list of input maps (3-d) or runs (4-d) once and
+writes their in-mask voxels to a single .npy matrix (one row per map / TR),
+together with an index of the input paths (and their subject, task and run
+ids, so rows can be selected without re-parsing paths). VoxelStore reads it back with
+np.load(mmap_mode='r'), so repeated analyses (different correlation methods,
+worker processes, ...) read the voxels zero-copy instead of re-decompressing
+the nifti files.
+
+The correlate functions (corrGroup, corrInd, corrIndTimeCourse) accept a
+VoxelStore in place of a list of file paths.
+
+"""
+
+import os
+import json
+import numpy as np
+import nibabel as nib
+
+VOXELS_FILE = 'voxels.npy'
+MASK_FILE = 'mask.npy'
+INDEX_FILE = 'index.csv'
+META_FILE = 'store.json'
+
+class VoxelStore:
+    """
+    Read-only, memory-mapped store of in-mask voxels made by buildStore.
+
+    Args:
+        storedir (str): Directory the store was written to.
+
+    Attributes:
+        data (numpy memmap): (n_rows x n_voxels) in-mask voxels, one row per map / TR.
+        index (pandas.DataFrame): One row per input with its path, row range (start, stop) and,
+            if buildStore was given the id strings, its 'subject', 'task' and 'run' ids.
+        mask_index (numpy array): Boolean 3-d array of in-mask voxels used to build the store.
+        mask_name (str): Name of the mask used to build the store.
+        map_coverage (str): The map coverage used to build the store.
+    """
+
+    def __init__(self, storedir):
+        import pandas as pd
+
+        self.storedir = storedir
+        with open(os.path.join(storedir, META_FILE)) as f:
+            meta = json.load(f)
+        self.mask_name = meta['mask_name']
+        self.map_coverage = meta['map_coverage']
+        self.index = pd.read_csv(os.path.join(storedir, INDEX_FILE))
+        self.mask_index = np.load(os.path.join(storedir, MASK_FILE))
+        self.data = np.load(os.path.join(storedir, VOXELS_FILE), mmap_mode='r')
+        # row ranges as plain arrays, so entry lookups do not go through pandas
+        self._ndims = self.index['ndim'].to_numpy()
+        self._starts = self.index['start'].to_numpy()
+        self._stops = self.index['stop'].to_numpy()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, entry):
+        """
+        Return in-mask voxels of one input (zero-copy view of the memmap).
+
+        Args:
+            entry (int): Position of the input in the index.
+
+        Returns:
+            numpy array: 1-d vector for a 3-d map, (n_TRs x n_voxels) matrix for a 4-d run.
+        """
+        if self._ndims[entry] == 3:
+            return self.data[self._starts[entry]]
+        return self.data[self._starts[entry]:self._stops[entry]]
+
+    def __reduce__(self):
+        # pickle the path only, worker processes open each store once (see openStore)
+        return (openStore, (self.storedir,))
+
+    @property
+    def paths(self):
+        return self.index['path'].tolist()
+
+    def checkmask(self, gradient_set):
+        """
+        Raise ValueError if the store was built with a different mask than gradient_set.
+
+        Args:
+            gradient_set (GradientSet): Gradients the stored voxels will be correlated with.
+        """
+        if not np.array_equal(self.mask_index, gradient_set.mask_index):
+            raise ValueError(f'VoxelStore {self.storedir} was built with mask {self.mask_name}, '
+                             f'which does not match the gradient set mask {gradient_set.mask_name}')
+
+# stores opened in this process, by directory and build time (see openStore)
+_open_stores = {}
+
+def openStore(storedir):
+    """
+    Return the VoxelStore in storedir, opened once per process.
+
+    Worker processes unpickle stores through this, so the index and mask are
+    read once per worker rather than once per item. A store rebuilt in the
+    same directory is opened again.
+
+    Args:
+        storedir (str): Directory the store was written to.
+
+    Returns:
+        VoxelStore: The store, opened for reading.
+    """
+    key = (os.path.abspath(storedir), os.stat(os.path.join(storedir, META_FILE)).st_mtime_ns)
+    if key not in _open_stores:
+        _open_stores[key] = VoxelStore(storedir)
+    return _open_stores[key]
+
+def buildStore(inputfiles, storedir, mask_name, map_coverage, gradient_set=None,
+               dtype=np.float32, z_score=False, substring=None, taskstring=None, runstring=None, verbose=1):
+    """
+    Write in-mask voxels of input maps or runs to a memory-mapped store.
+
+    Args:
+        inputfiles (list): The input map (3-d) or run (4-d) filepaths.
+        storedir (str): Directory to write the store to (created if needed).
+        mask_name (str): The name of the mask.
+        map_coverage (str): The coverage of the map.
+        gradient_set (GradientSet, optional): Preloaded gradients and mask. Defaults to None (loaded from cache).
+        dtype (numpy dtype, optional): dtype of the stored voxels. Defaults to float32.
+        z_score (boolean, optional): Z-score each input over its whole image first, as calGroupTimeCourse does. Defaults to False.
+        substring (str, optional): The string identifying the subject (assumes BID format), stored as the index's 'subject' column. Defaults to None.
+        taskstring (str, optional): The string identifying the task, stored as the 'task' column. Defaults to None.
+        runstring (str, optional): The string identifying the run, stored as the 'run' column. Defaults to None.
+        verbose (int, optional): The verbosity level. Defaults to 1.
+
+    Returns:
+        VoxelStore: The store, opened for reading.
+    """
+    import pandas as pd
+
+    from StateSpace.CorrelateTasksWithGradients import extractid, getGradientSet, usrpaths
+
+    gradient_paths, mask_path, task_paths = usrpaths(inputfiles, verbose, mask_name, map_coverage)
+    if gradient_set is None:
+        gradient_set = getGradientSet(mask_name, map_coverage)
+
+    # subject / task / run ids parsed from the paths (as in corrInd), checked before anything is written
+    ids = {col: [extractid(task, string) for task in task_paths]
+           for col, string in [('subject', substring), ('task', taskstring), ('run', runstring)] if string is not None}
+
+    os.makedirs(storedir, exist_ok=True)
+
+    # read headers only to find the number of rows (1 per 3-d map, 1 per TR of a 4-d run)
+    ndims, starts, stops = [], [], []
+    n_rows = 0
+    for task in task_paths:
+        shape = nib.load(task).shape
+        n = shape[3] if len(shape) == 4 else 1
+        ndims.append(len(shape))
+        starts.append(n_rows)
+        n_rows += n
+        stops.append(n_rows)
+
+    # preallocate on-disk matrix and fill it one input at a time
+    data = np.lib.format.open_memmap(os.path.join(storedir, VOXELS_FILE), mode='w+',
+                                     dtype=dtype, shape=(n_rows, gradient_set.n_voxels))
+    for task, start, stop in zip(task_paths, starts, stops):
+        taskimg = nib.load(task)
+        rows = np.atleast_2d(gradient_set.extract(taskimg))
+        if z_score:
+            # statistics over the whole image (including out-of-mask voxels), as in calGroupTimeCourse
+            taskarray = taskimg.get_fdata(dtype=np.float32)
+            rows = (rows - taskarray.mean(dtype=np.float64)) / taskarray.std(dtype=np.float64, ddof=1)
+            del taskarray
+        data[start:stop] = rows
+        if verbose > 0:
+            print (f"Stored {task} (rows {start}-{stop})")
+    data.flush()
+    del data
+
+    np.save(os.path.join(storedir, MASK_FILE), gradient_set.mask_index)
+    pd.DataFrame({'path': task_paths, **ids, 'ndim': ndims, 'start': starts, 'stop': stops}).to_csv(
+        os.path.join(storedir, INDEX_FILE), index=False)
+    with open(os.path.join(storedir, META_FILE), 'w') as f:
+        json.dump({'mask_name': str(mask_name), 'map_coverage': map_coverage,
+                   'n_voxels': gradient_set.n_voxels, 'dtype': np.dtype(dtype).name,
+                   'z_score': bool(z_score)}, f, indent=2)
+
+    return VoxelStore(storedir)
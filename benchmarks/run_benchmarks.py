@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
+'''
+Benchmark the CorrelateTasksWithGradients hot paths on synthetic data.
+
+Runs offline: synthetic niftis are generated in a temporary directory on the
+grid of the bundled gradients, and the masks in StateSpace/data/masks are used
+(binMask writes its mask to the temporary directory, never into data/masks).
+Each benchmark is timed (best and mean of --repeat runs) and then run once more
+under tracemalloc to record peak memory. The import time of each package module
+is measured in a fresh interpreter and checked against --import-budget.
+Results are written as JSON so they can be tracked over time.
+
+Example:
+    python benchmarks/run_benchmarks.py --subjects 8 --trs 50 --output bench.json
+
+'''
+
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import nibabel as nib
+import numpy as np
+from StateSpace.Utils import datapath
+
+from StateSpace import CorrelateTasksWithGradients, CreateBinarizedMask, Lesion
+
+def makeSynthetic(workdir, n_subjects, n_trs, n_parcels, seed=0):
+    """
+    Write synthetic maps, runs and a parcellation on the bundled gradient grid.
+
+    Args:
+        workdir (str): Directory to write to.
+        n_subjects (int): Number of subjects.
+        n_trs (int): Number of TRs per 4-d run.
+        n_parcels (int): Number of parcels in the synthetic parcellation.
+        seed (int, optional): Seed of the random generator. Defaults to 0.
+
+    Returns:
+        dict: Paths of the synthetic data.
+    """
+    rng = np.random.default_rng(seed)
+    gradient = nib.load(sorted(glob.glob(datapath('data/gradients') + '/*.nii.gz'))[0])
+    shape, affine = gradient.shape, gradient.affine
+
+    maps, runs = [], []
+    for sub in range(n_subjects):
+        for task in ('taskA', 'taskB'):
+            mapdir = os.path.join(workdir, 'bids', f'sub-{sub:03d}', f'task-{task}', 'run-1')
+            os.makedirs(mapdir, exist_ok=True)
+            maps.append(os.path.join(mapdir, 'map.nii.gz'))
+            nib.save(nib.Nifti1Image(rng.standard_normal(shape, dtype=np.float32), affine), maps[-1])
+        funcdir = os.path.join(workdir, 'bids', f'sub-{sub:03d}', 'func')
+        os.makedirs(funcdir, exist_ok=True)
+        runs.append(os.path.join(funcdir, 'bold.nii.gz'))
+        nib.save(nib.Nifti1Image(rng.standard_normal(shape + (n_trs,), dtype=np.float32), affine), runs[-1])
+
+    # parcellation as slabs along the x axis (labels 1..n_parcels)
+    labels = (np.arange(shape[0]) * n_parcels // shape[0] + 1).astype(np.int16)
+    parcellation = nib.Nifti1Image(np.broadcast_to(labels[:, None, None], shape).copy(), affine)
+
+    # lesion input directory (a copy of the first subject's maps)
+    lesiondir = os.path.join(workdir, 'lesion_maps')
+    os.makedirs(lesiondir, exist_ok=True)
+    for path in maps[:2]:
+        shutil.copy(path, os.path.join(lesiondir, os.path.basename(os.path.dirname(os.path.dirname(path))) + '.nii.gz'))
+
+    return {'maps': maps, 'runs': runs, 'parcellation': parcellation,
+            'lesiondir': lesiondir, 'lesionout': os.path.join(workdir, 'lesion_out')}
+
+def bench(name, func, repeat):
+    """
+    Time func (repeat runs) and record its peak traced memory (one extra run).
+
+    Args:
+        name (str): Name of the benchmark.
+        func (function): Function without arguments to benchmark.
+        repeat (int): Number of timed runs.
+
+    Returns:
+        dict: Benchmark result.
+    """
+    times = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        func()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {'name': name, 'repeat': repeat,
+              'seconds_min': min(times), 'seconds_mean': float(np.mean(times)),
+              'peak_mb': peak / 1e6}
+    print (f"{name:<24} min {result['seconds_min']:8.3f} s   mean {result['seconds_mean']:8.3f} s   peak {result['peak_mb']:9.1f} MB")
+    return result
+
+# modules whose cold import time is measured (and checked against the budget)
+IMPORT_MODULES = ['StateSpace.CorrelateTasksWithGradients', 'StateSpace.Lesion',
+                  'StateSpace.CreateBinarizedMask', 'StateSpace.CommandLine', 'StateSpace.AtlasRegistry']
+
+def importTime(module, repeat, budget):
+    """
+    Time a cold import of module in fresh interpreters (best of repeat runs).
+
+    Args:
+        module (str): Module to import.
+        repeat (int): Number of fresh interpreters to time the import in.
+        budget (float): Import time budget in seconds.
+
+    Returns:
+        dict: Import time result.
+    """
+    code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+    times = [float(subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout)
+             for _ in range(repeat)]
+    result = {'module': module, 'repeat': repeat, 'seconds_min': min(times), 'budget': budget,
+              'within_budget': min(times) <= budget}
+    print (f"import {module:<40} {result['seconds_min']:8.3f} s   budget {budget:.3f} s{'' if result['within_budget'] else '   OVER BUDGET'}")
+    return result
+
+def gitcommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--subjects', type=int, default=4, help='number of synthetic subjects (default: 4)')
+    parser.add_argument('--trs', type=int, default=20, help='number of TRs per synthetic run (default: 20)')
+    parser.add_argument('--parcels', type=int, default=7, help='number of parcels for Lesion.lesion / batchLesion (default: 7)')
+    parser.add_argument('--repeat', type=int, default=1, help='timed runs per benchmark (default: 1)')
+    parser.add_argument('--mask', default='gradientmask_cortical', help='mask name (default: gradientmask_cortical)')
+    parser.add_argument('--coverage', default='cortical_only', help='map coverage (default: cortical_only)')
+    parser.add_argument('--corr-method', default='spearman', help='correlation method (default: spearman)')
+    parser.add_argument('--only', nargs='+', help='only run benchmarks with these names')
+    parser.add_argument('--import-budget', type=float, default=0.5,
+                        help='maximum cold import time per module in seconds (default: 0.5)')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file to write results to')
+    args = parser.parse_args(argv)
+
+    C = CorrelateTasksWithGradients
+    mask, coverage, method = args.mask, args.coverage, args.corr_method
+
+    imports = [importTime(module, max(args.repeat, 3), args.import_budget) for module in IMPORT_MODULES]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        print (f"Writing synthetic data ({args.subjects} subjects, {args.trs} TRs) to {workdir}")
+        data = makeSynthetic(workdir, args.subjects, args.trs, args.parcels)
+        group_array = {}
+
+        def lesion():
+            for en in range(args.parcels):
+                parcel = f'parcel{en}'.encode()
+                os.makedirs(os.path.join(data['lesionout'], parcel.decode()), exist_ok=True)
+                Lesion.lesion(en, parcel, data['parcellation'], data['lesiondir'], data['lesionout'])
+
+        def batchlesion():
+            parcelnames = [f'parcel{en}'.encode() for en in range(args.parcels)]
+            Lesion.batchLesion(data['parcellation'], parcelnames, data['lesiondir'], data['lesionout'], verbose=0)
+
+        def calgroup():
+            group_array['masked'] = C.calGroupTimeCourse(mask, coverage, data['runs'], verbose=0)
+
+        def corrgrouptc():
+            if 'masked' not in group_array:
+                calgroup()
+            C.corrGroupTimeCourse(mask, coverage, group_array['masked'], corr_method=method, verbose=0)
+
+        def binmask():
+            # written to the temporary directory, never into the installed data/masks
+            maskdir = os.path.join(workdir, 'masks')
+            os.makedirs(maskdir, exist_ok=True)
+            CreateBinarizedMask.binMask('grad_only', coverage, outputdir=maskdir)
+
+        benchmarks = [
+            ('GradientSet', lambda: C.GradientSet(mask, coverage)),
+            ('corrGroup', lambda: C.corrGroup(mask, coverage, inputfiles=data['maps'], corr_method=method, verbose=0)),
+            ('corrInd', lambda: C.corrInd(mask, coverage, data['maps'], 'task-', 'sub-', corr_method=method, verbose=0)),
+            ('calGroupTimeCourse', calgroup),
+            ('corrGroupTimeCourse', corrgrouptc),
+            ('corrIndTimeCourse', lambda: C.corrIndTimeCourse(mask, coverage, data['runs'], 'sub-', corr_method=method, verbose=0)),
+            ('binMask', binmask),
+            ('Lesion.lesion', lesion),
+            ('Lesion.batchLesion', batchlesion),
+        ]
+
+        # load gradients once so the correlate benchmarks measure warm-cache runs
+        C.getGradientSet(mask, coverage)
+
+        results = [bench(name, func, args.repeat) for name, func in benchmarks
+                   if args.only is None or name in args.only]
+
+    report = {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'git_commit': gitcommit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'config': {'subjects': args.subjects, 'trs': args.trs, 'parcels': args.parcels,
+                   'repeat': args.repeat, 'mask': mask, 'coverage': coverage, 'corr_method': method,
+                   'import_budget': args.import_budget},
+        'imports': imports,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print (f"Results written to {args.output}")
+    return report
+
+if __name__ == '__main__':
+    report = main()
+    # non-zero exit if a module takes longer to import than the budget
+    sys.exit(0 if all(result['within_budget'] for result in report['imports']) else 1)
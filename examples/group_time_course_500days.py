@@ -1,7 +1,10 @@
 '''
 Correlates group time series of 500 days of summer with Gradients to produce group-averaged state-space coordinates.
 
-To run, make a copy in your analysis directory.
+To run, make a copy in your analysis directory and set bidsdir to your derivatives folder.
+The same analysis can be run from the command line:
+    statespace timecourse --mask gradientmask_cortical_subcortical --coverage all --name 500days-zscore --outputdir results \
+        --inputs "derivatives/sub_*/func/sub-*_task-500daysofsummer_bold_blur_censor_cut.nii.gz"
 
 '''
 import os
@@ -14,8 +17,11 @@ outputdir = os.path.join(os.path.split(os.path.split(os.path.realpath(__file__))
 if os.path.exists(outputdir) == False: #If results doesn't exist, make results directory
     os.mkdir(outputdir)
 
+# path to your derivatives folder
+bidsdir = os.path.join('500days', 'derivatives')
+
 # use glob to select all files you want to analyse and store them in a list
-inputfiles = glob.glob('C:\\Users\\bront\\Documents\\500days\\derivatives\\sub_*\\func\\sub-*_task-500daysofsummer_bold_blur_censor_cut.nii.gz')
+inputfiles = sorted(glob.glob(os.path.join(bidsdir, 'sub_*', 'func', 'sub-*_task-500daysofsummer_bold_blur_censor_cut.nii.gz')))
 
 # set the name of the mask you are using ('gradientmask_cortical_subcortical' or 'gradientmask_cortical') and the gradient coverage you want ('all' or 'cortical_only')
 mask_name = 'gradientmask_cortical_subcortical'
@@ -28,9 +34,9 @@ group_array_masked = CorrelateTasksWithGradients.calGroupTimeCourse(mask_name, m
 # set string to output name e.g., "500days-zscore", set verbose to 1 if you want print statements
 CorrelateTasksWithGradients.corrGroupTimeCourse(mask_name,
                                                 map_coverage, 
-                                                "500days-zscore",
                                                 group_array_masked,
-                                                outputdir,
+                                                timecourse_name="500days-zscore",
+                                                outputdir=outputdir,
                                                 corr_method='spearman',
                                                 verbose=1)
 
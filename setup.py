@@ -10,6 +10,15 @@ setup(
    author_email='bronte.mckeown@gmail.com',
    packages=find_packages(include=['StateSpace']),
    install_requires=required,
+   entry_points={
+    'console_scripts': ['statespace=StateSpace.CommandLine:main'],
+    },
+   extras_require={
+    'parquet': ['pyarrow'],
+    'feather': ['pyarrow'],
+    'hdf5': ['tables'],
+    'yaml': ['pyyaml'],
+    },
    include_package_data=True,
    package_data={'StateSpace': [
     'data/gradients/*nii.gz',
@@ -3,13 +3,15 @@
 '''
 Correlate task maps with Gradients to produce state-space coordinates.
 
-Using 'all maps' mask.
+Using the bundled 14-task battery maps with each mask.
+The same can be run from the command line, e.g.:
+    statespace corr-group --mask combinedmask_cortical --coverage cortical_only --outputdir scratch
 
 '''
 import os
 from StateSpace import CorrelateTasksWithGradients
 
-# get path to output dir 
+# get path to output dir 
 outputdir = os.path.join(os.path.split(os.path.split(os.path.realpath(__file__))[0])[0], 'scratch')
 
 if os.path.exists(outputdir) == False: #If scratch doesn't exist 
@@ -18,48 +20,24 @@ if os.path.exists(outputdir) == False: #If scratch doesn't exist
 ## COMBINED MASKS
 
 # Combined mask, cortical only
-CorrelateTasksWithGradients.corrTasks('combinedmask_cortical',
+CorrelateTasksWithGradients.corrGroup('combinedmask_cortical',
                                       'cortical_only',
                                       outputdir, verbose = 1)
 
 # Combined mask, cortical and subcortical
-CorrelateTasksWithGradients.corrTasks('combinedmask_cortical_subcortical',
+CorrelateTasksWithGradients.corrGroup('combinedmask_cortical_subcortical',
                                       'all',
                                       outputdir, verbose = 1)
 
-# Combined mask, cortical only, z-scored
-CorrelateTasksWithGradients.corrTasks('combinedmask_cortical',
-                                      'cortical_only',
-                                      outputdir, verbose = 1,
-                                      z_score=True)
-
-# Combined mask, cortical and subcortical, z-scored
-CorrelateTasksWithGradients.corrTasks('combinedmask_cortical_subcortical',
-                                      'all',
-                                      outputdir, verbose = 1,
-                                      z_score=True)
-
 
 ## GRADIENT-ONLY MASKS
 
 # Gradient mask, cortical only
-CorrelateTasksWithGradients.corrTasks('gradientmask_cortical',
+CorrelateTasksWithGradients.corrGroup('gradientmask_cortical',
                                       'cortical_only',
                                       outputdir, verbose = 1)
 
 # Gradient mask, cortical and subcortical
-CorrelateTasksWithGradients.corrTasks('gradientmask_cortical_subcortical',
+CorrelateTasksWithGradients.corrGroup('gradientmask_cortical_subcortical',
                                       'all',
                                       outputdir, verbose = 1)
-
-# Gradient mask, cortical only, z-scored
-CorrelateTasksWithGradients.corrTasks('gradientmask_cortical',
-                                      'cortical_only',
-                                      outputdir, verbose = 1,
-                                      z_score=True)
-
-# Gradient mask, cortical and subcortical, z-scored
-CorrelateTasksWithGradients.corrTasks('gradientmask_cortical_subcortical',
-                                      'all',
-                                      outputdir, verbose = 1,
-                                      z_score=True)
\ No newline at end of file
@@ -10,20 +10,19 @@ Create binarized mask from nifti image
 import glob
 import os
 from StateSpace import Lesion
-import pkg_resources
+from StateSpace.Utils import datapath
 import os
 import shutil
-from tqdm import tqdm
 
 if __name__ == "__main__":
 
     yeo = True
     splitmaps = False
 
-    # use pkg_resources to access the absolute path for each data subdirectory 
-    gradient_subdir = pkg_resources.resource_filename('StateSpace','data/gradients') # path to input gradient
-    task_subdir = pkg_resources.resource_filename('StateSpace','data/realTaskNiftis') # path to input task maps 
-    datadir = pkg_resources.resource_filename('StateSpace','data') # for output 
+    # use datapath to access the absolute path for each data subdirectory 
+    gradient_subdir = datapath('data/gradients') # path to input gradient
+    task_subdir = datapath('data/realTaskNiftis') # path to input task maps 
+    datadir = datapath('data') # for output 
 
     print(task_subdir)
 
@@ -34,11 +33,5 @@ if __name__ == "__main__":
 
     parcellation, parcelnames = Lesion.makemaps(yeo, splitmaps, yeover="thick_7")
 
-    for en, parcel in tqdm(enumerate(parcelnames)):
-        patht = os.path.join(path, parcel.decode())
-        if os.path.exists(patht):
-            shutil.rmtree(patht)
-        os.mkdir(patht)
-
-        Lesion.lesion(en, parcel, parcellation, task_subdir, path)
-        Lesion.lesion(en, parcel, parcellation, gradient_subdir, path)
\ No newline at end of file
+    # one pass over all parcels: maps are loaded and the parcellation resampled once
+    Lesion.batchLesion(parcellation, parcelnames, [task_subdir, gradient_subdir], path)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Shared fixtures: small synthetic volumes on a 6mm version of the bundled cortical mask.
+
+The bundled gradients are resampled to the coarse mask (as for any user mask),
+so every test runs on a few thousand voxels instead of the full 2mm grid.
+"""
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from StateSpace import CorrelateTasksWithGradients as C
+from StateSpace.Utils import datapath
+
+MAP_COVERAGE = 'cortical_only'
+
+@pytest.fixture(scope='session')
+def mask_path(tmp_path_factory):
+    from nilearn.image import resample_img
+
+    mask = nib.load(datapath('data/masks/gradientmask_cortical.nii.gz'))
+    affine = mask.affine.copy()
+    affine[:3, :3] *= 3
+    small = resample_img(mask, target_affine=affine, target_shape=(31, 37, 31), interpolation='nearest')
+    path = tmp_path_factory.mktemp('mask') / 'mask_6mm.nii.gz'
+    nib.Nifti1Image((small.get_fdata() > 0).astype(np.uint8), affine).to_filename(path)
+    return str(path)
+
+@pytest.fixture(scope='session')
+def gradient_set(mask_path):
+    return C.getGradientSet(mask_path, MAP_COVERAGE)
+
+def synthetic(gradient_set, rng, n_trs=None, signal=0.5):
+    # volume on the mask grid: a mix of gradients plus noise (also outside the mask)
+    shape = gradient_set.mask_index.shape + (() if n_trs is None else (n_trs,))
+    data = rng.normal(size=shape).astype(np.float32)
+    n = 1 if n_trs is None else n_trs
+    mix = rng.normal(size=(n, len(gradient_set.names))) @ gradient_set.matrix
+    data[gradient_set.mask_index] += signal * (mix.T if n_trs else mix[0]) / gradient_set.matrix.std()
+    return nib.Nifti1Image(data, gradient_set.maskimg.affine)
+
+@pytest.fixture(scope='session')
+def maps(gradient_set, tmp_path_factory):
+    rng = np.random.default_rng(0)
+    outdir = tmp_path_factory.mktemp('maps')
+    paths = []
+    for task in ['taskA', 'taskB', 'taskC']:
+        path = outdir / f'{task}.nii.gz'
+        synthetic(gradient_set, rng).to_filename(path)
+        paths.append(str(path))
+    return paths
+
+@pytest.fixture(scope='session')
+def subjects(gradient_set):
+    # (n_subjects x n_TRs x n_voxels) in-mask runs sharing a group time course
+    rng = np.random.default_rng(1)
+    group = rng.normal(size=(12, len(gradient_set.names))) @ gradient_set.matrix
+    group /= gradient_set.matrix.std()
+    return group + 0.5 * rng.normal(size=(8,) + group.shape)
+
+@pytest.fixture(scope='session')
+def parcellation(gradient_set):
+    # 5 slabs along x, labels 1..5 (0 outside the mask)
+    labels = np.zeros(gradient_set.mask_index.shape, dtype=np.int16)
+    x = np.nonzero(gradient_set.mask_index)[0]
+    labels[gradient_set.mask_index] = 1 + np.digitize(x, np.quantile(x, [0.2, 0.4, 0.6, 0.8]))
+    names = [f'parcel{label}'.encode() for label in range(1, 6)]
+    return nib.Nifti1Image(labels, gradient_set.maskimg.affine), names
+
+@pytest.fixture(scope='session')
+def indmaps(gradient_set, tmp_path_factory):
+    # individual-level maps in BIDS-like folders: <root>/sub-XX/task-Y/map.nii.gz
+    rng = np.random.default_rng(2)
+    root = tmp_path_factory.mktemp('bids')
+    paths = []
+    for sub in ['sub-01', 'sub-02', 'sub-03']:
+        for task in ['task-A', 'task-B']:
+            (root / sub / task).mkdir(parents=True)
+            path = root / sub / task / 'map.nii.gz'
+            synthetic(gradient_set, rng).to_filename(path)
+            paths.append(str(path))
+    return paths
+
+@pytest.fixture(scope='session')
+def runs(gradient_set, tmp_path_factory):
+    # int16 4-d runs in BIDS-like folders: <root>/sub-XX/func/bold.nii.gz
+    rng = np.random.default_rng(3)
+    root = tmp_path_factory.mktemp('runs')
+    paths = []
+    for sub in ['sub-01', 'sub-02', 'sub-03']:
+        (root / sub / 'func').mkdir(parents=True)
+        img = synthetic(gradient_set, rng, n_trs=20)
+        data = np.round(100 * img.get_fdata() + 1000).astype(np.int16)
+        path = root / sub / 'func' / 'bold.nii.gz'
+        nib.Nifti1Image(data, img.affine).to_filename(path)
+        paths.append(str(path))
+    return paths
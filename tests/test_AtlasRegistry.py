@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+import nibabel as nib
+import numpy as np
+import pytest
+from nilearn.image import resample_to_img
+
+from StateSpace.AtlasRegistry import AtlasRegistry, gridimg
+
+def test_seed_load_round_trip(parcellation, tmp_path):
+    labels, names = parcellation
+    path = str(tmp_path / 'slabs.nii.gz')
+    labels.to_filename(path)
+    # tab-separated lookup table (label, name, ...)
+    table = str(tmp_path / 'slabs.txt')
+    with open(table, 'w') as f:
+        f.writelines(f'{label}\t{name.decode()}\t0 0 0\n' for label, name in enumerate(names, start=1))
+
+    seeded = AtlasRegistry(str(tmp_path / 'registry')).seed('slabs_5', path, table)
+    registry = AtlasRegistry(str(tmp_path / 'registry'))
+    assert registry.keys() == ['slabs_5'] and 'slabs_5' in registry
+    atlas = registry.load('slabs_5')
+    assert atlas is registry.load('slabs_5')
+
+    expected = np.rint(resample_to_img(labels, gridimg(), interpolation='nearest').get_fdata())
+    assert atlas.labels.dtype == np.int16
+    np.testing.assert_array_equal(atlas.labels, expected)
+    np.testing.assert_array_equal(atlas.labels, seeded.labels)
+    np.testing.assert_array_equal(atlas.affine, gridimg().affine)
+    assert atlas.names == [name.decode() for name in names] and atlas.key == 'slabs_5'
+
+    for label, name in enumerate(names, start=1):
+        assert atlas.label(name) == label
+        np.testing.assert_array_equal(atlas.voxels(name), np.flatnonzero(expected == label))
+    with pytest.raises(KeyError):
+        registry.load('schaefer_400')
+
+def test_seed_rejects_mismatched_names(parcellation, tmp_path):
+    labels, names = parcellation
+    with pytest.raises(ValueError, match='do not match'):
+        AtlasRegistry(str(tmp_path)).seed('slabs_4', labels, names[:4])
+    assert AtlasRegistry(str(tmp_path)).keys() == []
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+from StateSpace import CorrelateTasksWithGradients as C
+from StateSpace.Bootstrap import bootstrapGroupTimeCourse
+
+from .conftest import MAP_COVERAGE
+
+@pytest.mark.parametrize('corr_method', ['pearson', 'spearman'])
+def test_bootstrap_ci_contains_estimate(mask_path, gradient_set, subjects, corr_method):
+    df = bootstrapGroupTimeCourse(mask_path, MAP_COVERAGE, subjects, n_boot=200, corr_method=corr_method, seed=0,
+                                  gradient_set=gradient_set, tr_chunk=5, boot_chunk=64, verbose=0)
+    assert len(df) == subjects.shape[1] * len(gradient_set.names)
+    assert np.all((df['lower'] <= df['Correlation']) & (df['Correlation'] <= df['upper']))
+    assert np.all(df['se'] > 0)
+
+    # standard percentile interval, and the median-centred band is the same interval shifted by the bias
+    assert np.all(df['percentile_lower'] <= df['percentile_upper'])
+    np.testing.assert_allclose(df['lower'], df['percentile_lower'] - df['bias'], atol=1e-12)
+    np.testing.assert_allclose(df['upper'], df['percentile_upper'] - df['bias'], atol=1e-12)
+
+    # point estimate is the group time course correlation
+    group = C.corrGroupTimeCourse(mask_path, MAP_COVERAGE, subjects.mean(axis=0), corr_method=corr_method,
+                                  gradient_set=gradient_set, verbose=0)
+    estimate = df.pivot(index='TR', columns='Gradient', values='Correlation')[group.columns]
+    np.testing.assert_allclose(estimate.values, group.values, atol=1e-10)
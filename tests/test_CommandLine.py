@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+import json
+
+from StateSpace import CommandLine
+
+
+def test_lesion_jobs_get_only_runlesion_defaults(tmp_path, monkeypatch):
+    manifest = tmp_path / 'jobs.json'
+    manifest.write_text(json.dumps({
+        'defaults': {'mask_name': 'gradientmask_cortical', 'map_coverage': 'cortical_only', 'output_format': 'parquet',
+                     'n_jobs': 4, 'cache': 'cache', 'n_perm': 100, 'verbose': 0},
+        'jobs': [{'command': 'corr-group', 'inputfiles': []},
+                 {'command': 'lesion', 'mapdir': 'maps', 'outpath': 'lesioned'}]}))
+    group, lesion = CommandLine.loadmanifest(str(manifest))
+    assert group['output_format'] == 'parquet' and group['n_jobs'] == 4
+    assert lesion == {'command': 'lesion', 'mapdir': 'maps', 'outpath': 'lesioned', 'verbose': 0}
+
+    calls = []
+    monkeypatch.setattr(CommandLine, 'runlesion', lambda **kwargs: calls.append(kwargs))
+    CommandLine.runjob(lesion)
+    assert calls == [{'mapdir': 'maps', 'outpath': 'lesioned', 'verbose': 0}]
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+import nibabel as nib
+import numpy as np
+import pandas as pd
+import pytest
+
+from StateSpace import CorrelateTasksWithGradients as C
+
+from .conftest import MAP_COVERAGE
+
+@pytest.mark.parametrize('corr_method', C.CORR_METHODS)
+def test_corrMatrix_matches_corrGrads(gradient_set, corr_method):
+    rng = np.random.default_rng(0)
+    inputs = rng.normal(size=(3, gradient_set.n_voxels)) + gradient_set.matrix[:3] / gradient_set.matrix.std()
+    # ties, as in thresholded maps
+    inputs[0, :100] = 0
+    corr = C.corrMatrix(inputs, gradient_set.matrix, corr_method)
+    expected = [[C.corrGrads(gradient, row, corr_method, verbose=0) for gradient in gradient_set.matrix] for row in inputs]
+    np.testing.assert_allclose(corr, expected, rtol=1e-7, atol=1e-10)
+
+def baselineLegacy(mask_path, maps, corr_method):
+    # whole-volume correlations as computed before the in-mask GradientSet (nilearn masking per map and gradient)
+    from nilearn import image as nimg
+
+    maskimg = nib.load(mask_path)
+    gradient_paths, mask, task_paths = C.getdata(mask_path, MAP_COVERAGE)
+    def masked(path):
+        img = nib.load(path)
+        if img.shape != maskimg.shape:
+            img = nimg.resample_to_img(source_img=img, target_img=maskimg, interpolation='nearest')
+        return nimg.math_img('a*b', a=img, b=maskimg).get_fdata()
+    return np.array([[C.corrGrads(masked(gradient), masked(task), corr_method, verbose=0) for gradient in gradient_paths]
+                     for task in maps])
+
+@pytest.mark.parametrize('corr_method', ['spearman', 'pearson'])
+def test_legacy_mask_matches_baseline(mask_path, gradient_set, maps, corr_method):
+    df = C.corrGroup(mask_path, MAP_COVERAGE, inputfiles=maps, corr_method=corr_method, verbose=0,
+                     gradient_set=gradient_set, legacy_mask=True)
+    np.testing.assert_allclose(df.values, baselineLegacy(mask_path, maps, corr_method), rtol=1e-6, atol=1e-9)
+    # in-mask correlations are a different statistic
+    in_mask = C.corrGroup(mask_path, MAP_COVERAGE, inputfiles=maps, corr_method=corr_method, verbose=0,
+                          gradient_set=gradient_set)
+    assert not np.allclose(in_mask.values, df.values)
+
+def test_ResampleIndex_matches_nilearn(gradient_set):
+    from nilearn.image import resample_to_img
+
+    # 5mm source grid, shifted so no target voxel falls halfway between source voxels
+    affine = np.diag([-5.0, 5.0, 5.0, 1.0])
+    affine[:3, 3] = [83.3, -118.9, -66.7]
+    data = np.random.default_rng(0).normal(size=(36, 44, 36, 2))
+    img = nib.Nifti1Image(data, affine)
+    index = C.ResampleIndex(img.shape[:3], img.affine, gradient_set.maskimg.shape, gradient_set.maskimg.affine)
+    expected = resample_to_img(img, gradient_set.maskimg, interpolation='nearest').get_fdata()
+    np.testing.assert_array_equal(index.apply(data), expected)
+    np.testing.assert_array_equal(index.apply(data, gradient_set.mask_index), expected[gradient_set.mask_index])
+
+def naiveWindow(matrix, window, taper):
+    # weighted mean of the TRs around each TR, truncated at the ends of the run
+    if taper == 'boxcar':
+        weights = np.ones(window)
+    else:
+        half = (window + 1) // 2
+        weights = np.convolve(np.ones(half), np.ones(half))
+    span = len(weights) - 1
+    out = np.empty(matrix.shape)
+    for tr in range(len(matrix)):
+        first = tr - (span + 1) // 2
+        rows = [(row, weight) for row, weight in zip(range(first, first + len(weights)), weights) if 0 <= row < len(matrix)]
+        out[tr] = sum(weight * matrix[row] for row, weight in rows) / sum(weight for row, weight in rows)
+    return out
+
+@pytest.mark.parametrize('window', [1, 2, 3, 4, 7])
+@pytest.mark.parametrize('taper', C.WINDOW_TAPERS)
+def test_slidingWindow_matches_naive(window, taper):
+    matrix = np.random.default_rng(window).normal(size=(15, 6))
+    np.testing.assert_allclose(C.slidingWindow(matrix, window, taper), naiveWindow(matrix, window, taper), atol=1e-12)
+
+def test_getGradientSet_reloads_rewritten_mask(mask_path, tmp_path):
+    import os
+
+    path = str(tmp_path / 'mask.nii.gz')
+    mask = nib.load(mask_path)
+    data = np.asanyarray(mask.dataobj).copy()
+    nib.Nifti1Image(data, mask.affine).to_filename(path)
+    first = C.getGradientSet(path, MAP_COVERAGE)
+    assert C.getGradientSet(path, MAP_COVERAGE) is first
+
+    # regenerate the mask at the same path with fewer voxels
+    data[:15] = 0
+    nib.Nifti1Image(data, mask.affine).to_filename(path)
+    os.utime(path, ns=(0, 0))
+    second = C.getGradientSet(path, MAP_COVERAGE)
+    assert second.n_voxels == int(data.sum()) < first.n_voxels
+
+def test_corrInd_n_jobs_matches_serial(mask_path, gradient_set, indmaps):
+    kwargs = dict(taskstring='task-', substring='sub-', verbose=0, gradient_set=gradient_set)
+    serial = C.corrInd(mask_path, MAP_COVERAGE, indmaps, **kwargs)
+    parallel = C.corrInd(mask_path, MAP_COVERAGE, indmaps, n_jobs=2, **kwargs)
+    assert len(serial) == len(indmaps)
+    pd.testing.assert_frame_equal(parallel, serial)
+
+def test_calGroupTimeCourse_streams_runs(mask_path, gradient_set, runs):
+    import tracemalloc
+
+    kwargs = dict(verbose=0, gradient_set=gradient_set, as_matrix=True)
+    group = C.calGroupTimeCourse(mask_path, MAP_COVERAGE, runs, chunk_size=3, **kwargs)
+    # z-scored over the whole 4-d image, then averaged
+    expected = np.mean([(data[gradient_set.mask_index].T - data.mean()) / data.std(ddof=1)
+                        for data in (nib.load(run).get_fdata() for run in runs)], axis=0)
+    np.testing.assert_allclose(group, expected, rtol=1e-5, atol=1e-5)
+
+    # peak memory stays below one int16 run (no float copy of the whole run)
+    run_bytes = np.asanyarray(nib.load(runs[0]).dataobj).nbytes
+    tracemalloc.start()
+    try:
+        C.calGroupTimeCourse(mask_path, MAP_COVERAGE, runs, chunk_size=2, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < run_bytes
+
+@pytest.mark.parametrize('legacy_mask', [False, True])
+def test_chunked_matches_whole_run_time_courses(mask_path, gradient_set, runs, legacy_mask):
+    kwargs = dict(verbose=0, gradient_set=gradient_set, legacy_mask=legacy_mask)
+    whole = C.corrIndTimeCourse(mask_path, MAP_COVERAGE, runs, 'sub-', **kwargs)
+    assert len(whole) == 3 * 20
+    # chunks that do not divide the run
+    chunked = C.corrIndTimeCourse(mask_path, MAP_COVERAGE, runs, 'sub-', chunk_size=7, **kwargs)
+    pd.testing.assert_frame_equal(chunked, whole, rtol=1e-10)
+
+@pytest.mark.parametrize('corr_method', ['spearman', 'pearson'])
+def test_parcel_mode_matches_manual_parcel_average(mask_path, gradient_set, maps, parcellation, corr_method):
+    labels, names = parcellation
+    corr = C.corrGroup(mask_path, MAP_COVERAGE, inputfiles=maps, corr_method=corr_method, verbose=0,
+                       gradient_set=gradient_set, parcellation=labels)
+    # mean of the in-mask voxels of every parcel, for the maps and the gradients
+    voxel_labels = np.asanyarray(labels.dataobj)[gradient_set.mask_index]
+    def average(matrix):
+        return np.stack([matrix[:, voxel_labels == label].mean(axis=1) for label in range(1, len(names) + 1)], axis=1)
+    inputs = np.stack([C.loadmasked(path, gradient_set) for path in maps])
+    expected = C.corrMatrix(average(inputs), average(gradient_set.matrix.astype(np.float64)), corr_method)
+    np.testing.assert_allclose(corr.values, expected, rtol=1e-6, atol=1e-9)
+
+    with pytest.raises(ValueError, match='legacy_mask is not supported at parcel resolution'):
+        C.corrGroup(mask_path, MAP_COVERAGE, inputfiles=maps, verbose=0, gradient_set=gradient_set,
+                    parcellation=labels, legacy_mask=True)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import nibabel as nib
+import numpy as np
+import pytest
+
+from StateSpace.CreateBinarizedMask import PackedMask, binMask, buildMask, coverageCount
+
+def writemaps(tmp_path, n_maps=5):
+    rng = np.random.default_rng(0)
+    affine = np.diag([3., 3., 3., 1.])
+    arrays = [rng.normal(size=(6, 7, 5)) * (rng.random((6, 7, 5)) < 0.7) for _ in range(n_maps)]
+    # a 4-d map counts voxels that are non-zero in every volume
+    run = rng.normal(size=(6, 7, 5, 3))
+    run[..., 1] *= rng.random((6, 7, 5)) < 0.8
+    paths = []
+    for n, array in enumerate(arrays + [run]):
+        paths.append(str(tmp_path / f'map{n}.nii.gz'))
+        nib.save(nib.Nifti1Image(array.astype(np.float32), affine), paths[-1])
+    nonzero = np.stack([array != 0 for array in arrays] + [(run != 0).all(axis=3)])
+    return paths, nonzero, affine
+
+def test_buildMask_rules(tmp_path):
+    paths, nonzero, affine = writemaps(tmp_path)
+    count, count_affine = coverageCount(paths)
+    np.testing.assert_array_equal(count, nonzero.sum(axis=0))
+    np.testing.assert_array_equal(count_affine, affine)
+
+    expected = {'intersection': nonzero.all(axis=0), 'union': nonzero.any(axis=0)}
+    for rule, array in expected.items():
+        mask = buildMask(paths, rule, verbose=0)
+        np.testing.assert_array_equal(mask.toarray(), array)
+        assert mask.n_voxels == array.sum()
+    for threshold in (0.5, 1.0):
+        mask = buildMask(paths, 'coverage', threshold=threshold, verbose=0)
+        np.testing.assert_array_equal(mask.toarray(), nonzero.mean(axis=0) >= threshold)
+    assert buildMask(paths, 'coverage', threshold=1.0, verbose=0) == buildMask(paths, 'intersection', verbose=0)
+
+    with pytest.raises(ValueError, match='rule must be one of'):
+        buildMask(paths, 'majority', verbose=0)
+    nib.save(nib.Nifti1Image(np.ones((6, 7, 4), dtype=np.float32), affine), str(tmp_path / 'other.nii.gz'))
+    with pytest.raises(ValueError, match='is not on the grid'):
+        buildMask(paths + [str(tmp_path / 'other.nii.gz')], 'union', verbose=0)
+
+def test_PackedMask_round_trip(tmp_path):
+    paths, nonzero, affine = writemaps(tmp_path)
+    path = str(tmp_path / 'mask.nii.gz')
+    mask = buildMask(paths, 'union', outpath=path, name='mymask', verbose=0)
+    loaded = PackedMask.load(path)
+    assert loaded == mask and hash(loaded) == hash(mask)
+    assert loaded.name == 'mask' and loaded.shape == nonzero.shape[1:]
+    assert nib.load(path).get_data_dtype() == np.uint8
+    np.testing.assert_array_equal(loaded.toarray(), nonzero.any(axis=0))
+
+def test_binMask_rejects_unknown_options(tmp_path):
+    with pytest.raises(ValueError, match='method must be'):
+        binMask('grad_union', 'cortical_only', outputdir=str(tmp_path))
+    with pytest.raises(ValueError, match='map_coverage must be'):
+        binMask('grad_only', 'subcortical', outputdir=str(tmp_path))
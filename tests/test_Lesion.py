@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import os
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from StateSpace import Lesion
+
+from .conftest import MAP_COVERAGE
+
+def lesions(function, mask_path, gradient_set, maps, parcellation, corr_method):
+    labels, names = parcellation
+    return function(labels, names, mask_path, MAP_COVERAGE, inputfiles=maps, corr_method=corr_method,
+                    gradient_set=gradient_set, verbose=0)
+
+def test_incrementalLesion_matches_virtualLesion(mask_path, gradient_set, maps, parcellation):
+    incremental = lesions(Lesion.incrementalLesion, mask_path, gradient_set, maps, parcellation, 'pearson')
+    virtual = lesions(Lesion.virtualLesion, mask_path, gradient_set, maps, parcellation, 'pearson')
+    np.testing.assert_allclose(incremental.loc[virtual.index].values, virtual.values, rtol=1e-6, atol=1e-9)
+
+def test_incrementalLesion_spearman_is_close(mask_path, gradient_set, maps, parcellation):
+    incremental = lesions(Lesion.incrementalLesion, mask_path, gradient_set, maps, parcellation, 'spearman')
+    virtual = lesions(Lesion.virtualLesion, mask_path, gradient_set, maps, parcellation, 'spearman')
+    # whole-brain ranks are not recomputed per lesion (each parcel here holds a fifth of the voxels)
+    deviation = np.abs(incremental.loc[virtual.index].values - virtual.values)
+    assert deviation.max() < 0.05
+    assert deviation.max() > 0
+
+def test_incrementalLesion_rejects_kendall(mask_path, gradient_set, maps, parcellation):
+    with pytest.raises(ValueError, match='use virtualLesion for kendall'):
+        lesions(Lesion.incrementalLesion, mask_path, gradient_set, maps, parcellation, 'kendall')
+
+def test_batchLesion_matches_lesion(maps, parcellation, tmp_path):
+    labels, names = parcellation
+    mapdir = os.path.dirname(maps[0])
+    for en, parcel in enumerate(names):
+        os.makedirs(tmp_path / 'lesion' / parcel.decode())
+        Lesion.lesion(en, parcel, labels, mapdir, str(tmp_path / 'lesion'))
+    paths = Lesion.batchLesion(labels, names, mapdir, str(tmp_path / 'batch'), n_threads=2, verbose=0)
+    assert len(paths) == len(names) * len(maps)
+    for path in paths:
+        expected = nib.load(path.replace(str(tmp_path / 'batch'), str(tmp_path / 'lesion')))
+        np.testing.assert_array_equal(nib.load(path).get_fdata(), expected.get_fdata())
+        np.testing.assert_array_equal(nib.load(path).affine, expected.affine)
+    # only the chosen parcels
+    paths = Lesion.batchLesion(labels, names, mapdir, str(tmp_path / 'some'), parcels=[names[1]], verbose=0)
+    assert sorted(os.listdir(tmp_path / 'some')) == [names[1].decode()] and len(paths) == len(maps)
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+from StateSpace.NullModels import blockIndex, nullPvalues, surrogateIndex
+
+@pytest.mark.parametrize('null_model', ['permute', 'block'])
+def test_nullPvalues_reproducible(gradient_set, null_model):
+    rng = np.random.default_rng(0)
+    inputs = rng.normal(size=(2, gradient_set.n_voxels)) + gradient_set.matrix[:2] / gradient_set.matrix.std()
+    pvalues = nullPvalues(inputs, gradient_set, n_perm=50, null_model=null_model, seed=7)
+    # same seed, whatever the batching and threads
+    np.testing.assert_array_equal(pvalues, nullPvalues(inputs, gradient_set, n_perm=50, null_model=null_model, seed=7))
+    np.testing.assert_array_equal(pvalues, nullPvalues(inputs, gradient_set, n_perm=50, null_model=null_model, seed=7,
+                                                       chunk_size=7, n_jobs=2))
+    assert not np.array_equal(pvalues, nullPvalues(inputs, gradient_set, n_perm=50, null_model=null_model, seed=8))
+    assert np.all((pvalues >= 1 / 51) & (pvalues <= 1))
+
+def test_block_surrogate_keeps_blocks_whole(gradient_set):
+    order, bounds = blocks = blockIndex(gradient_set.mask_index, block_size=3)
+    sizes = np.diff(bounds)
+    # partial blocks at the mask edge make sizes differ
+    assert len(np.unique(sizes)) > 1
+    block = np.repeat(np.arange(len(sizes)), sizes)
+    offset = np.arange(len(order)) - np.repeat(bounds[:-1], sizes)
+    position = np.empty(len(order), dtype=np.intp)
+    position[order] = np.arange(len(order))
+
+    index = surrogateIndex(np.random.default_rng(0), gradient_set.n_voxels, blocks)
+    np.testing.assert_array_equal(np.sort(index), np.arange(gradient_set.n_voxels))
+    source = position[index[order]]
+    shared = np.bincount(sizes)[sizes] > 1
+    for b in np.flatnonzero(shared):
+        rows = slice(bounds[b], bounds[b + 1])
+        # filled from a single block of the same size, voxels in their order
+        assert len(np.unique(block[source[rows]])) == 1
+        np.testing.assert_array_equal(offset[source[rows]], offset[rows])
+    # blocks were moved
+    assert np.mean(block[source[bounds[:-1]]] != np.arange(len(sizes))) > 0.5
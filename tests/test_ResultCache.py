@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+
+import nibabel as nib
+import numpy as np
+
+from StateSpace import CorrelateTasksWithGradients as C
+from StateSpace.ResultCache import ResultCache
+
+from .conftest import MAP_COVERAGE
+
+def corrGroup(mask_path, gradient_set, maps, cache, corr_method='spearman'):
+    return C.corrGroup(mask_path, MAP_COVERAGE, inputfiles=maps, corr_method=corr_method, verbose=0,
+                       gradient_set=gradient_set, cache=cache)
+
+def test_hits_and_invalidation(mask_path, gradient_set, maps, tmp_path):
+    maps = [shutil.copy(path, tmp_path) for path in maps]
+    cache = ResultCache(str(tmp_path / 'cache'))
+    first = corrGroup(mask_path, gradient_set, maps, cache)
+    assert (cache.hits, cache.misses) == (0, len(maps))
+
+    # same analysis again: every map read from the cache
+    second = corrGroup(mask_path, gradient_set, maps, cache)
+    assert (cache.hits, cache.misses) == (len(maps), len(maps))
+    np.testing.assert_array_equal(second.values, first.values)
+
+    # a changed map (new size / mtime) is correlated again
+    img = nib.load(maps[0])
+    nib.Nifti1Image(-img.get_fdata(), img.affine).to_filename(maps[0])
+    os.utime(maps[0], ns=(0, 0))
+    third = corrGroup(mask_path, gradient_set, maps, cache)
+    assert (cache.hits, cache.misses) == (2 * len(maps) - 1, len(maps) + 1)
+    assert not np.allclose(third.values[0], first.values[0])
+
+    # another correlation method misses every map
+    corrGroup(mask_path, gradient_set, maps, cache, corr_method='pearson')
+    assert cache.misses == 2 * len(maps) + 1
+    assert len(cache.entries()) == 2 * len(maps) + 1
+    assert cache.clear() == 2 * len(maps) + 1
+
+def test_key_follows_gradient_values_and_numerics_version(gradient_set, tmp_path, monkeypatch):
+    from StateSpace import ResultCache as RC
+
+    cache = ResultCache(str(tmp_path / 'cache'))
+    context = cache.context(gradient_set, 'spearman')
+    # same names, different values (e.g. a replaced gradient file)
+    changed = C.GradientSet.fromarrays(gradient_set.mask_name, gradient_set.map_coverage, gradient_set.names,
+                                       gradient_set.matrix[::-1].copy(), gradient_set.mask_index, gradient_set.maskimg)
+    assert cache.context(changed, 'spearman') != context
+    monkeypatch.setattr(RC, 'NUMERICS_VERSION', RC.NUMERICS_VERSION + 1)
+    assert cache.context(gradient_set, 'spearman') != context
+
+def test_cache_command(mask_path, gradient_set, maps, tmp_path, capsys):
+    from StateSpace.CommandLine import main
+
+    cachedir = str(tmp_path / 'cache')
+    corrGroup(mask_path, gradient_set, maps, cachedir)
+    assert main(['cache', 'info', cachedir]) == 0
+    assert f'{len(maps)} entries' in capsys.readouterr().out
+    assert main(['cache', 'clear', cachedir]) == 0
+    assert len(ResultCache(cachedir).entries()) == 0
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+from StateSpace.ResultTable import ResultTable
+
+def test_duplicate_ids_raise():
+    table = ResultTable(['Task_name', 'subid'], ['g1', 'g2'])
+    table.add(np.array([0.1, 0.2]), Task_name='taskA', subid='sub-01')
+    table.add(np.array([0.3, 0.4]), Task_name='taskA', subid='sub-02')
+    assert table.wide().shape == (2, 4)
+    table.add(np.array([0.5, 0.6]), Task_name='taskA', subid='sub-01')
+    with pytest.raises(ValueError, match='duplicate ids'):
+        table.wide()
+    with pytest.raises(ValueError, match='duplicate ids'):
+        table.long()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from StateSpace.ResultWriter import HDF_KEY, ResultWriter
+
+def chunk(subid, n=3):
+    df = pd.DataFrame(np.random.default_rng(len(subid)).normal(size=(n, 2)), columns=['g1', 'g2'])
+    df.insert(0, 'TR', np.arange(n))
+    df.insert(0, 'subid', subid)
+    return df
+
+def test_hdf5_rows_on_disk_after_each_append(tmp_path):
+    pytest.importorskip('tables')
+    path = str(tmp_path / 'scores.h5')
+    chunks = [chunk('sub-01'), chunk('sub-' + 'x' * 60)]
+    with ResultWriter(path, 'hdf5') as writer:
+        writer.append(chunks[0])
+        # appended to the table, not held back until close
+        assert writer._store.get_storer(HDF_KEY).nrows == 3
+        assert not writer._frames
+        writer.append(chunks[1])
+    pd.testing.assert_frame_equal(pd.read_hdf(path, HDF_KEY).reset_index(drop=True),
+                                  pd.concat(chunks, ignore_index=True))
+
+def test_corrInd_writes_each_subject_before_a_crash(mask_path, gradient_set, indmaps, tmp_path, monkeypatch):
+    from StateSpace import CorrelateTasksWithGradients as C
+    from .conftest import MAP_COVERAGE
+
+    corrIndMap = C._corrIndMap
+    def failing(task, *args, **kwargs):
+        if 'sub-03' in task:
+            raise RuntimeError('crash')
+        return corrIndMap(task, *args, **kwargs)
+    monkeypatch.setattr(C, '_corrIndMap', failing)
+    # mask given by file name, so output names have no directories in them
+    monkeypatch.chdir(os.path.dirname(mask_path))
+    with pytest.raises(RuntimeError):
+        C.corrInd(os.path.basename(mask_path), MAP_COVERAGE, indmaps, 'task-', 'sub-', outputdir=str(tmp_path), verbose=0,
+                  gradient_set=gradient_set)
+    # the subjects finished before the crash are on disk
+    wide = pd.read_csv(next(tmp_path.glob('*_wide.csv')))
+    assert sorted(set(wide['subid'])) == ['sub-01', 'sub-02']
+    assert len(next(tmp_path.glob('*_long.csv')).read_text().splitlines()) == 1 + 4 * len(gradient_set.names)
+
+def test_corrIndTimeCourse_writes_each_run_before_a_crash(mask_path, gradient_set, runs, tmp_path, monkeypatch):
+    from StateSpace import CorrelateTasksWithGradients as C
+    from .conftest import MAP_COVERAGE
+
+    loadmasked = C.loadmasked
+    def failing(item, *args, **kwargs):
+        if 'sub-02' in item:
+            raise RuntimeError('crash')
+        return loadmasked(item, *args, **kwargs)
+    monkeypatch.setattr(C, 'loadmasked', failing)
+    monkeypatch.chdir(os.path.dirname(mask_path))
+    with pytest.raises(RuntimeError):
+        C.corrIndTimeCourse(os.path.basename(mask_path), MAP_COVERAGE, runs, 'sub-', timecourse_name='tc', outputdir=str(tmp_path),
+                            verbose=0, gradient_set=gradient_set)
+    rows = pd.read_csv(next(tmp_path.glob('gradscores_ind_tc_*.csv')))
+    assert set(rows['subid']) == {'sub-01'} and len(rows) == 20
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+import pickle
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+from StateSpace import CorrelateTasksWithGradients as C
+from StateSpace.VoxelStore import buildStore
+
+from .conftest import MAP_COVERAGE
+
+def test_store_matches_per_file_loading(mask_path, gradient_set, indmaps, tmp_path):
+    store = buildStore(indmaps, str(tmp_path / 'store'), mask_path, MAP_COVERAGE, gradient_set,
+                       substring='sub-', taskstring='task-', verbose=0)
+    assert store.paths == indmaps
+    for entry, path in enumerate(indmaps):
+        np.testing.assert_array_equal(store[entry], gradient_set.extract(nib.load(path)).astype(np.float32))
+    # ids parsed once, at build time
+    assert store.index['subject'].tolist() == [C.extractid(path, 'sub-') for path in indmaps]
+    assert store.index['task'].tolist() == [C.extractid(path, 'task-') for path in indmaps]
+    assert 'run' not in store.index
+
+    # pickled (as for worker processes) as the directory only
+    assert len(pickle.dumps(store)) < 1000
+    np.testing.assert_array_equal(pickle.loads(pickle.dumps(store))[1], store[1])
+
+    kwargs = dict(taskstring='task-', substring='sub-', verbose=0, gradient_set=gradient_set)
+    from_files = C.corrInd(mask_path, MAP_COVERAGE, indmaps, **kwargs)
+    pd.testing.assert_frame_equal(C.corrInd(mask_path, MAP_COVERAGE, store, **kwargs), from_files, atol=1e-6)
+    pd.testing.assert_frame_equal(C.corrInd(mask_path, MAP_COVERAGE, store, n_jobs=2, **kwargs), from_files, atol=1e-6)